@@ -4,6 +4,7 @@ from aws_cdk import aws_ecs as ecs
 from aws_cdk import aws_s3 as s3
 from aws_cdk import aws_s3_notifications as s3n
 from aws_cdk import aws_ec2 as ec2
+from aws_cdk import aws_efs as efs
 from aws_cdk import aws_lambda as lambda_
 from aws_cdk import aws_secretsmanager as secretsmanager
 from aws_cdk import aws_iam as iam
@@ -38,6 +39,11 @@ class AlCaseScrnaseqStackPipeline(Stack):
         s3_bootstrap_bucket = cdk_config['s3_bucket_bootstrap']
         
         fastq_registration_task_storage_gb = int(cdk_config['fastq_registration_task_storage_gb'])
+        fastq_registration_num_cpus = int(cdk_config['fastq_registration_task_num_cpus'])
+        fastq_registration_task_ram_gb = int(cdk_config['fastq_registration_task_ram_gb'])
+        
+        fastq_registration_num_cpus_aws_format = str(fastq_registration_num_cpus*1024)
+        fastq_registration_task_ram_gb_aws_format = str(fastq_registration_task_ram_gb*1024)
         
         rawdata_processing_task_storage_gb = int(cdk_config['rawdata_processing_task_storage_gb'])
         rawdata_processing_num_cpus = int(cdk_config['rawdata_processing_task_num_cpus'])
@@ -46,6 +52,12 @@ class AlCaseScrnaseqStackPipeline(Stack):
         rawdata_processing_num_cpus_aws_format = str(rawdata_processing_num_cpus*1024)
         rawdata_processing_task_ram_gb_aws_format = str(rawdata_processing_task_ram_gb*1024)
         rawdata_processing_task_ram_cellranger = str(rawdata_processing_task_ram_gb-2) # Reduce 2GB for overhead
+        # Optional: transcriptome reference cache on EFS, shared by all rawdata-processing tasks
+        rawdata_processing_reference_cache_gb = int(cdk_config.get('rawdata_processing_reference_cache_gb', 0))
+        # Optional: sizing model of the quantification in the pipeline data bucket, see rawdata-processing/sizing.py
+        rawdata_processing_sizing_model_key = cdk_config.get('rawdata_processing_sizing_model_key') or ''
+        # Optional: million read pairs of a quick-look run launched before each full run, 0 disables quick-look runs
+        rawdata_processing_quick_look_reads = float(cdk_config.get('rawdata_processing_quick_look_reads') or 0)
         
         # integration        
         integration_task_ram_gb = int(cdk_config['integration_task_ram_gb'])
@@ -71,8 +83,8 @@ class AlCaseScrnaseqStackPipeline(Stack):
         fastq_registration_task_definition = ecs.TaskDefinition(self,
                                                     'case-scrnaseq-fastq-registration-td',
                                                     compatibility=ecs.Compatibility.FARGATE,
-                                                    cpu='1024',
-                                                    memory_mib = '2048',
+                                                    cpu=fastq_registration_num_cpus_aws_format,
+                                                    memory_mib = fastq_registration_task_ram_gb_aws_format,
                                                     ephemeral_storage_gib = fastq_registration_task_storage_gb)
         
         fastq_registration_container = fastq_registration_task_definition.add_container(
@@ -83,6 +95,7 @@ class AlCaseScrnaseqStackPipeline(Stack):
                 environment_files=[ecs.EnvironmentFile.from_asset('assets/fastq_registration.dev.env')],
                 environment={
                     'FASTQ_REGISTRATION_SERVICE_USER_SECRET_KEY_NAME' : service_user_secret_key_name,
+                    'FASTQ_REGISTRATION_NUM_WORKERS' : str(fastq_registration_num_cpus)
                 }
         )
         
@@ -117,6 +130,15 @@ class AlCaseScrnaseqStackPipeline(Stack):
             fastq_registration_input_policy
         )
         
+        # Registration manifests next to the input tar, checkpoints of a restarted registration are deleted
+        fastq_registration_manifest_policy = iam.PolicyStatement.from_json(policy_config['task_role_s3_io'])
+        fastq_registration_manifest_policy.add_actions('s3:DeleteObject')
+        fastq_registration_manifest_policy.add_resources(f'{fastq_registration_input_bucket.bucket_arn}/*.registration/*')
+        
+        fastq_registration_task_definition.add_to_task_role_policy(
+            fastq_registration_manifest_policy
+        )
+        
         # output bucket
         fastq_registration_databucket_policy = iam.PolicyStatement.from_json(policy_config['task_role_s3_io'])
         fastq_registration_databucket_policy.add_resources(f'{pipeline_data_bucket.bucket_arn}/*', 
@@ -170,9 +192,11 @@ class AlCaseScrnaseqStackPipeline(Stack):
         
         fastq_registration_lambda.add_to_role_policy(fastq_registration_lambda_policy)
         
-        fastq_registration_input_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, 
-                                                               s3n.LambdaDestination(fastq_registration_lambda), 
-                                                               s3.NotificationKeyFilter(suffix=".tar"))
+        # Uncompressed, gzip and zstd compressed tar archives
+        for tar_suffix in (".tar", ".tar.gz", ".tgz", ".tar.zst", ".tzst"):
+            fastq_registration_input_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, 
+                                                                   s3n.LambdaDestination(fastq_registration_lambda), 
+                                                                   s3.NotificationKeyFilter(suffix=tar_suffix))
         
         #endregion fastqregistration
 
@@ -202,6 +226,36 @@ class AlCaseScrnaseqStackPipeline(Stack):
                 }
         )
         
+        # Reference cache, tasks download a transcriptome reference once and reuse it from the file system
+        if rawdata_processing_reference_cache_gb:
+            reference_cache_mount_path = '/mnt/reference_cache'
+            
+            reference_cache_fs = efs.FileSystem(self,
+                                                'case-scrnaseq-reference-cache-fs',
+                                                vpc=network_stack.vpc,
+                                                vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_ISOLATED),
+                                                encrypted=True,
+                                                performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,
+                                                throughput_mode=efs.ThroughputMode.ELASTIC)
+            
+            reference_cache_fs.connections.allow_default_port_from(network_stack.sg_outbound)
+            
+            rawdata_processing_task_definition.add_volume(
+                name='reference-cache',
+                efs_volume_configuration=ecs.EfsVolumeConfiguration(file_system_id=reference_cache_fs.file_system_id,
+                                                                    transit_encryption='ENABLED')
+            )
+            
+            rawdata_processing_container.add_mount_points(ecs.MountPoint(container_path=reference_cache_mount_path,
+                                                                         source_volume='reference-cache',
+                                                                         read_only=False))
+            
+            rawdata_processing_container.add_environment('RAWDATA_PROCESSING_REFERENCE_CACHE_DIR', reference_cache_mount_path)
+            rawdata_processing_container.add_environment('RAWDATA_PROCESSING_REFERENCE_CACHE_MAX_GB', str(rawdata_processing_reference_cache_gb))
+        
+        if rawdata_processing_sizing_model_key:
+            rawdata_processing_container.add_environment('RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY', rawdata_processing_sizing_model_key)
+        
         # ENV File Policy
         rawdata_processing_task_execution_role_policy = iam.PolicyStatement.from_json(policy_config['task_execution_role_envfiles'])
         rawdata_processing_task_execution_role_policy.add_resources(f'arn:aws:s3:::{s3_bootstrap_bucket}/*', f'arn:aws:s3:::{s3_bootstrap_bucket}')
@@ -277,6 +331,16 @@ class AlCaseScrnaseqStackPipeline(Stack):
         
         rawdata_processing_lambda.add_to_role_policy(rawdata_processing_lambda_policy)
         
+        if rawdata_processing_quick_look_reads:
+            rawdata_processing_lambda.add_environment('QUICK_LOOK_READS', str(rawdata_processing_quick_look_reads))
+        
+        # Task size from the sizing model, the Lambda reads the model and the fastq sizes
+        if rawdata_processing_sizing_model_key:
+            rawdata_processing_lambda.add_environment('SIZING_MODEL_S3_KEY', rawdata_processing_sizing_model_key)
+            rawdata_processing_lambda_sizing_policy = iam.PolicyStatement.from_json(policy_config['task_execution_role_envfiles'])
+            rawdata_processing_lambda_sizing_policy.add_resources(f'{pipeline_data_bucket.bucket_arn}/*', pipeline_data_bucket.bucket_arn)
+            rawdata_processing_lambda.add_to_role_policy(rawdata_processing_lambda_sizing_policy)
+        
         pipeline_data_bucket.add_event_notification(s3.EventType.OBJECT_CREATED, 
                                                                s3n.LambdaDestination(rawdata_processing_lambda), 
                                                                s3.NotificationKeyFilter(suffix="R2_001.fastq.gz"))
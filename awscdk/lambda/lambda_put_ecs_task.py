@@ -1,32 +1,61 @@
 import json
+import math
 import boto3
 import jmespath
 import os
 boto3.set_stream_logger('')
 client = boto3.client("ecs")
+s3_client = boto3.client("s3")
 
 """
 
 """
 
-def lambda_handler(event, context):
+# Fargate vCPUs with min, max and step of the memory in GB, as in rawdata-processing/sizing.py
+FARGATE_SIZES = ((1, 2, 8, 1), (2, 4, 16, 1), (4, 8, 30, 1), (8, 16, 60, 4), (16, 32, 120, 8))
+OVERHEAD_GB = 2
+MEMORY_HEADROOM = 1.1
+
+def predict_task_size(model, fastq_size, num_reads=None):
+    """Predict the Fargate task size (vCPUs, memory GB) of a fastq pair of fastq_size bytes (the first num_reads), as sizing.predict in rawdata-processing/sizing.py
     
-    # Get object key
-    object_key = jmespath.search('Records[0].s3.object.key', event)
-    bucket = jmespath.search('Records[0].s3.bucket.name', event)
+    Kept in sync with sizing.predict, checked with: python rawdata-processing/sizing.py check model.json
+    """
     
-    # Load env variables
-    # Load env variables
-    cluster_name = os.environ.get('CLUSTER')
-    task_definition = os.environ.get('TASK_DEFINITION')
-    container_overrides = os.environ.get('CONTAINER_OVERRIDES')
-    security_groups = os.environ.get('SECURITY_GROUPS').split(',') # In case multiple are encoded by SECURITY GROUPS
-    subnets = os.environ.get('SUBNETS').split(',')
-    object_key_cmd_argument = os.environ.get('OBJECT_KEY_CMD_ARGUMENT')
-    bucket_cmd_argument = os.environ.get('BUCKET_CMD_ARGUMENT')
+    if num_reads:
+        fastq_size = min(fastq_size, num_reads * model['bytes_per_read_pair'])
     
-    # Add overwrites
-    overwrite_cmd = [bucket_cmd_argument, bucket, object_key_cmd_argument, object_key]
+    # Without transcriptome offset, the prediction is for the most frequent transcriptome of the history
+    fastq_gb = fastq_size / 1024 ** 3
+    features = {'intercept': 1.0, 'fastq_gb': fastq_gb, 'reads_m': int(fastq_gb * 1024 ** 3 / model['bytes_per_read_pair']) / 1e6}
+    rss_gb = sum(value * features.get(name, 0.0) for name, value in model['memory_coefficients'].items())
+    cpu_cores = sum(value * features.get(name, 0.0) for name, value in model['cores_coefficients'].items())
+    
+    # Capped at the largest task size
+    num_cores = min(max(math.ceil(cpu_cores + model['cores_margin']), 1), FARGATE_SIZES[-1][0])
+    mem_gb = min(math.ceil((max(rss_gb, 0) + model['memory_margin_gb']) * MEMORY_HEADROOM) + OVERHEAD_GB, FARGATE_SIZES[-1][2])
+    
+    for vcpus, min_gb, max_gb, step_gb in FARGATE_SIZES:
+        if vcpus >= num_cores and max_gb >= mem_gb:
+            return vcpus, max(min_gb, math.ceil(mem_gb / step_gb) * step_gb)
+
+def get_sizing_overrides(bucket, object_key, object_size, sizing_model_key, num_reads=None):
+    """Return the task size overrides and the container environment of a fastq pair from the sizing model"""
+    
+    model = json.loads(s3_client.get_object(Bucket=bucket, Key=sizing_model_key)['Body'].read())
+    
+    # Object key is read2, read1 is next to it
+    read1_key = object_key.removesuffix('R2_001.fastq.gz') + 'R1_001.fastq.gz'
+    fastq_size = object_size + s3_client.head_object(Bucket=bucket, Key=read1_key)['ContentLength']
+    
+    vcpus, task_gb = predict_task_size(model, fastq_size, num_reads)
+    
+    environment = [{'name': 'RAWDATA_PROCESSING_NUM_CORES', 'value': str(vcpus)},
+                   {'name': 'RAWDATA_PROCESSING_MEM_GB', 'value': str(task_gb - OVERHEAD_GB)}]
+    
+    return {'cpu': str(vcpus * 1024), 'memory': str(task_gb * 1024)}, environment
+
+def run_task(cluster_name, task_definition, security_groups, subnets, container, task_overrides):
     
     res = client.run_task(
         cluster=cluster_name,
@@ -42,13 +71,59 @@ def lambda_handler(event, context):
         },
         overrides={
             "containerOverrides": [
-                {"name": container_overrides, "command": overwrite_cmd},
+                container,
             ],
+            **task_overrides
         },
         propagateTags="TASK_DEFINITION",
         taskDefinition=task_definition
     )
     
+    return res
+
+def lambda_handler(event, context):
+    
+    # Get object key
+    object_key = jmespath.search('Records[0].s3.object.key', event)
+    bucket = jmespath.search('Records[0].s3.bucket.name', event)
+    
+    # Load env variables
+    # Load env variables
+    cluster_name = os.environ.get('CLUSTER')
+    task_definition = os.environ.get('TASK_DEFINITION')
+    container_overrides = os.environ.get('CONTAINER_OVERRIDES')
+    security_groups = os.environ.get('SECURITY_GROUPS').split(',') # In case multiple are encoded by SECURITY GROUPS
+    subnets = os.environ.get('SUBNETS').split(',')
+    object_key_cmd_argument = os.environ.get('OBJECT_KEY_CMD_ARGUMENT')
+    bucket_cmd_argument = os.environ.get('BUCKET_CMD_ARGUMENT')
+    sizing_model_key = os.environ.get('SIZING_MODEL_S3_KEY') # Optional: task size from the sizing model
+    quick_look_reads = float(os.environ.get('QUICK_LOOK_READS') or 0) # Optional: million read pairs of a quick-look run before the full run
+    
+    # Add overwrites
+    overwrite_cmd = [bucket_cmd_argument, bucket, object_key_cmd_argument, object_key]
+    
+    # A quick-look run on the first reads registers a preview, the full run follows as a second task
+    commands = [overwrite_cmd + ['--quick-look-reads', str(quick_look_reads)]] if quick_look_reads else []
+    commands.append(overwrite_cmd)
+    
+    for cmd in commands:
+        container = {"name": container_overrides, "command": cmd}
+        task_overrides = {}
+        
+        # The task definition size is used if the model is missing or the sizing fails for any reason
+        if sizing_model_key:
+            try:
+                object_size = jmespath.search('Records[0].s3.object.size', event)
+                num_reads = int(quick_look_reads * 1e6) if '--quick-look-reads' in cmd else None
+                sizing_overrides, environment = get_sizing_overrides(bucket, object_key, object_size, sizing_model_key, num_reads)
+            except Exception as e:
+                print(f'WARNING: Sizing failed, use the task definition size: {e}')
+            else:
+                task_overrides = sizing_overrides
+                container['environment'] = environment
+        
+        run_task(cluster_name, task_definition, security_groups, subnets, container, task_overrides)
+    
     return {'statusCode' : 200,
         'body': json.dumps(
             f'{bucket_cmd_argument}: {bucket}, {object_key_cmd_argument}: {object_key}'
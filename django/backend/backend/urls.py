@@ -37,6 +37,7 @@ urlpatterns = [
     path('api_v1/', include(router.urls)),
     path('admin/', admin.site.urls),
     path('api_v1/fastq_datasets/get_by_s3_read2_fastq_key/', views.FastqDatasetsViewSet.as_view({'get': 'get_by_s3_read2_fastq_key'})),
+    path('api_v1/fastq_datasets/get_by_sha256/', views.FastqDatasetsViewSet.as_view({'get': 'get_by_sha256'})),
     path('api_v1/scrnaseq_datasets/get_valid/', views.ScrnaseqDatasetsViewSet.as_view({'get': 'get_valid'})),
     path('api_v1/scrnaseq_integration/get_valid/', views.ScrnaseqIntegrationViewSet.as_view({'get': 'get_valid'})),
     path('api_v1/scrnaseq_dataset_annotations/get_valid/', views.ScrnaseqDatasetAnnotationsViewSet.as_view({'get': 'get_valid'})),
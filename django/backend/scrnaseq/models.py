@@ -12,6 +12,11 @@ class FastqDatasets(models.Model):
     s3_source_bucket = models.TextField()
     s3_read1_fastq_key = models.TextField()
     s3_read2_fastq_key = models.TextField()
+    s3_qc_profile_key = models.TextField(null=True, blank=True)
+    read1_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True) # Digest of the uncompressed fastq
+    read2_sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    chemistry = models.TextField(null=True, blank=True) # Likely cellranger chemistry from the read1 barcode prescan
+    valid_barcode_fraction = models.FloatField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     owner = models.ForeignKey(User, related_name='fastq_datasets', on_delete=models.CASCADE)
@@ -28,11 +33,15 @@ class ScrnaseqDatasets(models.Model):
     s3_qc_metrics_key = models.TextField()
     s3_gene_expression_matrix_key = models.TextField()
     s3_gene_expression_matrix_size_mb = models.FloatField()
+    s3_analysis_matrix_key = models.TextField(null=True, blank=True) # Analysis-ready h5ad of the filtered matrix
     number_cells = models.IntegerField()
     mean_reads_per_cell = models.IntegerField()
     median_number_genes_per_cell = models.IntegerField()
     total_number_reads = models.IntegerField()
     pipeline_version = models.TextField()
+    run_summary = models.JSONField(null=True, blank=True) # Resources and stage timings of the quantification
+    s3_run_timeline_key = models.TextField(null=True, blank=True)
+    provisional = models.BooleanField(default=False) # Preview of a quick-look run on the first reads
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     valid_from = models.DateTimeField(auto_now=True)
@@ -26,7 +26,12 @@ class FastqDatasetsSerializer(serializers.HyperlinkedModelSerializer):
                   's3_source_key',
                   's3_source_bucket',
                   's3_read1_fastq_key', 
-                  's3_read2_fastq_key')
+                  's3_read2_fastq_key',
+                  's3_qc_profile_key',
+                  'read1_sha256',
+                  'read2_sha256',
+                  'chemistry',
+                  'valid_barcode_fraction')
 
 class ScrnaseqDatasetsSerializer(serializers.HyperlinkedModelSerializer):
     
@@ -45,11 +50,15 @@ class ScrnaseqDatasetsSerializer(serializers.HyperlinkedModelSerializer):
                   's3_qc_metrics_key',
                   's3_gene_expression_matrix_key',
                   's3_gene_expression_matrix_size_mb', 
+                  's3_analysis_matrix_key',
                   'number_cells',
                   'mean_reads_per_cell',
                   'median_number_genes_per_cell', 
                   'total_number_reads',
                   'pipeline_version',
+                  'run_summary',
+                  's3_run_timeline_key',
+                  'provisional',
                     'valid_from',
                     'valid_to',
                 )
@@ -84,6 +84,18 @@ class FastqDatasetsViewSet(viewsets.ModelViewSet):
             return Response(serializer.data)
         else:
             return Response({"error": "read2 parameter is required"}, status=400)
+    
+    @action(detail=False, methods=['get'])
+    def get_by_sha256(self, request):
+        
+        read1_sha256 = request.query_params.get('read1_sha256')
+        read2_sha256 = request.query_params.get('read2_sha256')
+        if read1_sha256 and read2_sha256:
+            qset = FastqDatasets.objects.filter(read1_sha256=read1_sha256, read2_sha256=read2_sha256).order_by('created')
+            serializer = self.get_serializer(qset, many=True)
+            return Response(serializer.data)
+        else:
+            return Response({"error": "read1_sha256 and read2_sha256 parameters are required"}, status=400)
         
         
 class ScrnaseqDatasetsViewSet(viewsets.ModelViewSet):
@@ -100,20 +112,31 @@ class ScrnaseqDatasetsViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         
         fastq_dataset = serializer.validated_data.get('fastq_dataset')
+        provisional = serializer.validated_data.get('provisional', False)
         
-        # Update last dataset
-        q_last = ScrnaseqDatasets.objects.filter(fastq_dataset=fastq_dataset, valid_to=None).first()
+        # Update last dataset, a provisional preview of a quick-look run only replaces previews
+        q_valid = ScrnaseqDatasets.objects.filter(fastq_dataset=fastq_dataset, valid_to=None)
         
-        if q_last:
-            q_last.valid_to = datetime.datetime.now()
-            q_last.save()
+        if provisional:
+            q_valid = q_valid.filter(provisional=True)
         
-        serializer.save(owner=self.request.user)
+        q_valid.update(valid_to=datetime.datetime.now())
+        
+        # A preview which finished after the full run is not valid
+        if provisional and ScrnaseqDatasets.objects.filter(fastq_dataset=fastq_dataset, valid_to=None, provisional=False).exists():
+            serializer.save(owner=self.request.user, valid_to=datetime.datetime.now())
+        else:
+            serializer.save(owner=self.request.user)
     
     @action(detail=False, methods=['get'])
     def get_valid(self, request):
         
         qset = ScrnaseqDatasets.objects.filter(valid_to=None).all()
+        
+        # Optional: provisional=false excludes the previews of quick-look runs
+        provisional = request.query_params.get('provisional')
+        if provisional:
+            qset = qset.filter(provisional=provisional.lower() == 'true')
                 
         serializer = self.get_serializer(qset, many=True)
         return Response(serializer.data)
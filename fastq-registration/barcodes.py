@@ -0,0 +1,170 @@
+# case-scrnaseq/fastq-registration/barcodes.py
+
+"""
+Module for the cell barcode prescan of read1 during registration.
+
+The 16 bp cell barcode at the start of sampled read1 sequences is looked up
+in the 10x Genomics barcode whitelists. Barcodes are packed into uint32 keys
+with 2 bits per base, a whitelist index is the sorted array of its keys and
+lookups are a vectorized np.searchsorted over all sampled barcodes. The
+whitelist with the highest fraction of valid barcodes determines the likely
+chemistry, so that rawdata processing can fail fast or pin the chemistry.
+
+Whitelist indices are precomputed once from the whitelist files shipped with
+cellranger (lib/python/cellranger/barcodes):
+
+    python barcodes.py 3M-february-2018.txt.gz 737K-august-2016.txt --output-dir whitelists
+"""
+
+import argparse
+import gzip
+import os
+
+import numpy as np
+from pydantic import BaseModel
+
+import fastqcheck
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+BARCODE_LENGTH = 16
+
+INDEX_SUFFIX = '.npy'
+
+# cellranger chemistry by whitelist, None if the whitelist is shared by several chemistries
+WHITELIST_CHEMISTRIES = {
+    '737K-august-2016': None, # Single Cell 3' v2 and 5' v1/v2
+    '3M-february-2018': 'SC3Pv3',
+    '3M-3pgex-may-2023': 'SC3Pv4',
+    '3M-5pgex-jan-2023': 'SC5P-R2-v3',
+    '737K-arc-v1': 'ARC-v1'
+}
+
+# A whitelist is called if at least this fraction of sampled barcodes is valid
+MIN_CALL_FRACTION = 0.3
+
+# 2-bit base codes, other characters invalidate the barcode
+BASE_CODES = np.full(256, 4, dtype=np.uint32)
+for i, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = i
+    BASE_CODES[ord(base.lower())] = i
+
+SHIFTS = np.arange(2 * (BARCODE_LENGTH - 1), -1, -2, dtype=np.uint32)
+
+# DATA CLASSES
+
+class BarcodeReport(BaseModel):
+    num_reads_sampled: int
+    num_barcodes: int # Sampled reads with a barcode without N
+    whitelist: str | None = None # Called whitelist
+    chemistry: str | None = None
+    valid_barcode_fraction: float | None = None # Of the best matching whitelist
+    whitelist_fractions: dict[str, float] = {}
+
+# METHODS
+
+def encode_barcodes(barcodes: np.ndarray) -> tuple:
+    """Pack an (n, 16) uint8 array of barcodes into uint32 keys. Returns keys and a mask of barcodes without N."""
+
+    codes = BASE_CODES[barcodes]
+    valid = (codes < 4).all(axis=1)
+    keys = np.bitwise_or.reduce(np.where(codes < 4, codes, 0) << SHIFTS, axis=1)
+
+    return keys, valid
+
+
+def build_whitelist_index(whitelist_path: str) -> np.ndarray:
+    """Return the sorted uint32 keys of a whitelist file with one barcode per line, optionally gzipped."""
+
+    opener = gzip.open if whitelist_path.endswith('.gz') else open
+
+    with opener(whitelist_path, 'rb') as fh:
+        lines = fh.read().split()
+
+    barcodes = np.frombuffer(b''.join(line[:BARCODE_LENGTH] for line in lines), dtype=np.uint8).reshape(-1, BARCODE_LENGTH)
+    keys, valid = encode_barcodes(barcodes)
+
+    return np.unique(keys[valid])
+
+
+def get_whitelist_name(path: str) -> str:
+    name = os.path.basename(path)
+
+    for suffix in ('.gz', '.txt', INDEX_SUFFIX):
+        name = name.removesuffix(suffix)
+
+    return name
+
+
+def load_whitelists(whitelist_dir: str) -> dict:
+    """Memory-map the whitelist indices of a directory, worker processes share the pages."""
+
+    return {get_whitelist_name(f): np.load(os.path.join(whitelist_dir, f), mmap_mode='r')
+            for f in sorted(os.listdir(whitelist_dir)) if f.endswith(INDEX_SUFFIX)}
+
+
+class BarcodeCollector:
+    """Look up the barcodes of sampled read1 records in the whitelists.
+
+    Args:
+        whitelists: Sorted uint32 keys by whitelist name.
+        sample_rate: Fraction of records looked up.
+    """
+
+    def __init__(self, whitelists: dict, sample_rate: float = 0.01):
+        assert 0 < sample_rate <= 1, 'Sample rate must be in (0, 1]'
+
+        self.whitelists = whitelists
+        self.num_reads_sampled = 0
+        self.num_barcodes = 0
+        self._stride = max(1, round(1 / sample_rate))
+        self._hits = dict.fromkeys(whitelists, 0)
+
+    def update(self, batch: fastqcheck.RecordBatch):
+        first = (-batch.first_record) % self._stride
+        seq_starts = batch.starts[first::self._stride, 1]
+        seq_starts = seq_starts[batch.ends[first::self._stride, 1] - seq_starts >= BARCODE_LENGTH]
+        self.num_reads_sampled += len(batch.starts[first::self._stride])
+
+        if len(seq_starts) == 0:
+            return
+
+        keys, valid = encode_barcodes(batch.buf[seq_starts[:, None] + np.arange(BARCODE_LENGTH)[None, :]])
+        keys = keys[valid]
+        self.num_barcodes += len(keys)
+
+        for name, whitelist in self.whitelists.items():
+            i = np.minimum(np.searchsorted(whitelist, keys), len(whitelist) - 1)
+            self._hits[name] += int(np.count_nonzero(whitelist[i] == keys))
+
+    def finish(self) -> BarcodeReport:
+        fractions = {name: round(hits / max(self.num_barcodes, 1), 4) for name, hits in self._hits.items()}
+        best = max(fractions, key=fractions.get) if fractions else None
+        called = best if best is not None and fractions[best] >= MIN_CALL_FRACTION else None
+
+        return BarcodeReport(
+            num_reads_sampled=self.num_reads_sampled,
+            num_barcodes=self.num_barcodes,
+            whitelist=called,
+            chemistry=WHITELIST_CHEMISTRIES.get(called),
+            valid_barcode_fraction=fractions[best] if best is not None else None,
+            whitelist_fractions=fractions
+        )
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Precompute whitelist indices for the barcode prescan')
+    parser.add_argument('whitelists', nargs='+', help='Whitelist files, one barcode per line')
+    parser.add_argument('--output-dir', dest='output_dir', default='.', help='Output directory of the .npy indices')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for whitelist_path in args.whitelists:
+        index = build_whitelist_index(whitelist_path)
+        index_path = os.path.join(args.output_dir, get_whitelist_name(whitelist_path) + INDEX_SUFFIX)
+        np.save(index_path, index)
+        print(f'Wrote {len(index)} barcodes of {whitelist_path} to {index_path}')
@@ -0,0 +1,110 @@
+# case-scrnaseq/fastq-registration/benchmarks/bgzf_throughput.py
+
+"""
+Throughput benchmark of the BGZF block compressor against single-threaded gzip.
+
+The single-threaded baseline compresses with gzip.open and shutil.copyfileobj,
+which is the approach of utils.gzip_file. utils.gzip_file itself is benchmarked
+in addition if zihelper is installed.
+
+Usage:
+    python benchmarks/bgzf_throughput.py --size-mb 512 --threads 1,2,4,8
+"""
+
+import argparse
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bgzf
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size-mb", dest='size_mb', type=int, default=256, help="Size of the synthetic fastq file")
+parser.add_argument("--threads", dest='threads', type=str, default='1,2,4,8', help="Comma separated thread counts")
+parser.add_argument("--level", dest='level', type=int, default=6, help="Compression level of the BGZF compressor")
+
+
+def write_synthetic_fastq(path: str, size_mb: int, read_length: int = 90):
+    rnd = random.Random(42)
+    target_size = size_mb * 1024 * 1024
+    written = 0
+    i = 0
+
+    with open(path, 'w') as fh:
+        while written < target_size:
+            seq = ''.join(rnd.choices('ACGT', k=read_length))
+            qual = ''.join(rnd.choices('FFFF:,', k=read_length))
+            record = f'@A00123:8:H7TGKDSXY:1:1101:{i}:1000 2:N:0:ACGTACGT\n{seq}\n+\n{qual}\n'
+            fh.write(record)
+            written += len(record)
+            i += 1
+
+
+def benchmark(name: str, fn, input_path: str, output_path: str) -> dict:
+    size_mb = os.path.getsize(input_path) / (1024 * 1024)
+
+    start = time.perf_counter()
+    fn(input_path, output_path)
+    elapsed = time.perf_counter() - start
+
+    # Any gzip reader must restore the input
+    with gzip.open(output_path, 'rb') as out_fh, open(input_path, 'rb') as in_fh:
+        assert out_fh.read() == in_fh.read(), f'{name} output does not match input'
+
+    result = {
+        'name': name,
+        'seconds': round(elapsed, 2),
+        'mb_per_second': round(size_mb / elapsed, 1),
+        'ratio': round(os.path.getsize(output_path) / os.path.getsize(input_path), 3)
+    }
+    print(f"{name:<24} {result['seconds']:>8} s {result['mb_per_second']:>8} MB/s ratio {result['ratio']}")
+
+    return result
+
+
+def gzip_single_threaded(input_path: str, output_path: str):
+    with open(input_path, 'rb') as in_fh, gzip.open(output_path, 'wb') as out_fh:
+        shutil.copyfileobj(in_fh, out_fh)
+
+
+def main(size_mb: int, threads: list, level: int) -> list:
+    temp_dir = tempfile.TemporaryDirectory()
+    input_path = os.path.join(temp_dir.name, 'bench_R2_001.fastq')
+    output_path = input_path + '.gz'
+
+    print(f'Write synthetic fastq file of {size_mb} MB')
+    write_synthetic_fastq(input_path, size_mb)
+
+    results = [benchmark('gzip single-threaded', gzip_single_threaded, input_path, output_path)]
+
+    try:
+        from zihelper import utils
+
+        def _utils_gzip_file(in_path, out_path):
+            utils.gzip_file(in_path, output_dir=os.path.dirname(out_path), remove_original=False)
+
+        results.append(benchmark('utils.gzip_file', _utils_gzip_file, input_path, output_path))
+
+    except ImportError:
+        print('zihelper not installed, skip utils.gzip_file')
+
+    for num_threads in threads:
+        results.append(benchmark(f'bgzf {num_threads} threads',
+                                 lambda i, o: bgzf.compress_file(i, o, threads=num_threads, level=level),
+                                 input_path, output_path))
+
+    temp_dir.cleanup()
+
+    return results
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    main(args.size_mb, [int(t) for t in args.threads.split(',')], args.level)
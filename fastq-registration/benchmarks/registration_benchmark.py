@@ -0,0 +1,423 @@
+# case-scrnaseq/fastq-registration/benchmarks/registration_benchmark.py
+
+"""
+End-to-end benchmark of the fastq registration.
+
+Generates a synthetic tar with synthetic_tar.py, uploads it to a local S3
+stand-in (e.g. moto_server or MinIO) and runs main.main against a stub backend
+which answers the lookups and POST requests of the registration in-process.
+
+The registration runs all steps of a read in a single pass, per phase
+throughput is measured with each phase in isolation on the same tar:
+
+- download: ranged-request read of the input tar from S3
+- untar: walking the tar members, including archive decompression
+- gunzip: decompression of gzipped fastq members
+- validate: fastq validation of the uncompressed reads
+- gzip: BGZF compression of the uncompressed reads, as for uncompressed input
+- upload: multipart upload of the tar size with the registration's upload settings
+- post: POST requests of fastq datasets to the stub backend (requests/s)
+
+The end-to-end run reports the wall time, MB/s of tar and fastq bytes, the
+upload throughput of the registration's multipart uploads and the peak RSS of
+the registration including its worker processes and the peak disk usage of the
+filesystem of the temp directory, which includes a local S3 stand-in on the
+same filesystem. Results are written as JSON, --baseline prints the ratio of
+each throughput to a previous result.
+
+Usage:
+    moto_server -p 5000 &
+    python benchmarks/registration_benchmark.py --endpoint-url http://127.0.0.1:5000 --samples 4 --reads 1000000 \\
+        --compression gz --output results.json --baseline previous.json
+"""
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import boto3
+import numpy as np
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bgzf
+import fastqcheck
+import gzindex
+import manifest
+import multipart
+import tarstream
+import synthetic_tar
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+BACKEND_PATH = '/api_v1/fastq_datasets/'
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--endpoint-url", dest='endpoint_url', type=str, default=None, help="S3 endpoint, AWS_ENDPOINT_URL by default")
+parser.add_argument("--input-bucket", dest='input_bucket', type=str, default='registration-benchmark-input', help="Bucket of the tar, created if missing")
+parser.add_argument("--output-bucket", dest='output_bucket', type=str, default='registration-benchmark-output', help="Output bucket, created if missing")
+parser.add_argument("--samples", dest='samples', type=int, default=2, help="Number of samples")
+parser.add_argument("--reads", dest='reads', type=int, default=500000, help="Read pairs per sample and lane")
+parser.add_argument("--lanes", dest='lanes', type=int, default=1, help="Lanes per sample")
+parser.add_argument("--depth", dest='depth', type=int, default=1, help="Directory depth of the fastq files in the tar")
+parser.add_argument("--compression", dest='compression', type=str, default='none', help="Tar compression: none, gz or zst")
+parser.add_argument("--plain", dest='plain', action='store_true', help="Uncompressed fastq files in the tar")
+parser.add_argument("--whitelist", dest='whitelist', type=str, default=None, help="Whitelist index (.npy) of the cell barcodes")
+parser.add_argument("--posts", dest='posts', type=int, default=50, help="POST requests of the post phase")
+parser.add_argument("--output", dest='output', type=str, default=None, help="JSON file of the results")
+parser.add_argument("--baseline", dest='baseline', type=str, default=None, help="JSON results of a previous run to compare with")
+
+
+class StubBackend(ThreadingHTTPServer):
+    """Stub of the fastq dataset endpoints of the backend, POST requests are recorded."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubBackendHandler)
+        self.posts = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}{BACKEND_PATH}'
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubBackendHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        # Dataset list, connection test and content digest lookup, nothing is registered yet
+        self._respond(200, [])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        fields = {key: values[0] for key, values in parse_qs(body).items()}
+        self.server.posts.append(fields)
+        self._respond(201, fields)
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status: int, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ResourceSampler:
+    """Sample the RSS of this process and its worker processes and the disk usage of the temp directory."""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._disk_baseline = shutil.disk_usage(tempfile.gettempdir()).used
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+            self.peak_rss = max(self.peak_rss, sum(get_rss(pid) for pid in pids))
+            self.peak_disk = max(self.peak_disk, shutil.disk_usage(tempfile.gettempdir()).used - self._disk_baseline)
+            self._stop.wait(self.interval)
+
+
+class NullWriter:
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data: bytes) -> int:
+        self.bytes_written += len(data)
+        return len(data)
+
+
+def get_rss(pid: int) -> int:
+    """Return the resident set size of a process in bytes, 0 if it is not available."""
+
+    try:
+        with open(f'/proc/{pid}/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+
+    except OSError:
+        pass
+
+    return 0
+
+
+def get_throughput(num_bytes: int, seconds: float) -> dict:
+    seconds = max(seconds, 1e-6)
+
+    return {'mb': round(num_bytes / (1024 * 1024), 1), 'seconds': round(seconds, 2),
+            'mb_per_second': round(num_bytes / (1024 * 1024) / seconds, 1)}
+
+
+def set_registration_env(output_bucket: str, backend_url: str):
+    """Set the environment of main.py, tuning variables of the calling environment are kept."""
+
+    defaults = {
+        'FASTQ_REGISTRATION_VALID_FASTQ_EXTENSIONS': 'fastq.gz,fastq',
+        'FASTQ_REGISTRATION_VALID_READ1_SUFFIX': 'R1_001',
+        'FASTQ_REGISTRATION_VALID_READ2_SUFFIX': 'R2_001',
+        'FASTQ_REGISTRATION_OUTPUT_BUCKET_PREFIX': 'fastq_dataset',
+        'FASTQ_REGISTRATION_SERVICE_USER_SECRET_KEY_NAME': '',
+        'FASTQ_REGISTRATION_SERVICE_USER': 'benchmark',
+        'FASTQ_REGISTRATION_SERVICE_USER_PWD': 'benchmark'
+    }
+
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+    os.environ['FASTQ_REGISTRATION_OUTPUT_BUCKET'] = output_bucket
+    os.environ['FASTQ_REGISTRATION_BACKEND_URL'] = backend_url
+    # Every run registers the tar again
+    os.environ['FASTQ_REGISTRATION_RESUME'] = 'false'
+
+
+def benchmark_download(s3_bucket: str, s3_key: str, size: int, part_size: int, workers: int) -> dict:
+    start = time.perf_counter()
+
+    with tarstream.S3RangeReader(s3_bucket, s3_key, 0, size, part_size, workers) as fh:
+        while fh.read(READ_CHUNK_SIZE):
+            pass
+
+    return get_throughput(size, time.perf_counter() - start)
+
+
+def benchmark_local_phases(tar_path: str, compression: str | None, gzip_threads: int) -> dict:
+    """Time untar, gunzip, validate and gzip in one pass over the local tar, each step with its own timer."""
+
+    seconds = dict.fromkeys(('untar', 'gunzip', 'validate', 'gzip'), 0.0)
+    num_bytes = {'untar': os.path.getsize(tar_path), 'gunzip': 0, 'validate': 0, 'gzip': 0}
+
+    with open(tar_path, 'rb') as fh, tarstream.PrefetchStream(fh) as stream:
+        members = tarstream.iter_tar_members(stream, compression)
+
+        while True:
+            start = time.perf_counter()
+            item = next(members, None)
+            seconds['untar'] += time.perf_counter() - start
+
+            if item is None:
+                break
+
+            member, member_fh = item
+            gzipped = member.name.endswith('.gz')
+            decompressor = gzindex.GzipStreamDecompressor()
+            validator = fastqcheck.FastqValidator()
+            compressor = bgzf.BgzfWriter(NullWriter(), threads=gzip_threads)
+
+            while True:
+                start = time.perf_counter()
+                chunk = member_fh.read(READ_CHUNK_SIZE)
+                seconds['untar'] += time.perf_counter() - start
+
+                if not chunk:
+                    break
+
+                if gzipped:
+                    start = time.perf_counter()
+                    data = decompressor.decompress(chunk)
+                    seconds['gunzip'] += time.perf_counter() - start
+                    num_bytes['gunzip'] += len(chunk)
+                else:
+                    data = chunk
+
+                start = time.perf_counter()
+                validator.update(data)
+                seconds['validate'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                compressor.write(data)
+                seconds['gzip'] += time.perf_counter() - start
+
+                num_bytes['validate'] += len(data)
+                num_bytes['gzip'] += len(data)
+
+            start = time.perf_counter()
+            compressor.close()
+            seconds['gzip'] += time.perf_counter() - start
+
+            report = validator.finish()
+            assert report.valid, f'{member.name}: {report.error}'
+
+    return {phase: get_throughput(num_bytes[phase], seconds[phase]) for phase in seconds if num_bytes[phase]}
+
+
+def benchmark_upload(tar_path: str, s3_bucket: str, part_size: int, workers: int, max_buffer: int, min_workers: int) -> dict:
+    stats = multipart.upload_file(tar_path, s3_bucket, 'benchmark/upload.bin', None, part_size, workers, max_buffer, min_workers)
+
+    return get_throughput(stats.bytes_uploaded, stats.seconds) | {'concurrency': stats.concurrency, 'retries': stats.retries}
+
+
+def benchmark_post(backend: StubBackend, num_posts: int) -> dict:
+    fields = {'name': 'fq_benchmark', 's3_bucket': 'bucket', 's3_source_key': 'benchmark.tar', 's3_source_bucket': 'bucket',
+              's3_read1_fastq_key': 'benchmark_R1_001.fastq.gz', 's3_read2_fastq_key': 'benchmark_R2_001.fastq.gz'}
+    latencies = []
+
+    for _ in range(num_posts):
+        start = time.perf_counter()
+        res = requests.post(backend.url, data=fields)
+        latencies.append(time.perf_counter() - start)
+        assert res.status_code == 201, f'POST failed with status code {res.status_code}'
+
+    backend.posts.clear()
+
+    return {'requests': num_posts, 'seconds': round(sum(latencies), 2),
+            'requests_per_second': round(num_posts / max(sum(latencies), 1e-6), 1),
+            'mean_ms': round(1000 * float(np.mean(latencies)), 2), 'p95_ms': round(1000 * float(np.percentile(latencies, 95)), 2)}
+
+
+def benchmark_registration(main_module, s3_client, s3_bucket: str, s3_key: str, tar_size: int, backend: StubBackend) -> dict:
+    """Run main.main on the uploaded tar and collect throughput and peak resources."""
+
+    with ResourceSampler() as sampler:
+        start = time.perf_counter()
+        main_module.main(s3_key, s3_bucket)
+        seconds = time.perf_counter() - start
+
+    samples = manifest.load_manifest(s3_client, s3_bucket, s3_key).samples.values()
+    job_results = [job_result for checkpoint in samples for job_result in checkpoint.job_results.values()]
+    upload_rates = [job_result.upload_stats.mb_per_second for job_result in job_results if job_result.upload_stats]
+
+    return {
+        'samples': len(samples),
+        'registered': sum(checkpoint.state == 'posted' for checkpoint in samples),
+        'posts': len(backend.posts),
+        'tar': get_throughput(tar_size, seconds),
+        'fastq': get_throughput(sum(job_result.bytes_uncompressed for job_result in job_results), seconds),
+        'upload_mb_per_second_per_file': round(float(np.mean(upload_rates)), 1) if upload_rates else None,
+        'peak_rss_mb': round(sampler.peak_rss / (1024 * 1024), 1),
+        'peak_disk_mb': round(max(sampler.peak_disk, 0) / (1024 * 1024), 1)
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Print the throughput ratio of each phase to the baseline."""
+
+    rows = [(phase, result.get('mb_per_second', result.get('requests_per_second')),
+             baseline['phases'].get(phase, {}).get('mb_per_second', baseline['phases'].get(phase, {}).get('requests_per_second')))
+            for phase, result in results['phases'].items()]
+    rows.append(('end-to-end', results['registration']['fastq']['mb_per_second'], baseline['registration']['fastq']['mb_per_second']))
+
+    print(f"Compared with baseline of {baseline['created']}")
+    for phase, value, baseline_value in rows:
+        ratio = f'{value / baseline_value:.2f}x' if baseline_value else '-'
+        print(f'{phase:<12} {value:>10} {baseline_value if baseline_value is not None else "-":>10} {ratio:>8}')
+
+
+def main(args) -> dict:
+    if args.endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+
+    assert os.getenv('AWS_ENDPOINT_URL'), 'Local S3 endpoint required, set --endpoint-url or AWS_ENDPOINT_URL'
+
+    backend = StubBackend()
+    backend.start()
+    set_registration_env(args.output_bucket, backend.url)
+
+    # main.py reads its configuration on import
+    import main as registration_main
+
+    s3_client = boto3.client('s3')
+    existing_buckets = [bucket['Name'] for bucket in s3_client.list_buckets()['Buckets']]
+
+    for bucket in (args.input_bucket, args.output_bucket):
+        if bucket not in existing_buckets:
+            s3_client.create_bucket(Bucket=bucket)
+
+    compression = None if args.compression == 'none' else args.compression
+    temp_dir = tempfile.TemporaryDirectory()
+    s3_key = 'benchmark' + tarstream.TAR_SUFFIXES[compression][0]
+    tar_path = os.path.join(temp_dir.name, s3_key)
+
+    print(f'Write synthetic tar with {args.samples} samples, {args.lanes} lanes and {args.reads} read pairs per lane')
+    whitelist = np.load(args.whitelist) if args.whitelist else None
+    files = synthetic_tar.write_synthetic_tar(tar_path, args.samples, args.reads, args.lanes, depth=args.depth, plain=args.plain,
+                                              whitelist=whitelist)
+    tar_size = os.path.getsize(tar_path)
+    s3_client.upload_file(tar_path, args.input_bucket, s3_key)
+
+    phases = {}
+    phases['download'] = benchmark_download(args.input_bucket, s3_key, tar_size, registration_main.DOWNLOAD_PART_SIZE_MB * 1024 * 1024,
+                                            registration_main.DOWNLOAD_WORKERS)
+    phases.update(benchmark_local_phases(tar_path, compression, registration_main.GZIP_THREADS))
+    phases['upload'] = benchmark_upload(tar_path, args.output_bucket, registration_main.UPLOAD_PART_SIZE_MB * 1024 * 1024,
+                                        registration_main.UPLOAD_WORKERS, registration_main.UPLOAD_MAX_BUFFER_MB * 1024 * 1024,
+                                        registration_main.UPLOAD_MIN_WORKERS)
+    phases['post'] = benchmark_post(backend, args.posts)
+
+    for phase, result in phases.items():
+        print(f"{phase:<10} {result.get('mb_per_second', result.get('requests_per_second')):>10} "
+              f"{'MB/s' if 'mb_per_second' in result else 'requests/s'}")
+
+    print(f'Run registration of {s3_key}')
+    registration_result = benchmark_registration(registration_main, s3_client, args.input_bucket, s3_key, tar_size, backend)
+    print(f"Registered {registration_result['registered']} of {registration_result['samples']} samples at "
+          f"{registration_result['fastq']['mb_per_second']} MB/s fastq, peak RSS {registration_result['peak_rss_mb']} MB, "
+          f"peak disk {registration_result['peak_disk_mb']} MB")
+
+    backend.stop()
+    temp_dir.cleanup()
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'config': {
+            'samples': args.samples, 'reads': args.reads, 'lanes': args.lanes, 'depth': args.depth, 'compression': args.compression,
+            'plain': args.plain, 'num_files': len(files), 'fastq_mb': round(sum(files.values()) / (1024 * 1024), 1),
+            'tar_mb': round(tar_size / (1024 * 1024), 1), 'ingest_mode': registration_main.INGEST_MODE, 'qc_mode': registration_main.QC_MODE,
+            'num_workers': registration_main.NUM_WORKERS, 'gzip_threads': registration_main.GZIP_THREADS,
+            'download_workers': registration_main.DOWNLOAD_WORKERS, 'upload_workers': registration_main.UPLOAD_WORKERS,
+            'upload_part_size_mb': registration_main.UPLOAD_PART_SIZE_MB
+        },
+        'phases': phases,
+        'registration': registration_result
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f'Wrote results to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            compare(results, json.load(fh))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    main(parser.parse_args())
@@ -0,0 +1,150 @@
+# case-scrnaseq/fastq-registration/benchmarks/synthetic_tar.py
+
+"""
+Generator of synthetic 10x-style fastq pairs and tar archives.
+
+Read1 holds a 16 bp cell barcode from a pool of cells and a 12 bp UMI, read2
+a random 90 bp cDNA sequence. Mates share their read names as written by
+bcl-convert. Fastq files are written per sample and lane, uncompressed or
+as multi-member gzip, and packed into a tar (.tar, .tar.gz or .tar.zst) at a
+configurable directory depth. Barcodes are drawn from a whitelist index of
+barcodes.py if given, so the barcode prescan finds valid barcodes.
+
+Usage:
+    python benchmarks/synthetic_tar.py --output bench.tar.gz --samples 4 --reads 1000000 --lanes 2 --depth 2
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tarfile
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import barcodes
+import tarstream
+
+UMI_LENGTH = 12
+CDNA_LENGTH = 90
+
+# Reads per generated chunk, each chunk is one gzip member
+CHUNK_READS = 100000
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+QUALITIES = np.frombuffer(b'FFFF:,', dtype=np.uint8)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--output", dest='output', type=str, required=True, help="Output tar, the suffix sets the compression")
+parser.add_argument("--samples", dest='samples', type=int, default=2, help="Number of samples")
+parser.add_argument("--reads", dest='reads', type=int, default=100000, help="Read pairs per sample and lane")
+parser.add_argument("--lanes", dest='lanes', type=int, default=1, help="Lanes per sample")
+parser.add_argument("--cells", dest='cells', type=int, default=5000, help="Cell barcodes per sample")
+parser.add_argument("--depth", dest='depth', type=int, default=1, help="Directory depth of the fastq files in the tar")
+parser.add_argument("--plain", dest='plain', action='store_true', help="Write uncompressed fastq files")
+parser.add_argument("--whitelist", dest='whitelist', type=str, default=None, help="Whitelist index (.npy) of the cell barcodes")
+parser.add_argument("--seed", dest='seed', type=int, default=42, help="Random seed")
+
+
+def decode_barcodes(keys: np.ndarray) -> np.ndarray:
+    """Unpack uint32 barcode keys of a whitelist index into an (n, 16) uint8 array of bases."""
+
+    return BASES[(keys[:, None] >> barcodes.SHIFTS[None, :]) & 3]
+
+
+def get_cell_barcodes(rng: np.random.Generator, num_cells: int, whitelist: np.ndarray | None = None) -> np.ndarray:
+    if whitelist is not None:
+        return decode_barcodes(rng.choice(whitelist, num_cells, replace=False))
+
+    return BASES[rng.integers(0, 4, (num_cells, barcodes.BARCODE_LENGTH))]
+
+
+def get_fastq_chunk(names: np.ndarray, read: int, seqs: np.ndarray, rng: np.random.Generator) -> bytes:
+    """Return the fastq records of equally long sequences, names is an (n, k) uint8 array of read names."""
+
+    num_reads = len(seqs)
+    tag = np.frombuffer(f' {read}:N:0:ACGTACGT\n'.encode(), dtype=np.uint8)
+    quals = QUALITIES[rng.integers(0, len(QUALITIES), seqs.shape)]
+
+    columns = [np.full((num_reads, 1), ord('@'), dtype=np.uint8), names, np.broadcast_to(tag, (num_reads, len(tag))),
+               seqs, np.full((num_reads, 1), ord('\n'), dtype=np.uint8),
+               np.broadcast_to(np.frombuffer(b'+\n', dtype=np.uint8), (num_reads, 2)),
+               quals, np.full((num_reads, 1), ord('\n'), dtype=np.uint8)]
+
+    return np.hstack(columns).tobytes()
+
+
+def write_fastq_pair(r1_path: str, r2_path: str, num_reads: int, cell_barcodes: np.ndarray, lane: int,
+                     rng: np.random.Generator, plain: bool = False):
+    """Write read1 and read2 of a lane, gzipped files are written as one gzip member per chunk."""
+
+    with open(r1_path, 'wb') as r1_fh, open(r2_path, 'wb') as r2_fh:
+        for first in range(0, num_reads, CHUNK_READS):
+            n = min(CHUNK_READS, num_reads - first)
+
+            names = np.frombuffer(''.join(f'A00123:8:H7TGKDSXY:{lane}:1101:{first + i:010d}:1000' for i in range(n)).encode(),
+                                  dtype=np.uint8).reshape(n, -1)
+
+            cells = cell_barcodes[rng.integers(0, len(cell_barcodes), n)]
+            umis = BASES[rng.integers(0, 4, (n, UMI_LENGTH))]
+            cdna = BASES[rng.integers(0, 4, (n, CDNA_LENGTH))]
+
+            r1 = get_fastq_chunk(names, 1, np.hstack([cells, umis]), rng)
+            r2 = get_fastq_chunk(names, 2, cdna, rng)
+
+            r1_fh.write(r1 if plain else gzip.compress(r1, compresslevel=1))
+            r2_fh.write(r2 if plain else gzip.compress(r2, compresslevel=1))
+
+
+def write_synthetic_tar(output: str, num_samples: int = 2, num_reads: int = 100000, num_lanes: int = 1, num_cells: int = 5000,
+                        depth: int = 1, plain: bool = False, whitelist: np.ndarray | None = None, seed: int = 42) -> dict:
+    """Write a tar of synthetic fastq pairs. Returns the generated files with their sizes."""
+
+    compression = tarstream.get_tar_compression(output)
+    rng = np.random.default_rng(seed)
+    extension = 'fastq' if plain else 'fastq.gz'
+    prefix = '/'.join(['run'] + [f'level{i}' for i in range(1, depth)]) + '/' if depth else ''
+    files = {}
+
+    with tempfile.TemporaryDirectory() as temp_dir, open(output, 'wb') as out_fh:
+
+        if compression == 'zst':
+            import zstandard
+            fh = zstandard.ZstdCompressor(threads=-1).stream_writer(out_fh, closefd=False)
+        else:
+            fh = out_fh
+
+        with tarfile.open(fileobj=fh, mode='w|gz' if compression == 'gz' else 'w|') as tar:
+            for s in range(num_samples):
+                cell_barcodes = get_cell_barcodes(rng, num_cells, whitelist)
+
+                for lane in range(1, num_lanes + 1):
+                    paths = [os.path.join(temp_dir, f'Sample{s + 1}_S{s + 1}_L{lane:03d}_{read}_001.{extension}') for read in ('R1', 'R2')]
+                    write_fastq_pair(*paths, num_reads, cell_barcodes, lane, rng, plain)
+
+                    # Members are added and removed one lane at a time
+                    for path in paths:
+                        arcname = prefix + os.path.basename(path)
+                        files[arcname] = os.path.getsize(path)
+                        tar.add(path, arcname=arcname)
+                        os.remove(path)
+
+        if compression == 'zst':
+            fh.close()
+
+    return files
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    whitelist = np.load(args.whitelist) if args.whitelist else None
+
+    files = write_synthetic_tar(args.output, args.samples, args.reads, args.lanes, args.cells, args.depth, args.plain,
+                                whitelist, args.seed)
+
+    print(f'Wrote {len(files)} fastq files of {sum(files.values()) / (1024 * 1024):.1f} MB to {args.output} '
+          f'({os.path.getsize(args.output) / (1024 * 1024):.1f} MB)')
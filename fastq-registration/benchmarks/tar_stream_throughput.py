@@ -0,0 +1,124 @@
+# case-scrnaseq/fastq-registration/benchmarks/tar_stream_throughput.py
+
+"""
+Throughput benchmark of sequential tar streaming.
+
+Writes a synthetic archive of gzipped fastq members as .tar, .tar.gz and
+.tar.zst and walks each archive with tarstream.iter_tar_members behind a
+PrefetchStream. Member data is decompressed and validated as in stream mode of
+the registration. Reports MB/s of archive bytes and of uncompressed fastq
+bytes per compression.
+
+Usage:
+    python benchmarks/tar_stream_throughput.py --size-mb 256 --members 8
+"""
+
+import argparse
+import gzip
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fastqcheck
+import gzindex
+import tarstream
+from bgzf_throughput import write_synthetic_fastq
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--size-mb", dest='size_mb', type=int, default=256, help="Uncompressed fastq size of all members")
+parser.add_argument("--members", dest='members', type=int, default=8, help="Number of fastq members")
+parser.add_argument("--compressions", dest='compressions', type=str, default='none,gz,zst', help="Comma separated archive compressions")
+
+
+def write_archive(path: str, members: list, compression: str | None):
+    with open(path, 'wb') as out_fh:
+        if compression == 'zst':
+            import zstandard
+            fh = zstandard.ZstdCompressor(threads=-1).stream_writer(out_fh)
+            mode = 'w|'
+
+        else:
+            fh = out_fh
+            mode = 'w|gz' if compression == 'gz' else 'w|'
+
+        with tarfile.open(fileobj=fh, mode=mode) as tar:
+            for member_path in members:
+                tar.add(member_path, arcname=os.path.basename(member_path))
+
+        if compression == 'zst':
+            fh.close()
+
+
+def benchmark(name: str, archive_path: str, compression: str | None) -> dict:
+    archive_mb = os.path.getsize(archive_path) / (1024 * 1024)
+    num_bytes = 0
+    num_records = 0
+
+    start = time.perf_counter()
+
+    with open(archive_path, 'rb') as fh, tarstream.PrefetchStream(fh) as stream:
+        for member, member_fh in tarstream.iter_tar_members(stream, compression):
+            decompressor = gzindex.GzipStreamDecompressor()
+            validator = fastqcheck.FastqValidator()
+
+            while chunk := member_fh.read(1024 * 1024):
+                validator.update(decompressor.decompress(chunk))
+
+            decompressor.finish()
+            report = validator.finish()
+            assert report.valid, f'{member.name}: {report.error}'
+
+            num_bytes += report.num_bytes
+            num_records += report.num_records
+
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'name': name,
+        'seconds': round(elapsed, 2),
+        'archive_mb_per_second': round(archive_mb / elapsed, 1),
+        'fastq_mb_per_second': round(num_bytes / (1024 * 1024) / elapsed, 1),
+        'num_records': num_records
+    }
+    print(f"{name:<10} {result['seconds']:>8} s {result['archive_mb_per_second']:>8} MB/s archive "
+          f"{result['fastq_mb_per_second']:>8} MB/s fastq")
+
+    return result
+
+
+def main(size_mb: int, num_members: int, compressions: list) -> list:
+    temp_dir = tempfile.TemporaryDirectory()
+    members = []
+
+    print(f'Write {num_members} synthetic fastq.gz members of {size_mb} MB in total')
+    for i in range(num_members):
+        fastq_path = os.path.join(temp_dir.name, f'S{i}_S1_R2_001.fastq')
+        write_synthetic_fastq(fastq_path, max(1, size_mb // num_members))
+
+        with open(fastq_path, 'rb') as in_fh, gzip.open(fastq_path + '.gz', 'wb', compresslevel=1) as out_fh:
+            out_fh.write(in_fh.read())
+
+        os.remove(fastq_path)
+        members.append(fastq_path + '.gz')
+
+    results = []
+
+    for name in compressions:
+        compression = None if name == 'none' else name
+        archive_path = os.path.join(temp_dir.name, 'bench' + tarstream.TAR_SUFFIXES[compression][0])
+        write_archive(archive_path, members, compression)
+        results.append(benchmark(name, archive_path, compression))
+
+    temp_dir.cleanup()
+
+    return results
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    main(args.size_mb, args.members, args.compressions.split(','))
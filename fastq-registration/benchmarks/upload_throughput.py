@@ -0,0 +1,98 @@
+# case-scrnaseq/fastq-registration/benchmarks/upload_throughput.py
+
+"""
+Throughput benchmark of the multipart upload engine.
+
+Uploads a random file with fixed and auto-tuned concurrency and reports MB/s
+per upload. Runs against the S3 endpoint of AWS_ENDPOINT_URL or --endpoint-url,
+e.g. a local MinIO or moto_server. --fail-rate injects failed part uploads to
+exercise the per-part retries.
+
+Usage:
+    moto_server -p 5000 &
+    python benchmarks/upload_throughput.py --endpoint-url http://127.0.0.1:5000 --size-mb 512 --workers 1,4,8
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import boto3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import multipart
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--endpoint-url", dest='endpoint_url', type=str, default=None, help="S3 endpoint, AWS_ENDPOINT_URL by default")
+parser.add_argument("--bucket", dest='bucket', type=str, default='upload-benchmark', help="Bucket, created if missing")
+parser.add_argument("--size-mb", dest='size_mb', type=int, default=256, help="Size of the uploaded file")
+parser.add_argument("--part-size-mb", dest='part_size_mb', type=int, default=16, help="Part size")
+parser.add_argument("--workers", dest='workers', type=str, default='1,4,8', help="Comma separated fixed concurrencies")
+parser.add_argument("--max-buffer-mb", dest='max_buffer_mb', type=int, default=None, help="Memory ceiling of buffered parts")
+parser.add_argument("--fail-rate", dest='fail_rate', type=float, default=0.0, help="Fraction of part uploads which fail")
+
+
+class FlakyClient:
+    """S3 client wrapper which fails a fraction of part uploads."""
+
+    def __init__(self, s3_client, fail_rate: float):
+        self._s3_client = s3_client
+        self._fail_rate = fail_rate
+        self._random = random.Random(42)
+
+    def upload_part(self, **kwargs):
+        if self._random.random() < self._fail_rate:
+            raise ConnectionError('Injected part upload failure')
+
+        return self._s3_client.upload_part(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._s3_client, name)
+
+
+def main(endpoint_url: str | None, bucket: str, size_mb: int, part_size_mb: int, workers: list,
+         max_buffer_mb: int | None, fail_rate: float) -> list:
+    s3_client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    if bucket not in [b['Name'] for b in s3_client.list_buckets()['Buckets']]:
+        s3_client.create_bucket(Bucket=bucket)
+
+    if fail_rate:
+        s3_client = FlakyClient(s3_client, fail_rate)
+        multipart.RETRY_BACKOFF_SECONDS = 0.1
+
+    temp_dir = tempfile.TemporaryDirectory()
+    file_path = os.path.join(temp_dir.name, 'upload.bin')
+
+    print(f'Write random file of {size_mb} MB')
+    with open(file_path, 'wb') as fh:
+        for _ in range(size_mb):
+            fh.write(os.urandom(1024 * 1024))
+
+    max_buffer_bytes = max_buffer_mb * 1024 * 1024 if max_buffer_mb else None
+    runs = [(f'fixed {w}', w, None) for w in workers] + [(f'auto 1-{max(workers)}', max(workers), 1)]
+    results = []
+
+    for name, max_workers, min_workers in runs:
+        stats = multipart.upload_file(file_path, bucket, f'benchmark/{name.replace(" ", "_")}.bin', s3_client,
+                                      part_size_mb * 1024 * 1024, max_workers, max_buffer_bytes, min_workers)
+
+        head = s3_client.head_object(Bucket=bucket, Key=stats.s3_key)
+        assert head['ContentLength'] == size_mb * 1024 * 1024, f'{name} uploaded {head["ContentLength"]} bytes'
+
+        print(f'{name:<12} {stats.mb_per_second:>8} MB/s concurrency {stats.concurrency} retries {stats.retries}')
+        results.append(stats.model_dump() | {'name': name})
+
+    temp_dir.cleanup()
+
+    return results
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    main(args.endpoint_url, args.bucket, args.size_mb, args.part_size_mb, [int(w) for w in args.workers.split(',')],
+         args.max_buffer_mb, args.fail_rate)
@@ -0,0 +1,166 @@
+# case-scrnaseq/fastq-registration/bgzf.py
+
+"""
+Module for multi-threaded block gzip (BGZF) compression.
+
+Input is split into independent blocks of at most 64 KB which are compressed
+on a thread pool. Each block is written as a separate gzip member with the
+BGZF extra field, the result is a regular multi-member gzip file readable by
+any gzip reader and by htslib based tools.
+"""
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# Uncompressed bytes per block, as used by htslib to keep blocks below 64 KB compressed
+BGZF_BLOCK_SIZE = 65280
+BGZF_MAX_BLOCK_SIZE = 65536
+
+# Empty block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Number of blocks compressed per thread pool task
+BLOCKS_PER_BATCH = 64
+
+# METHODS
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    """Compress up to BGZF_BLOCK_SIZE bytes into a single BGZF block."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    # Incompressible data can exceed the block size limit, store it uncompressed instead
+    if len(cdata) + 26 > BGZF_MAX_BLOCK_SIZE:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+
+    # gzip header with FEXTRA flag and BGZF subfield 'BC' holding the total block size - 1
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25)
+    trailer = struct.pack('<2I', zlib.crc32(data), len(data))
+
+    return header + cdata + trailer
+
+
+def compress_batch(data: bytes, level: int = 6) -> bytes:
+    """Compress data into consecutive BGZF blocks."""
+
+    return b''.join(compress_block(data[i:i + BGZF_BLOCK_SIZE], level) for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+
+class BgzfWriter:
+    """File-like writer which compresses data to BGZF on a thread pool.
+
+    Compressed batches are written to fileobj in input order. Call close()
+    to flush pending data, the BGZF EOF marker is appended if eof is True.
+
+    Args:
+        fileobj: Target with a write(bytes) method.
+        threads: Number of compression threads.
+        level: zlib compression level.
+        eof: Append the BGZF EOF marker on close.
+        block_fn: Called with the compressed and uncompressed offset of each written block.
+    """
+
+    def __init__(self, fileobj, threads: int = 4, level: int = 6, eof: bool = True, block_fn: Callable[[int, int], Any] | None = None):
+        self.fileobj = fileobj
+        self.level = level
+        self.eof = eof
+        self.block_fn = block_fn
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._bytes_written_in = 0
+        self._batch_size = BGZF_BLOCK_SIZE * BLOCKS_PER_BATCH
+        self._buf = bytearray()
+        self._pending = deque()
+        self._max_pending = 2 * threads
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data: bytes) -> int:
+        self._buf += data
+        self.bytes_in += len(data)
+
+        while len(self._buf) >= self._batch_size:
+            self._submit(bytes(self._buf[:self._batch_size]))
+            del self._buf[:self._batch_size]
+
+        return len(data)
+
+    def flush(self):
+        """Compress and write all buffered data, the current block is closed."""
+
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf.clear()
+
+        while self._pending:
+            self._write_next()
+
+    def close(self):
+        if self._closed:
+            return
+
+        self.flush()
+
+        if self.eof:
+            self.fileobj.write(BGZF_EOF)
+            self.bytes_out += len(BGZF_EOF)
+
+        self._executor.shutdown(wait=True)
+        self._closed = True
+
+    def _submit(self, data: bytes):
+        # Bound memory usage by the number of batches in flight
+        while len(self._pending) >= self._max_pending:
+            self._write_next()
+
+        self._pending.append((self._executor.submit(compress_batch, data, self.level), len(data)))
+
+    def _write_next(self):
+        future, size = self._pending.popleft()
+        cdata = future.result()
+
+        if self.block_fn is not None:
+            pos = 0
+
+            # BSIZE field of the BGZF header holds the block size - 1
+            for i in range(0, size, BGZF_BLOCK_SIZE):
+                self.block_fn(self.bytes_out + pos, self._bytes_written_in + i)
+                pos += struct.unpack_from('<H', cdata, pos + 16)[0] + 1
+
+        self.fileobj.write(cdata)
+        self.bytes_out += len(cdata)
+        self._bytes_written_in += size
+
+
+def compress_file(input_path: str, output_path: str | None = None, threads: int = 4, level: int = 6,
+                  remove_original: bool = False) -> str:
+    """Compress a file to BGZF. Returns the output path, input_path + '.gz' by default."""
+
+    if output_path is None:
+        output_path = input_path + '.gz'
+
+    with open(input_path, 'rb') as in_fh, open(output_path, 'wb') as out_fh:
+        with BgzfWriter(out_fh, threads=threads, level=level) as writer:
+            while chunk := in_fh.read(BGZF_BLOCK_SIZE * BLOCKS_PER_BATCH):
+                writer.write(chunk)
+
+    if remove_original:
+        os.remove(input_path)
+
+    return output_path
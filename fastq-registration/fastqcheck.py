@@ -0,0 +1,203 @@
+# case-scrnaseq/fastq-registration/fastqcheck.py
+
+"""
+Module for vectorized checks of fastq streams.
+
+Uncompressed fastq data is fed in large chunks. Complete records are located
+with NumPy on the raw bytes, partial records are carried over to the next
+chunk. All checks work on arrays of line offsets instead of single records.
+"""
+
+import numpy as np
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# Byte values used by the checks
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+HEADER_MARKER = ord('@')
+SEPARATOR_MARKER = ord('+')
+TAB = ord('\t')
+
+# DATA CLASSES
+
+class FastqValidationReport(BaseModel):
+    valid: bool
+    num_records: int
+    num_bytes: int
+    error: str | None = None
+    error_record: int | None = None # 0-based index of the first invalid record
+
+# METHODS
+
+def is_printable(arr: np.ndarray) -> bool:
+    """Check that a chunk only contains printable ASCII, line breaks and tabs."""
+
+    if arr.max(initial=0) > 126:
+        return False
+
+    # Fast path for chunks where newlines are the only control characters
+    num_control = np.count_nonzero(arr < 32)
+    if num_control == np.count_nonzero(arr == NEWLINE):
+        return True
+
+    return num_control == np.count_nonzero((arr == NEWLINE) | (arr == CARRIAGE_RETURN) | (arr == TAB))
+
+
+class RecordBatch:
+    """Complete fastq records of a chunk.
+
+    Attributes:
+        buf: uint8 array of the raw record bytes.
+        starts: Array of shape (n, 4) with start offsets of header, sequence, separator and quality lines.
+        ends: Array of shape (n, 4) with end offsets (exclusive, without line breaks).
+        first_record: Index of the first record of the batch in the stream.
+    """
+
+    def __init__(self, buf: np.ndarray, starts: np.ndarray, ends: np.ndarray, first_record: int):
+        self.buf = buf
+        self.starts = starts
+        self.ends = ends
+        self.first_record = first_record
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def read_lengths(self) -> np.ndarray:
+        return self.ends[:, 1] - self.starts[:, 1]
+
+
+class FastqRecordParser:
+    """Split a stream of uncompressed fastq chunks into batches of complete records."""
+
+    def __init__(self):
+        self.num_records = 0
+        self.num_bytes = 0
+        self._carry = b''
+
+    def feed(self, data: bytes) -> RecordBatch | None:
+        """Add a chunk, returns the complete records or None if no record was completed."""
+
+        self.num_bytes += len(data)
+        buf = self._carry + data if self._carry else data
+        arr = np.frombuffer(buf, dtype=np.uint8)
+
+        newlines = np.flatnonzero(arr == NEWLINE)
+        num_records = len(newlines) // 4
+
+        if num_records == 0:
+            self._carry = buf
+            return None
+
+        # Keep the bytes of incomplete records for the next chunk
+        num_lines = num_records * 4
+        end = newlines[num_lines - 1] + 1
+        self._carry = buf[end:]
+
+        ends = newlines[:num_lines]
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+
+        # Windows line breaks are not part of the line
+        has_cr = np.zeros(num_lines, dtype=bool)
+        non_empty = ends > starts
+        has_cr[non_empty] = arr[ends[non_empty] - 1] == CARRIAGE_RETURN
+        ends = ends - has_cr
+
+        batch = RecordBatch(arr[:end], starts.reshape(-1, 4), ends.reshape(-1, 4), self.num_records)
+        self.num_records += num_records
+
+        return batch
+
+    def finish(self) -> RecordBatch | None:
+        """Parse a final record without trailing line break. Remaining bytes are in .remainder."""
+
+        if self._carry and not self._carry.endswith(b'\n') and self._carry.count(b'\n') == 3:
+            self.num_bytes -= 1
+            return self.feed(b'\n')
+
+        return None
+
+    @property
+    def remainder(self) -> bytes:
+        return self._carry
+
+
+class FastqValidator:
+    """Validate the full fastq stream.
+
+    Checks the 4-line record structure, the '@' and '+' markers, equal
+    sequence and quality lengths, printable characters and counts records.
+    Checked record batches are passed to the update(batch) method of consumers.
+    """
+
+    def __init__(self, consumers: list | None = None):
+        self.parser = FastqRecordParser()
+        self.consumers = consumers or []
+        self.error = None
+        self.error_record = None
+
+    def update(self, data: bytes) -> RecordBatch | None:
+        """Validate a chunk, returns the complete records of the chunk for further processing."""
+
+        if self.error is not None:
+            return None
+
+        if not is_printable(np.frombuffer(data, dtype=np.uint8)):
+            self._set_error('Invalid non-printable character', self.parser.num_records)
+            return None
+
+        batch = self.parser.feed(data)
+
+        if batch is not None:
+            self._check_batch(batch)
+
+        return batch
+
+    def finish(self) -> FastqValidationReport:
+        if self.error is None:
+            batch = self.parser.finish()
+
+            if batch is not None:
+                self._check_batch(batch)
+
+        if self.error is None and self.parser.remainder.strip():
+            self._set_error('Truncated record at end of file', self.parser.num_records)
+
+        if self.error is None and self.parser.num_records == 0:
+            self._set_error('No fastq records', 0)
+
+        return FastqValidationReport(
+            valid=self.error is None,
+            num_records=self.parser.num_records,
+            num_bytes=self.parser.num_bytes,
+            error=self.error,
+            error_record=self.error_record
+        )
+
+    def _check_batch(self, batch: RecordBatch):
+        buf, starts, ends = batch.buf, batch.starts, batch.ends
+
+        checks = [
+            ('Header line does not start with @', (ends[:, 0] > starts[:, 0]) & (buf[starts[:, 0]] == HEADER_MARKER)),
+            ('Separator line does not start with +', (ends[:, 2] > starts[:, 2]) & (buf[np.minimum(starts[:, 2], len(buf) - 1)] == SEPARATOR_MARKER)),
+            ('Sequence and quality lengths differ', (ends[:, 1] - starts[:, 1]) == (ends[:, 3] - starts[:, 3]))
+        ]
+
+        for message, ok in checks:
+            if not ok.all():
+                self._set_error(message, batch.first_record + int(np.argmin(ok)))
+                return
+
+        for consumer in self.consumers:
+            consumer.update(batch)
+
+    def _set_error(self, message: str, record: int):
+        if self.error is None:
+            self.error = message
+            self.error_record = record
@@ -0,0 +1,156 @@
+# case-scrnaseq/fastq-registration/fastqqc.py
+
+"""
+Module for fastq QC profiles computed during registration.
+
+Record batches of the fastq validator are profiled with NumPy: read length
+histogram, per-position mean quality, Q30 fraction, per-position base
+composition and N rate. In sample mode only every n-th record is profiled,
+in full mode all records are profiled.
+"""
+
+import numpy as np
+from pydantic import BaseModel
+
+import fastqcheck
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+QC_MODES = ('full', 'sample', 'off')
+
+# Phred+33 encoded quality offset and Q30 threshold
+QUALITY_OFFSET = 33
+Q30 = 30
+
+# Positions beyond this length are not profiled
+MAX_PROFILE_LENGTH = 1024
+
+BASES = 'ACGTN'
+
+# Base codes, all other characters are counted as N
+BASE_CODES = np.full(256, BASES.index('N'), dtype=np.int64)
+for i, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = i
+
+# DATA CLASSES
+
+class FastqQcProfile(BaseModel):
+    name: str
+    mode: str
+    sample_rate: float
+    num_reads: int
+    num_reads_profiled: int
+    length_histogram: dict[int, int]
+    mean_quality: list[float] # Per position
+    q30_fraction: float
+    base_composition: dict[str, list[float]] # Per base and position
+    n_rate: float
+
+# METHODS
+
+class FastqQcCollector:
+    """Accumulate a QC profile from record batches.
+
+    Args:
+        name: Name of the profiled file.
+        mode: 'full' profiles all records, 'sample' every n-th record.
+        sample_rate: Fraction of records profiled in sample mode.
+    """
+
+    def __init__(self, name: str, mode: str = 'sample', sample_rate: float = 0.05):
+        assert mode in ('full', 'sample'), f'Invalid QC mode {mode}'
+        assert 0 < sample_rate <= 1, 'Sample rate must be in (0, 1]'
+
+        self.name = name
+        self.mode = mode
+        self.sample_rate = sample_rate if mode == 'sample' else 1.0
+        self.num_reads = 0
+        self.num_reads_profiled = 0
+        self._stride = max(1, round(1 / self.sample_rate))
+        self._length_counts = np.zeros(0, dtype=np.int64)
+        self._position_counts = np.zeros(0, dtype=np.int64)
+        self._quality_sums = np.zeros(0, dtype=np.int64)
+        self._base_counts = np.zeros((0, len(BASES)), dtype=np.int64)
+        self._q30_bases = 0
+
+    def update(self, batch: fastqcheck.RecordBatch):
+        self.num_reads += len(batch)
+
+        # Records are sampled by their index in the file, independent of chunk boundaries
+        first = (-batch.first_record) % self._stride
+        seq_starts = batch.starts[first::self._stride, 1]
+        qual_starts = batch.starts[first::self._stride, 3]
+        lengths = batch.ends[first::self._stride, 1] - seq_starts
+
+        if len(lengths) == 0:
+            return
+
+        self.num_reads_profiled += len(lengths)
+        self._add_lengths(lengths)
+
+        profile_length = min(int(lengths.max()), MAX_PROFILE_LENGTH)
+        positions = np.arange(profile_length)
+        self._grow(profile_length)
+
+        # Reads of equal length (the common case) are profiled as reads x positions matrices
+        if lengths.min() >= profile_length:
+            seq = batch.buf[seq_starts[:, None] + positions[None, :]]
+            qual = batch.buf[qual_starts[:, None] + positions[None, :]]
+
+            base_counts = np.stack([np.count_nonzero(seq == ord(base), axis=0) for base in BASES[:-1]], axis=1)
+
+            self._position_counts[:profile_length] += len(lengths)
+            self._quality_sums[:profile_length] += qual.sum(axis=0, dtype=np.int64) - QUALITY_OFFSET * len(lengths)
+            self._q30_bases += int(np.count_nonzero(qual >= QUALITY_OFFSET + Q30))
+            self._base_counts[:profile_length, :-1] += base_counts
+            self._base_counts[:profile_length, -1] += len(lengths) - base_counts.sum(axis=1)
+            return
+
+        # Reads of different length are masked by their length
+        mask = positions[None, :] < lengths[:, None]
+        position_index = np.broadcast_to(positions, mask.shape)[mask]
+        seq = batch.buf[(seq_starts[:, None] + positions[None, :])[mask]]
+        qual = batch.buf[(qual_starts[:, None] + positions[None, :])[mask]].astype(np.int64) - QUALITY_OFFSET
+
+        self._position_counts[:profile_length] += np.bincount(position_index, minlength=profile_length)
+        self._quality_sums[:profile_length] += np.bincount(position_index, weights=qual, minlength=profile_length).astype(np.int64)
+        self._q30_bases += int(np.count_nonzero(qual >= Q30))
+
+        base_index = position_index * len(BASES) + BASE_CODES[seq]
+        self._base_counts[:profile_length] += np.bincount(base_index, minlength=profile_length * len(BASES)).reshape(-1, len(BASES))
+
+    def finish(self) -> FastqQcProfile:
+        num_bases = int(self._position_counts.sum())
+        position_counts = np.maximum(self._position_counts, 1)
+        base_fractions = self._base_counts / position_counts[:, None]
+
+        return FastqQcProfile(
+            name=self.name,
+            mode=self.mode,
+            sample_rate=self.sample_rate,
+            num_reads=self.num_reads,
+            num_reads_profiled=self.num_reads_profiled,
+            length_histogram={int(length): int(count) for length, count in enumerate(self._length_counts) if count},
+            mean_quality=np.round(self._quality_sums / position_counts, 2).tolist(),
+            q30_fraction=round(self._q30_bases / max(num_bases, 1), 4),
+            base_composition={base: np.round(base_fractions[:, i], 4).tolist() for i, base in enumerate(BASES)},
+            n_rate=round(int(self._base_counts[:, BASES.index('N')].sum()) / max(num_bases, 1), 6)
+        )
+
+    def _add_lengths(self, lengths: np.ndarray):
+        counts = np.bincount(lengths)
+
+        if len(counts) > len(self._length_counts):
+            self._length_counts = np.pad(self._length_counts, (0, len(counts) - len(self._length_counts)))
+
+        self._length_counts[:len(counts)] += counts
+
+    def _grow(self, length: int):
+        missing = length - len(self._position_counts)
+
+        if missing > 0:
+            self._position_counts = np.pad(self._position_counts, (0, missing))
+            self._quality_sums = np.pad(self._quality_sums, (0, missing))
+            self._base_counts = np.pad(self._base_counts, ((0, missing), (0, 0)))
@@ -0,0 +1,317 @@
+# case-scrnaseq/fastq-registration/gzindex.py
+
+"""
+Module for random access to registered fastq.gz files.
+
+Registered fastq files are multi-member gzip files: BGZF blocks for
+uncompressed input, the original gzip members (e.g. the blocks written by
+bcl-convert and bcl2fastq, merged lanes) for compressed input. Decompression
+can start at every member without preceding data, member starts are the seek
+points of the index. Seek points inside a deflate stream as in zlib's zran
+would need the 32 KB window and inflatePrime(), which Python's zlib does not
+provide, a single-member file has a single seek point.
+
+The index is built during registration from the same pass which validates
+the file. Seek points are at least spacing uncompressed bytes apart and hold
+the offset and index of the first fastq record at or after the point, i.e.
+a file can be split into chunks of whole records without parsing. The index
+is stored as a small binary sidecar next to the fastq file.
+"""
+
+import struct
+import zlib
+from collections import deque
+from typing import Any, Callable
+
+import boto3
+import numpy as np
+
+import fastqcheck
+import tarstream
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+INDEX_SUFFIX = '.gzidx'
+
+# Magic, number of points, number of records, uncompressed size, compressed size
+INDEX_MAGIC = b'FQGZI1'
+INDEX_HEADER = struct.Struct('<6s4Q')
+
+# Minimum distance of seek points in uncompressed bytes
+DEFAULT_SPACING = 4 * 1024 * 1024
+
+# Record offsets are kept for points reported after their records were validated, e.g. of BGZF blocks compressed in the background
+MAX_POINT_LAG = 256 * 1024 * 1024
+
+# Columns of the seek point array
+COMPRESSED_OFFSET, UNCOMPRESSED_OFFSET, RECORD_OFFSET, RECORD_INDEX = range(4)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# METHODS
+
+class GzipStreamDecompressor:
+    """Incremental decompressor for single and multi-member gzip streams.
+
+    Args:
+        member_fn: Called with the compressed and uncompressed offset of each member start.
+    """
+
+    def __init__(self, member_fn: Callable[[int, int], Any] | None = None):
+        self.member_fn = member_fn
+        self.num_members = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self._member_started = False
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        offset = self.bytes_in
+        self.bytes_in += len(data)
+
+        while data:
+            if not self._member_started and self.member_fn is not None:
+                self.member_fn(offset, self.bytes_out)
+
+            out.append(self._decompressor.decompress(data))
+            self.bytes_out += len(out[-1])
+            self._member_started = True
+
+            if not self._decompressor.eof:
+                break
+
+            # Next gzip member, trailing zero padding is ignored
+            offset += len(data) - len(self._decompressor.unused_data)
+            data = self._decompressor.unused_data
+            self.num_members += 1
+            self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            self._member_started = False
+
+            if not data.strip(b'\x00'):
+                break
+
+        return b''.join(out)
+
+    def finish(self):
+        if self._member_started and not self._decompressor.eof:
+            raise ValueError('Truncated gzip stream')
+
+
+class GzipIndex:
+    """Seek points of a multi-member gzip file.
+
+    Attributes:
+        points: uint64 array of shape (n, 4) with compressed offset, uncompressed offset,
+            offset and index of the first record at or after the point.
+        num_records: Number of fastq records of the file.
+        uncompressed_size: Uncompressed size of the file.
+        compressed_size: Size of the gzip file.
+    """
+
+    def __init__(self, points: np.ndarray, num_records: int, uncompressed_size: int, compressed_size: int):
+        self.points = points
+        self.num_records = num_records
+        self.uncompressed_size = uncompressed_size
+        self.compressed_size = compressed_size
+
+    def __len__(self):
+        return len(self.points)
+
+    def to_bytes(self) -> bytes:
+        header = INDEX_HEADER.pack(INDEX_MAGIC, len(self.points), self.num_records, self.uncompressed_size, self.compressed_size)
+
+        return header + self.points.astype('<u8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'GzipIndex':
+        magic, num_points, num_records, uncompressed_size, compressed_size = INDEX_HEADER.unpack_from(data)
+        assert magic == INDEX_MAGIC, 'Not a fastq gzip index'
+
+        points = np.frombuffer(data, dtype='<u8', count=num_points * 4, offset=INDEX_HEADER.size).reshape(-1, 4)
+
+        return cls(points.astype(np.uint64), num_records, uncompressed_size, compressed_size)
+
+    def split(self, num_chunks: int) -> list[tuple[int, int | None]]:
+        """Split the file into at most num_chunks chunks of whole records.
+
+        Returns (start point, end point) tuples, the end point is None for the last chunk.
+        """
+
+        num_chunks = max(1, min(num_chunks, len(self.points)))
+        starts = sorted(set(np.linspace(0, len(self.points), num_chunks, endpoint=False).astype(int).tolist()))
+
+        return list(zip(starts, starts[1:] + [None]))
+
+
+class GzipIndexBuilder:
+    """Collect seek points while a gzip file is written and validated.
+
+    Member starts are passed to add_point(), record batches of the fastq
+    validator to update(). Points are resolved to the first record at or after
+    the point, in any order of the two calls.
+
+    Args:
+        spacing: Minimum distance of seek points in uncompressed bytes.
+    """
+
+    def __init__(self, spacing: int = DEFAULT_SPACING):
+        self.spacing = spacing
+        self._points = []
+        self._pending = deque()
+        self._batches = deque() # Record start offsets and index of the first record
+        self._batch_offset = 0
+        self._last_offset = -1
+
+    def add_point(self, compressed_offset: int, uncompressed_offset: int):
+        # Later points and their records are never before this offset
+        self._last_offset = uncompressed_offset
+
+        if self._pending or self._points:
+            last = self._pending[-1] if self._pending else self._points[-1]
+
+            if uncompressed_offset - last[UNCOMPRESSED_OFFSET] < self.spacing:
+                self._prune(uncompressed_offset)
+                return
+
+        self._pending.append((compressed_offset, uncompressed_offset))
+        self._resolve()
+
+    def update(self, batch: fastqcheck.RecordBatch):
+        self._batches.append((self._batch_offset + batch.starts[:, 0], batch.first_record))
+        self._batch_offset += len(batch.buf)
+        self._resolve()
+        self._prune(self._batch_offset - MAX_POINT_LAG)
+
+    def finish(self, num_records: int, uncompressed_size: int, compressed_size: int) -> GzipIndex:
+        """Return the index, points after the last record are dropped."""
+
+        points = np.array(self._points, dtype=np.uint64).reshape(-1, 4)
+
+        return GzipIndex(points, num_records, uncompressed_size, compressed_size)
+
+    def _resolve(self):
+        while self._pending:
+            compressed_offset, uncompressed_offset = self._pending[0]
+
+            for record_offsets, first_record in self._batches:
+                if record_offsets[-1] >= uncompressed_offset:
+                    i = int(np.searchsorted(record_offsets, uncompressed_offset))
+                    self._points.append((compressed_offset, uncompressed_offset, int(record_offsets[i]), first_record + i))
+                    break
+            else:
+                return
+
+            self._pending.popleft()
+
+        self._prune(self._last_offset)
+
+    def _prune(self, offset: int):
+        # Batches which end before the offset cannot resolve later points, pending points may need any batch
+        while not self._pending and self._batches and self._batches[0][0][-1] < offset:
+            self._batches.popleft()
+
+
+def get_index_key(s3_key: str) -> str:
+    return s3_key + INDEX_SUFFIX
+
+
+def upload_index(s3_client, s3_bucket: str, s3_key: str, index: GzipIndex) -> str:
+    """Upload the index of a gzip file next to the file. Returns the index key."""
+
+    index_key = get_index_key(s3_key)
+    s3_client.put_object(Bucket=s3_bucket, Key=index_key, Body=index.to_bytes())
+
+    return index_key
+
+
+def load_index(s3_bucket: str, s3_key: str, s3_client=None) -> GzipIndex:
+    """Load the index of a gzip file in S3."""
+
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+
+    res = s3_client.get_object(Bucket=s3_bucket, Key=get_index_key(s3_key))
+
+    return GzipIndex.from_bytes(res['Body'].read())
+
+
+class IndexedGzipReader:
+    """Read the fastq records of an indexed gzip file from any seek point.
+
+    The file is either a local file or an S3 object, compressed data is read
+    with parallel ranged requests from the seek point onwards.
+
+    Args:
+        index: Index of the file.
+        local_path: Path of a local file.
+        s3_bucket: Bucket of an S3 object.
+        s3_key: Key of an S3 object.
+    """
+
+    def __init__(self, index: GzipIndex, local_path: str | None = None, s3_bucket: str | None = None, s3_key: str | None = None,
+                 part_size: int = 16 * 1024 * 1024, max_workers: int = 4):
+        assert local_path or (s3_bucket and s3_key), 'Local path or S3 bucket and key required'
+
+        self.index = index
+        self.local_path = local_path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+    def iter_chunk(self, start_point: int, end_point: int | None = None):
+        """Yield the uncompressed records from start_point up to the records of end_point (exclusive)."""
+
+        points = self.index.points
+        record_offset = int(points[start_point, RECORD_OFFSET])
+        end_offset = int(points[end_point, RECORD_OFFSET]) if end_point is not None else self.index.uncompressed_size
+
+        # Compressed data up to the first seek point after the last byte of the chunk
+        next_point = int(np.searchsorted(points[:, UNCOMPRESSED_OFFSET], end_offset))
+        compressed_start = int(points[start_point, COMPRESSED_OFFSET])
+        compressed_end = int(points[next_point, COMPRESSED_OFFSET]) if next_point < len(points) else self.index.compressed_size
+
+        decompressor = GzipStreamDecompressor()
+        position = int(points[start_point, UNCOMPRESSED_OFFSET])
+
+        with self._open(compressed_start, compressed_end - compressed_start) as fh:
+            while position < end_offset and (chunk := fh.read(READ_CHUNK_SIZE)):
+                data = decompressor.decompress(chunk)
+                start, end = max(record_offset - position, 0), min(end_offset - position, len(data))
+                position += len(data)
+
+                if start < end:
+                    yield data[start:end]
+
+    def read_chunk(self, start_point: int, end_point: int | None = None) -> bytes:
+        return b''.join(self.iter_chunk(start_point, end_point))
+
+    def head(self, start_point: int, num_records: int) -> bytes:
+        """Return the first num_records records at or after start_point."""
+
+        out = bytearray()
+        num_lines = 4 * num_records
+        line_count = 0
+
+        for data in self.iter_chunk(start_point):
+            out += data
+            line_count += data.count(b'\n')
+
+            if line_count >= num_lines:
+                break
+
+        newlines = np.flatnonzero(np.frombuffer(out, dtype=np.uint8) == fastqcheck.NEWLINE)
+        end = newlines[min(num_lines, len(newlines)) - 1] + 1 if num_lines and len(newlines) else 0
+
+        return bytes(out[:end])
+
+    def _open(self, offset: int, size: int):
+        if self.local_path:
+            fh = open(self.local_path, 'rb')
+            fh.seek(offset)
+            return fh
+
+        return tarstream.S3RangeReader(self.s3_bucket, self.s3_key, offset, size, self.part_size, self.max_workers)
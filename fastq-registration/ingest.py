@@ -0,0 +1,174 @@
+# case-scrnaseq/fastq-registration/ingest.py
+
+"""
+Client CLI for the direct ingestion of local fastq files.
+
+Local fastq files are registered without the tar round-trip. Files are paired
+with the read suffixes, extensions and lanes of the registration, validated,
+hashed and profiled in the same single pass as in the registration and
+uploaded straight to their output keys with parallel multipart uploads. The
+fastq datasets are registered in the backend by the CLI.
+
+The CLI reads the FASTQ_REGISTRATION_* environment of the registration (.env
+file) and needs AWS credentials with write access to the output bucket. A
+local S3 stand-in (e.g. moto or MinIO) is used with --s3-endpoint-url.
+
+The files of an ingest are listed in an ingest key below the output prefix.
+The ingest key is the source key of the registered datasets and the
+registration manifest is stored next to it, a rerun with the same name and
+unchanged files resumes an interrupted ingest.
+
+Usage:
+    python ingest.py --input-dir /data/run_42 --name run_42
+"""
+
+import argparse
+import datetime
+import json
+import os
+import re
+
+import boto3
+
+from zihelper import aws
+from zihelper import exceptions as ziexceptions
+
+import main
+import manifest
+import fastqqc
+import pipeline
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+INGEST_PREFIX = 'ingest'
+
+# PARSER
+
+parser = argparse.ArgumentParser(description='Validate, upload and register local fastq files')
+parser.add_argument(
+    "--input-dir",
+    dest='input_dir',
+    required=True,
+    type=str,
+    help="Local directory with fastq files, subdirectories are included"
+)
+
+parser.add_argument(
+    "--name",
+    dest='name',
+    default=None,
+    type=str,
+    help="Name of the ingest, default is the name of the input directory"
+)
+
+parser.add_argument(
+    "--s3-endpoint-url",
+    dest='s3_endpoint_url',
+    default=None,
+    type=str,
+    help="Endpoint of a local S3 stand-in, e.g. http://localhost:5000"
+)
+
+parser.add_argument(
+    "--dry-run",
+    dest='dry_run',
+    action='store_true',
+    help="Pair the fastq files and print the samples without upload"
+)
+
+# METHODS
+
+def list_fastq_sources(input_dir: str) -> list[pipeline.FastqSource]:
+    """Return the files of the input directory as local fastq sources, named by their relative path."""
+
+    sources = []
+
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+
+        for f in sorted(files):
+            local_path = os.path.join(root, f)
+            sources.append(main.get_fastq_source(os.path.relpath(local_path, input_dir), local_path=local_path,
+                                                 size=os.path.getsize(local_path)))
+
+    return sources
+
+def get_ingest_key(name: str) -> str:
+    return f'{main.OUTPUT_BUCKET_PREFIX}/{INGEST_PREFIX}/{name}.json'
+
+def put_ingest_listing(s3_client, name: str, input_dir: str, complete_samples: dict) -> str:
+    """Upload the listing of the ingested files. Returns the ingest key.
+
+    The listing only changes with the files, its ETag identifies the ingest in the manifest.
+    """
+
+    listing = {
+        'name': name,
+        'input_dir': os.path.abspath(input_dir),
+        'samples': {
+            sample: {read: [{'name': source.name, 'size': source.size, 'mtime': int(os.path.getmtime(source.local_path))}
+                            for source in sources] for read, sources in read_sources.items()}
+            for sample, read_sources in complete_samples.items()
+        }
+    }
+
+    ingest_key = get_ingest_key(name)
+
+    print(f'Upload ingest listing to {ingest_key}')
+    s3_client.put_object(Bucket=main.OUTPUT_BUCKET, Key=ingest_key, Body=json.dumps(listing, sort_keys=True).encode(),
+                         ContentType='application/json')
+
+    return ingest_key
+
+# MAIN
+
+def ingest(input_dir: str, name: str | None = None, dry_run: bool = False):
+
+    if not os.path.isdir(input_dir):
+        raise ziexceptions.ZiHelperError(f'Input directory {input_dir} does not exist. Exit.')
+
+    name = name or os.path.basename(os.path.abspath(input_dir))
+    assert re.fullmatch(r'[\w.-]+', name), f'Invalid ingest name {name}, use letters, digits, _, . and -. Exit.'
+    assert main.QC_MODE in fastqqc.QC_MODES, f'Invalid QC mode {main.QC_MODE}. Exit.'
+
+    # Files are paired before anything is uploaded
+    complete_samples = main.get_complete_samples(list_fastq_sources(input_dir), input_dir)
+
+    for sample, read_sources in complete_samples.items():
+        print(f"{sample}: " + ', '.join(f"{read} {' + '.join(source.name for source in sources)}" for read, sources in read_sources.items()))
+
+    if dry_run:
+        return
+
+    aws_s3 = aws.AwsS3()
+
+    # Check if output bucket exists
+    aws_s3.check_bucket_exists(main.OUTPUT_BUCKET)
+
+    login = main.get_backend_login()
+
+    if main.BARCODE_WHITELIST_S3_BUCKET:
+        main.download_barcode_whitelists(aws_s3)
+
+    s3_client = boto3.client('s3')
+    ingest_key = put_ingest_listing(s3_client, name, input_dir, complete_samples)
+
+    # Progress is recorded in a manifest next to the ingest listing
+    manifest_store = manifest.ManifestStore(s3_client, main.OUTPUT_BUCKET, ingest_key,
+                                            datetime.datetime.now().strftime("%Y%m%d"), main.RESUME)
+
+    main.register_samples(login, manifest_store, ingest_key, main.OUTPUT_BUCKET, complete_samples)
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+
+    # Clients of the worker processes pick up the endpoint from the environment
+    if args.s3_endpoint_url:
+        os.environ['AWS_ENDPOINT_URL_S3'] = args.s3_endpoint_url
+
+    ingest(args.input_dir, args.name, args.dry_run)
+
+    print('fastq ingest completed. Exit.')
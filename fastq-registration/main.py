@@ -1,30 +1,40 @@
 # case-scrnaseq/fastq-registration/main.py
 
 import argparse
-import tempfile
 import os
 from collections import defaultdict
-import gzip
 import datetime
-import glob
+import functools
+import json
+import re
+import multiprocessing
+import tempfile
 
+import boto3
 from pydantic import BaseModel
 import requests
 from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
-from Bio import SeqIO
 
 from zihelper import aws
 from zihelper import utils
 from zihelper import exceptions as ziexceptions
 
+import tarstream
+import registration
+import pipeline
+import multipart
+import fastqqc
+import pairsync
+import manifest
+import barcodes
+
 __author__ = "Jonathan Alles"
 __email__ = "Jonathan.Alles@gmx.de"
 __copyright__ = "Copyright 2024"
 
 load_dotenv()
 
-MAX_INPUT_GB = int(utils.load_check_env_var('FASTQ_REGISTRATION_MAX_INPUT_GB'))
 VALID_FASTQ_EXTENSIONS = utils.load_check_env_var('FASTQ_REGISTRATION_VALID_FASTQ_EXTENSIONS').split(',')
 VALID_READ1_SUFFIX = utils.load_check_env_var('FASTQ_REGISTRATION_VALID_READ1_SUFFIX').split(',')
 VALID_READ2_SUFFIX = utils.load_check_env_var('FASTQ_REGISTRATION_VALID_READ2_SUFFIX').split(',')
@@ -38,6 +48,33 @@ SERVICE_USER_PWD=utils.load_check_env_var('FASTQ_REGISTRATION_SERVICE_USER_PWD')
 
 BACKEND_URL = utils.load_check_env_var('FASTQ_REGISTRATION_BACKEND_URL').rstrip('/') # Remove trailing slash for format list URL
 
+# Optional tuning: 'index' fetches fastq members with ranged requests, 'stream' reads the whole tar sequentially
+INGEST_MODE = os.getenv('FASTQ_REGISTRATION_INGEST_MODE', 'index')
+DOWNLOAD_WORKERS = int(os.getenv('FASTQ_REGISTRATION_DOWNLOAD_WORKERS', 4))
+DOWNLOAD_PART_SIZE_MB = int(os.getenv('FASTQ_REGISTRATION_DOWNLOAD_PART_SIZE_MB', 16))
+UPLOAD_WORKERS = int(os.getenv('FASTQ_REGISTRATION_UPLOAD_WORKERS', 4))
+UPLOAD_PART_SIZE_MB = int(os.getenv('FASTQ_REGISTRATION_UPLOAD_PART_SIZE_MB', 64))
+UPLOAD_MIN_WORKERS = int(os.getenv('FASTQ_REGISTRATION_UPLOAD_MIN_WORKERS', 2)) # Concurrency is tuned from min to max workers
+UPLOAD_MAX_BUFFER_MB = int(os.getenv('FASTQ_REGISTRATION_UPLOAD_MAX_BUFFER_MB', 384)) # Memory ceiling per file
+NUM_WORKERS = int(os.getenv('FASTQ_REGISTRATION_NUM_WORKERS', os.cpu_count()))
+GZIP_THREADS = int(os.getenv('FASTQ_REGISTRATION_GZIP_THREADS', 2))
+# Optional QC profile: 'sample' profiles a fraction of reads, 'full' all reads, 'off' disables the profile
+QC_MODE = os.getenv('FASTQ_REGISTRATION_QC_MODE', 'sample')
+QC_SAMPLE_RATE = float(os.getenv('FASTQ_REGISTRATION_QC_SAMPLE_RATE', 0.05))
+# Optional: merge the lanes (_L001, _L002, ...) of a sample into one read1 and one read2 file
+MERGE_LANES = os.getenv('FASTQ_REGISTRATION_MERGE_LANES', 'true').lower() == 'true'
+# Optional: skip samples whose fastq content is already registered
+DEDUPLICATE = os.getenv('FASTQ_REGISTRATION_DEDUPLICATE', 'true').lower() == 'true'
+# Optional: minimum distance of gzip index seek points, 0 disables the index
+GZIP_INDEX_SPACING_MB = int(os.getenv('FASTQ_REGISTRATION_GZIP_INDEX_SPACING_MB', 4))
+# Optional: read1 barcode prescan with whitelist indices (.npy) from S3, disabled if no bucket is set
+BARCODE_WHITELIST_S3_BUCKET = os.getenv('FASTQ_REGISTRATION_BARCODE_WHITELIST_S3_BUCKET', '')
+BARCODE_WHITELIST_S3_KEY = os.getenv('FASTQ_REGISTRATION_BARCODE_WHITELIST_S3_KEY', 'barcode_whitelists')
+BARCODE_SAMPLE_RATE = float(os.getenv('FASTQ_REGISTRATION_BARCODE_SAMPLE_RATE', 0.01))
+BARCODE_WHITELIST_DIR = os.path.join(tempfile.gettempdir(), 'barcode_whitelists')
+# Optional: resume from the registration manifest of a previous run of the same tar
+RESUME = os.getenv('FASTQ_REGISTRATION_RESUME', 'true').lower() == 'true'
+
 # PARSER
 
 parser = argparse.ArgumentParser()
@@ -46,7 +83,7 @@ parser.add_argument(
     dest='s3_input_tar_key',
     required=True,
     type=str,
-    help="Input tar filename"
+    help="Input tar filename (.tar, .tar.gz, .tgz, .tar.zst)"
 )
 
 parser.add_argument(
@@ -66,30 +103,611 @@ class FastqDatasets(BaseModel):
     s3_source_bucket : str
     s3_read1_fastq_key : str
     s3_read2_fastq_key : str
+    s3_qc_profile_key : str | None = None
+    read1_sha256 : str | None = None
+    read2_sha256 : str | None = None
+    chemistry : str | None = None
+    valid_barcode_fraction : float | None = None
 
 # METHODS
 
-def is_fastq(fh):
-    fastq = SeqIO.parse(fh, "fastq")
+def get_read_endings():
+    """Prepare combinations for fastq endings of read1 and read2 files."""
     
-    try : return any(fastq)
+    read1_endings = [f'_{suf1}.{suf2}' for suf1 in VALID_READ1_SUFFIX for suf2 in VALID_FASTQ_EXTENSIONS]
+    read2_endings = [f'_{suf1}.{suf2}' for suf1 in VALID_READ2_SUFFIX for suf2 in VALID_FASTQ_EXTENSIONS]
     
-    except Exception as e:
-        return False
+    return read1_endings, read2_endings
 
-# MAIN
+def assign_sample_read(f: str, read1_endings: list, read2_endings: list):
+    """Return (sample, read) for a fastq filename or None if the file cannot be assigned."""
+    
+    # Check for file which is matching substring and read
+    # Loop over read1 endings, if loop ends, check read2 endings
+    for read1_end in read1_endings:
+        if f.endswith(read1_end):
+            return os.path.basename(f).replace(read1_end, ''), 'R1'
+    
+    for read2_end in read2_endings:
+        if f.endswith(read2_end):
+            return os.path.basename(f).replace(read2_end, ''), 'R2'
+    
+    return None
 
-def main(s3_input_tar_key: str, s3_bucket: str):
+def get_dataset_name(sample: str) -> str:
+    uuid_short = utils.generate_short_uuid()
+    return f'fq_{sample}_{uuid_short}'
+
+def get_output_key(date: str, dataset_name: str, read: str) -> str:
+    return f'{OUTPUT_BUCKET_PREFIX}/{date}/{dataset_name}_S1_{read}_001.fastq.gz'
+
+def check_fastq_member(f: str, size: int, read1_endings: list, read2_endings: list):
+    """Check name and size of a fastq file from the input tar.
     
-    aws_s3 = aws.AwsS3()
-    init_wd = os.getcwd()
+    Returns (sample, read) or None if the file is skipped.
+    """
     
-    # Prepare combinations for fastq endings
-    read1_endings = [f'_{suf1}.{suf2}' for suf1 in VALID_READ1_SUFFIX for suf2 in VALID_FASTQ_EXTENSIONS]
-    read2_endings = [f'_{suf1}.{suf2}' for suf1 in VALID_READ2_SUFFIX for suf2 in VALID_FASTQ_EXTENSIONS]
+    # Prefilter fastq files from tar members
+    if not f.endswith(tuple(VALID_FASTQ_EXTENSIONS)):
+        return None
     
-    # Check if output bucket exists
-    aws_s3.check_bucket_exists(OUTPUT_BUCKET)
+    sample_read = assign_sample_read(f, read1_endings, read2_endings)
+    
+    if sample_read is None:
+        print(f"WARNING {f} cannot be assigned to read1 or read2. Skip.")
+        return None
+    
+    # Check if the fastq file has minimum size of 1 MB
+    if size < 1024:
+        print(f"WARNING {f} is smaller than 1MB. Skip.")
+        return None
+    
+    return sample_read
+
+def split_lane(sample: str) -> tuple:
+    """Split the lane from an Illumina sample prefix, e.g. Sample_S1_L001 -> (Sample_S1, 1).
+    
+    The lane is None if the prefix has no lane or lanes are not merged.
+    """
+    
+    match = re.fullmatch(r'(.+)_L(\d{3})', sample)
+    
+    if not MERGE_LANES or match is None:
+        return sample, None
+    
+    return match.group(1), int(match.group(2))
+
+def get_paired_lanes(sample: str, read_dict: dict) -> list:
+    """Return the sorted lanes of a sample with read1 and read2, lanes without mate are skipped."""
+    
+    if 'R1' not in read_dict:
+        print(f"WARNING {sample} does not have read1. Skip.")
+        return []
+    if 'R2' not in read_dict:
+        print(f"WARNING {sample} does not have read2. Skip.")
+        return []
+    
+    for read, mate in (('R1', 'R2'), ('R2', 'R1')):
+        for lane in read_dict[read].keys() - read_dict[mate].keys():
+            print(f"WARNING Lane {lane} of {sample} does not have a {mate} file. Skip.")
+    
+    return sorted(read_dict['R1'].keys() & read_dict['R2'].keys(), key=lambda lane: lane or 0)
+
+def get_lane_order_error(sample: str, read: str, lane: int | None, read_dict: dict) -> str | None:
+    """Check the next lane of a streamed read against the lanes fed before, in feed order by read.
+    
+    Lanes are appended to the merged output as they are read from the tar stream. Both reads
+    must be fed the same lanes in ascending lane order, otherwise the records of read1 and
+    read2 are not in the same order. Returns an error message or None.
+    """
+    
+    fed_lanes = list(read_dict[read])
+    mate_lanes = list(read_dict['R2' if read == 'R1' else 'R1'])
+    
+    if fed_lanes and (lane or 0) <= (fed_lanes[-1] or 0):
+        return f"Lane {lane} of {sample} {read} follows lane {fed_lanes[-1]} in the tar stream, lanes are not in lane order"
+    
+    if len(mate_lanes) > len(fed_lanes) and mate_lanes[len(fed_lanes)] != lane:
+        return f"Lane {lane} of {sample} {read} is merged in place of lane {mate_lanes[len(fed_lanes)]} of the mate, " \
+               f"read1 and read2 lanes are not in the same lane order"
+    
+    return None
+
+def get_fastq_source(f: str, **location) -> pipeline.FastqSource:
+    return pipeline.FastqSource(name = f, gzipped = f.endswith('.gz'), **location)
+
+def get_fastq_job(name: str, output_key: str, sources: list, **kwargs) -> pipeline.FastqJob:
+    
+    return pipeline.FastqJob(
+        name = name,
+        output_bucket = OUTPUT_BUCKET,
+        output_key = output_key,
+        sources = sources,
+        gzip_threads = GZIP_THREADS,
+        download_part_size = DOWNLOAD_PART_SIZE_MB * 1024 * 1024,
+        download_workers = DOWNLOAD_WORKERS,
+        upload_part_size = UPLOAD_PART_SIZE_MB * 1024 * 1024,
+        upload_workers = UPLOAD_WORKERS,
+        upload_min_workers = UPLOAD_MIN_WORKERS,
+        upload_max_buffer = UPLOAD_MAX_BUFFER_MB * 1024 * 1024,
+        qc_mode = QC_MODE,
+        qc_sample_rate = QC_SAMPLE_RATE,
+        index_spacing = GZIP_INDEX_SPACING_MB * 1024 * 1024,
+        barcode_whitelist_dir = BARCODE_WHITELIST_DIR if BARCODE_WHITELIST_S3_BUCKET else None,
+        barcode_sample_rate = BARCODE_SAMPLE_RATE,
+        **kwargs
+    )
+
+def upload_qc_profile(s3_client, dataset_name: str, job_results: dict) -> str | None:
+    """Upload the QC profiles of read1 and read2 next to the fastq files. Returns the key."""
+    
+    if any(job_result.qc_profile is None for job_result in job_results.values()):
+        return None
+    
+    qc_profile = {
+        'name': dataset_name,
+        'R1': job_results['R1'].qc_profile.model_dump(),
+        'R2': job_results['R2'].qc_profile.model_dump()
+    }
+    
+    qc_profile_key = f"{os.path.dirname(job_results['R1'].s3_key)}/{dataset_name}_qc.json"
+    
+    print(f'Upload QC profile to {qc_profile_key}')
+    s3_client.put_object(Bucket=OUTPUT_BUCKET, Key=qc_profile_key, Body=json.dumps(qc_profile).encode(),
+                         ContentType='application/json')
+    
+    return qc_profile_key
+
+def get_fastq_datasets_by_sha256(login: HTTPBasicAuth, job_results: dict) -> list:
+    """Return the registered fastq datasets with identical read1 and read2 content."""
+    
+    params = {'read1_sha256': job_results['R1'].content_sha256, 'read2_sha256': job_results['R2'].content_sha256}
+    res = requests.get(f'{BACKEND_URL}/get_by_sha256', params=params, auth=login)
+    assert res.status_code == 200, f'Failed to look up fastq datasets by content digest with status code {res.status_code}. Exit.'
+    
+    return res.json()
+
+def get_duplicate_fastq_dataset(login: HTTPBasicAuth, job_results: dict) -> dict | None:
+    """Return the registered fastq dataset with identical read1 and read2 content or None."""
+    
+    duplicates = get_fastq_datasets_by_sha256(login, job_results)
+    
+    return duplicates[0] if duplicates else None
+
+def post_fastq_dataset(login: HTTPBasicAuth, fastq_dataset: FastqDatasets):
+    
+    print('POST dataset json.')
+    res = requests.post(BACKEND_URL + '/', auth=login, data=fastq_dataset.model_dump())
+    assert res.status_code == 201, f'POST request failed with status code {res.status_code}. Exit.'
+
+def abort_uploads(s3_client, job_results: dict):
+    
+    for job_result in job_results.values():
+        try:
+            multipart.abort_multipart_upload(s3_client, job_result.s3_bucket, job_result.s3_key, job_result.upload_id)
+        except s3_client.exceptions.NoSuchUpload:
+            print(f'WARNING Upload of {job_result.s3_key} is no longer pending.')
+        
+        if job_result.s3_index_key:
+            s3_client.delete_object(Bucket=job_result.s3_bucket, Key=job_result.s3_index_key)
+
+def discard_sample(s3_client, manifest_store: manifest.ManifestStore, sample: str, job_results: dict, error: str | None = None):
+    """Abort the pending uploads of a sample, including uploads recorded by a previous run, and mark it as failed."""
+    
+    abort_uploads(s3_client, manifest_store.get(sample).job_results | job_results)
+    manifest_store.update(sample, state='failed', job_results={}, error=error)
+
+def resume_sample(s3_client, manifest_store: manifest.ManifestStore, sample: str, keep_results: bool = True) -> dict:
+    """Prepare a sample of a resumed registration. Returns the recorded job results which are reused.
+    
+    Recorded reads of a pending sample are reused if their uploads are still pending,
+    other uploads of the sample's output keys were left behind by the crashed run and
+    are aborted.
+    """
+    
+    checkpoint = manifest_store.get(sample)
+    
+    if checkpoint.state not in ('pending', 'failed'):
+        return checkpoint.job_results
+    
+    job_results = {read: job_result for read, job_result in checkpoint.job_results.items() if keep_results and
+                   multipart.multipart_upload_exists(s3_client, job_result.s3_bucket, job_result.s3_key, job_result.upload_id)}
+    
+    for read in ('R1', 'R2'):
+        output_key = get_output_key(manifest_store.date, checkpoint.dataset_name, read)
+        num_aborted = multipart.abort_stale_multipart_uploads(s3_client, OUTPUT_BUCKET, output_key,
+                                                              tuple(job_result.upload_id for job_result in job_results.values()))
+        if num_aborted:
+            print(f'Aborted {num_aborted} stale uploads of {output_key}')
+    
+    if job_results:
+        print(f"Resume {sample}, reuse pending uploads of {', '.join(job_results)}")
+    
+    manifest_store.update(sample, state='pending', job_results=job_results, error=None)
+    
+    return job_results
+
+def complete_upload(s3_client, job_result: pipeline.FastqPipelineResult):
+    """Complete a pending upload, an upload which was completed before a crash is accepted if the object exists."""
+    
+    print(f"Complete upload of {', '.join(job_result.sources)} to {job_result.s3_key}")
+    
+    try:
+        multipart.complete_multipart_upload(s3_client, job_result.s3_bucket, job_result.s3_key, job_result.upload_id, job_result.parts)
+    
+    except s3_client.exceptions.NoSuchUpload:
+        try:
+            s3_client.head_object(Bucket=job_result.s3_bucket, Key=job_result.s3_key)
+        except s3_client.exceptions.ClientError:
+            raise ziexceptions.ZiHelperError(f'Upload of {job_result.s3_key} is neither pending nor completed. Skip.')
+        
+        print(f'Upload of {job_result.s3_key} was completed before.')
+
+def finalize_sample(s3_client, login: HTTPBasicAuth, manifest_store: manifest.ManifestStore, sample: str,
+                    s3_input_tar_key: str, s3_bucket: str, job_results: dict) -> str:
+    """Complete the pending uploads of a sample and register the fastq dataset.
+    
+    Each completed step is recorded in the manifest, a resumed sample continues
+    from its last recorded step with the recorded job results.
+    """
+    
+    checkpoint = manifest_store.get(sample)
+    dataset_name = checkpoint.dataset_name
+    resumed_state = checkpoint.state
+    job_results = checkpoint.job_results | job_results
+    
+    if checkpoint.state == 'pending':
+        
+        # Paired reads must have the same number of records and read names
+        num_records = {read: job_result.validation.num_records for read, job_result in job_results.items()}
+        
+        if num_records['R1'] != num_records['R2']:
+            error = f"{dataset_name} read1 has {num_records['R1']} records, read2 has {num_records['R2']} records"
+            discard_sample(s3_client, manifest_store, sample, job_results, error)
+            raise ziexceptions.ZiHelperError(f'{error}. Skip.')
+        
+        if job_results['R1'].pair_sync and job_results['R2'].pair_sync:
+            pair_error = pairsync.check_pair_reports(job_results['R1'].pair_sync, job_results['R2'].pair_sync)
+            
+            if pair_error:
+                discard_sample(s3_client, manifest_store, sample, job_results, f'{dataset_name} {pair_error}')
+                raise ziexceptions.ZiHelperError(f'{dataset_name} {pair_error}. Skip.')
+        
+        print(f"{dataset_name} passed validation with {num_records['R1']} read pairs")
+        
+        # Identical fastq files are not stored and processed again, the pending uploads are discarded
+        if DEDUPLICATE:
+            duplicate = get_duplicate_fastq_dataset(login, job_results)
+            
+            if duplicate is not None:
+                print(f"{dataset_name} has the same read1 and read2 content (sha256 {job_results['R1'].content_sha256[:12]}, "
+                      f"{job_results['R2'].content_sha256[:12]}) as registered fastq dataset {duplicate['name']}. Skip upload and registration.")
+                abort_uploads(s3_client, job_results)
+                manifest_store.update(sample, state='duplicate', job_results={}, duplicate_of=duplicate['name'])
+                return duplicate['name']
+        
+        qc_profile_key = upload_qc_profile(s3_client, dataset_name, job_results)
+        
+        # QC profiles are uploaded and not recorded again
+        job_results = {read: job_result.model_copy(update={'qc_profile': None}) for read, job_result in job_results.items()}
+        manifest_store.update(sample, state='validated', job_results=job_results, qc_profile_key=qc_profile_key)
+    
+    if checkpoint.state == 'validated':
+        
+        # read2 triggers rawdata processing and is completed last
+        for read in ('R1', 'R2'):
+            try:
+                complete_upload(s3_client, job_results[read])
+            except ziexceptions.ZiHelperError as e:
+                discard_sample(s3_client, manifest_store, sample, {}, str(e))
+                raise
+        
+        job_results = {read: job_result.model_copy(update={'parts': []}) for read, job_result in job_results.items()}
+        manifest_store.update(sample, state='uploaded', job_results=job_results)
+    
+    barcode_report = job_results['R1'].barcode_report
+    
+    if barcode_report is not None:
+        print(f'{dataset_name} barcode prescan: whitelist {barcode_report.whitelist}, chemistry {barcode_report.chemistry}, '
+              f'{barcode_report.valid_barcode_fraction} valid barcodes in {barcode_report.num_barcodes} sampled reads')
+    
+    fastq_dataset = FastqDatasets(
+        name = dataset_name,
+        s3_bucket = OUTPUT_BUCKET,
+        s3_source_key = s3_input_tar_key,
+        s3_source_bucket = s3_bucket,
+        s3_read1_fastq_key = job_results['R1'].s3_key,
+        s3_read2_fastq_key = job_results['R2'].s3_key,
+        s3_qc_profile_key = checkpoint.qc_profile_key,
+        read1_sha256 = job_results['R1'].content_sha256,
+        read2_sha256 = job_results['R2'].content_sha256,
+        chemistry = barcode_report.chemistry if barcode_report else None,
+        valid_barcode_fraction = barcode_report.valid_barcode_fraction if barcode_report else None
+    )
+    
+    # The POST request may have succeeded before a crash
+    registered = resumed_state == 'uploaded' and \
+        any(dataset['name'] == dataset_name for dataset in get_fastq_datasets_by_sha256(login, job_results))
+    
+    if registered:
+        print(f'{dataset_name} was registered before.')
+    else:
+        post_fastq_dataset(login, fastq_dataset)
+    
+    manifest_store.update(sample, state='posted')
+    
+    return dataset_name
+
+def get_registered_result(manifest_store: manifest.ManifestStore, sample: str) -> registration.UnitResult | None:
+    """Return the result of a sample registered by a previous run or None."""
+    
+    checkpoint = manifest_store.get(sample)
+    
+    if checkpoint is None or checkpoint.state not in manifest.FINAL_STATES:
+        return None
+    
+    dataset_name = checkpoint.duplicate_of or checkpoint.dataset_name
+    print(f'{sample} was registered as {dataset_name} by a previous run. Skip.')
+    
+    return registration.UnitResult(unit=sample, success=True, value=dataset_name)
+
+def get_complete_samples(sources: list, input_name: str) -> dict:
+    """Sort fastq sources by sample, read and lane.
+    
+    Returns the sources of the lanes with read1 and read2 by sample and read.
+    """
+    
+    read1_endings, read2_endings = get_read_endings()
+    sample_read_dict = defaultdict(lambda: defaultdict(dict))
+    
+    for source in sources:
+        sample_read = check_fastq_member(source.name, source.size, read1_endings, read2_endings)
+        
+        if sample_read is None:
+            continue
+        
+        sample, read = sample_read
+        sample, lane = split_lane(sample)
+        
+        if lane in sample_read_dict[sample][read]:
+            print(f"WARNING {source.name} is a duplicate {read} file for sample {sample}. Skip.")
+            continue
+        
+        sample_read_dict[sample][read][lane] = source
+    
+    # Check if the sample has read1 and read2 for its lanes
+    complete_samples = {}
+    
+    for sample, read_dict in sample_read_dict.items():
+        lanes = get_paired_lanes(sample, read_dict)
+        
+        if lanes:
+            complete_samples[sample] = {read: [read_dict[read][lane] for lane in lanes] for read in ('R1', 'R2')}
+    
+    # Reject inputs without pairs before any fastq data is read
+    if not complete_samples:
+        raise ziexceptions.ZiHelperError(f'{input_name} does not contain valid read1/read2 pairs. Exit.')
+    
+    print(f'Found {len(complete_samples)} samples with read1/read2 pairs in {len(sources)} files of {input_name}')
+    
+    return complete_samples
+
+def register_samples(login: HTTPBasicAuth, manifest_store: manifest.ManifestStore, s3_source_key: str, s3_source_bucket: str,
+                     complete_samples: dict):
+    """Register samples whose fastq sources can be read independently, i.e. tar members or local files.
+    
+    Each read is streamed through the registration pipeline in a worker process,
+    lanes of a sample are merged into one read1 and one read2 file. Samples are
+    processed in parallel. Finished reads and steps are recorded in the manifest,
+    a resumed registration only runs the reads and steps which were not finished.
+    """
+    
+    s3_client = boto3.client('s3')
+    
+    registered_results = [result for sample in complete_samples if (result := get_registered_result(manifest_store, sample))]
+    
+    for result in registered_results:
+        del complete_samples[result.unit]
+    
+    # Dataset names are recorded before any upload, a resumed registration reuses them
+    manifest_store.add_samples({sample: get_dataset_name(sample) for sample in complete_samples if manifest_store.get(sample) is None})
+    
+    # Mates run in separate worker processes and exchange read name digests through a shared dict
+    with multiprocessing.get_context('spawn').Manager() as manager:
+        pair_channel = manager.dict()
+        job_fn = functools.partial(pipeline.run_fastq_job, pair_channel=pair_channel)
+        
+        with registration.RegistrationEngine(job_fn, NUM_WORKERS) as engine:
+            
+            for sample, read_sources in complete_samples.items():
+                dataset_name = manifest_store.get(sample).dataset_name
+                job_results = resume_sample(s3_client, manifest_store, sample) if manifest_store.resumed else {}
+                
+                # Reads with a recorded pending upload are not run again
+                jobs = {
+                    read: get_fastq_job(f'{sample} {read}', get_output_key(manifest_store.date, dataset_name, read), sources,
+                                        unit=dataset_name, read=read)
+                    for read, sources in read_sources.items() if read not in job_results
+                }
+                
+                engine.submit(sample, jobs,
+                              functools.partial(finalize_sample, s3_client, login, manifest_store, sample, s3_source_key, s3_source_bucket),
+                              functools.partial(discard_sample, s3_client, manifest_store, sample),
+                              functools.partial(manifest_store.add_job_result, sample))
+            
+            results = engine.results()
+    
+    report_results(registered_results + results)
+
+def register_indexed(login: HTTPBasicAuth, manifest_store: manifest.ManifestStore, s3_input_tar_key: str, s3_bucket: str):
+    """Register fastq files from an uncompressed tar using a ranged-request member index.
+    
+    Only fastq members of complete samples are read, each member is streamed with
+    parallel ranged requests through the registration pipeline.
+    """
+    
+    print(f'Index input tar file {s3_input_tar_key} from bucket {s3_bucket}')
+    
+    members = tarstream.index_s3_tar(s3_bucket, s3_input_tar_key)
+    
+    sources = [get_fastq_source(member.name, s3_bucket=s3_bucket, s3_key=s3_input_tar_key, offset=member.offset, size=member.size)
+               for member in members]
+    
+    register_samples(login, manifest_store, s3_input_tar_key, s3_bucket, get_complete_samples(sources, s3_input_tar_key))
+
+def abort_pipelines(manifest_store: manifest.ManifestStore, sample: str, fastq_pipelines: dict, error: str | None = None):
+    
+    for fastq_pipeline in fastq_pipelines.values():
+        fastq_pipeline.abort()
+    
+    manifest_store.update(sample, state='failed', error=error)
+
+def finish_sample(s3_client, login: HTTPBasicAuth, manifest_store: manifest.ManifestStore, sample: str,
+                  s3_input_tar_key: str, s3_bucket: str, fastq_pipelines: dict) -> str:
+    """Finish the pipelines of both reads of a streamed sample and finalize it."""
+    
+    job_results = {}
+    
+    try:
+        for read, fastq_pipeline in fastq_pipelines.items():
+            job_results[read] = fastq_pipeline.finish()
+    
+    except Exception as e:
+        abort_pipelines(manifest_store, sample, fastq_pipelines, str(e))
+        raise
+    
+    return finalize_sample(s3_client, login, manifest_store, sample, s3_input_tar_key, s3_bucket, job_results)
+
+def register_stream(login: HTTPBasicAuth, manifest_store: manifest.ManifestStore, s3_input_tar_key: str, s3_bucket: str,
+                    compression: str | None = None):
+    """Register fastq files from a tar by streaming the archive member by member.
+    
+    Each member is passed through the registration pipeline of its sample and read
+    while it is read from the tar stream. Lanes are appended to the same pipeline,
+    pipelines are finished once the whole tar is read. Lanes must be stored in
+    lane order in the tar, samples with lanes out of order fail with a lane order
+    error as their lanes cannot be reordered in a stream. gzip and zstd compressed
+    archives are decompressed on the fly. A resumed registration skips the members
+    of samples which were validated by a previous run and restarts other samples.
+    """
+    
+    s3_client = boto3.client('s3')
+    read1_endings, read2_endings = get_read_endings()
+    
+    # Open pipelines and fed lanes by sample
+    sample_pipelines = defaultdict(dict)
+    sample_read_dict = defaultdict(lambda: defaultdict(dict))
+    failed_samples = set()
+    # Samples of a previous run which are not read again
+    registered_results = {}
+    resumed_samples = set()
+    
+    print(f'Stream input tar file {s3_input_tar_key} from bucket {s3_bucket}')
+    
+    # Mates are read one after the other, the second mate is checked against the read name digests of the first
+    pair_channel = {}
+    
+    # The tar stream is closed if the registration stops before the end of the tar
+    with tarstream.PrefetchStream(tarstream.open_s3_stream(s3_bucket, s3_input_tar_key)) as tar_stream, \
+         registration.RegistrationEngine(pipeline.run_fastq_job, NUM_WORKERS) as engine:
+        
+        # fastq files can be in root, level1 or level2 of the tar file, depending on the tar file structure
+        for member, member_fh in tarstream.iter_tar_members(tar_stream, compression):
+            
+            f = member.name
+            sample_read = check_fastq_member(f, member.size, read1_endings, read2_endings)
+            
+            if sample_read is None:
+                continue
+            
+            sample, read = sample_read
+            sample, lane = split_lane(sample)
+            
+            if sample in failed_samples:
+                print(f"WARNING {f} belongs to failed sample {sample}. Skip.")
+                continue
+            
+            if sample in registered_results or sample in resumed_samples:
+                continue
+            
+            if lane in sample_read_dict[sample][read]:
+                print(f"WARNING {f} is a duplicate {read} file for sample {sample}. Skip.")
+                continue
+            
+            # First member of the sample
+            if sample not in sample_pipelines:
+                checkpoint = manifest_store.get(sample)
+                
+                if (result := get_registered_result(manifest_store, sample)) is not None:
+                    registered_results[sample] = result
+                    continue
+                
+                if checkpoint is not None and checkpoint.state in ('validated', 'uploaded'):
+                    print(f'{sample} was validated by a previous run, resume from state {checkpoint.state}.')
+                    resumed_samples.add(sample)
+                    continue
+                
+                # Partial uploads of a previous run cannot be continued from a stream
+                if checkpoint is None:
+                    manifest_store.add_samples({sample: get_dataset_name(sample)})
+                else:
+                    resume_sample(s3_client, manifest_store, sample, keep_results=False)
+            
+            # Merged lanes cannot be reordered in a stream, tar files in lane order are required
+            if (lane_error := get_lane_order_error(sample, read, lane, sample_read_dict[sample])) is not None:
+                print(f'WARNING {lane_error}. Skip.')
+                failed_samples.add(sample)
+                abort_pipelines(manifest_store, sample, sample_pipelines.pop(sample, {}), lane_error)
+                continue
+            
+            dataset_name = manifest_store.get(sample).dataset_name
+            
+            if read not in sample_pipelines[sample]:
+                job = get_fastq_job(f'{sample} {read}', get_output_key(manifest_store.date, dataset_name, read), [],
+                                    unit=dataset_name, read=read)
+                sample_pipelines[sample][read] = pipeline.FastqPipeline(job, s3_client, pair_channel)
+            
+            # The tar stream can only be read sequentially, the pipeline runs in this process
+            result = engine.run_inline(f, sample_pipelines[sample][read].feed, member_fh, get_fastq_source(f))
+            
+            if not result.success:
+                failed_samples.add(sample)
+                abort_pipelines(manifest_store, sample, sample_pipelines.pop(sample), result.error)
+                continue
+            
+            sample_read_dict[sample][read][lane] = f
+        
+        complete_samples = {}
+        
+        # Check if the sample has read1 and read2 for the same lanes
+        for sample, fastq_pipelines in sample_pipelines.items():
+            read_dict = sample_read_dict[sample]
+            lanes = get_paired_lanes(sample, read_dict)
+            
+            if lanes and all(len(read_dict[read]) == len(lanes) for read in read_dict):
+                complete_samples[sample] = fastq_pipelines
+                continue
+            
+            # Lanes are already merged into the pending uploads
+            if lanes:
+                print(f"WARNING {sample} does not have read1 and read2 for all lanes. Skip.")
+            
+            abort_pipelines(manifest_store, sample, fastq_pipelines, 'Incomplete read1/read2 pairs')
+        
+        results = engine.map(
+            lambda sample: finish_sample(s3_client, login, manifest_store, sample, s3_input_tar_key, s3_bucket, complete_samples[sample]),
+            {sample: sample for sample in complete_samples}
+        )
+        
+        results += engine.map(
+            lambda sample: finalize_sample(s3_client, login, manifest_store, sample, s3_input_tar_key, s3_bucket, {}),
+            {sample: sample for sample in resumed_samples}
+        )
+    
+    report_results(list(registered_results.values()) + results)
+
+def get_backend_login() -> HTTPBasicAuth:
+    """Return the login of the backend service user and test the connection to the backend."""
     
     # Check if backend credentials can be defined
     
@@ -110,137 +728,63 @@ def main(s3_input_tar_key: str, s3_bucket: str):
     res = requests.get(BACKEND_URL, auth=login)
     assert res.status_code == 200, f'Backend URL {BACKEND_URL} is not reachable. Exit.'
     
-    # Check if single bucket key exists
-    assert s3_input_tar_key.endswith('.tar'), f'{s3_input_tar_key} is not a .tar file. Exit.'
+    return login
+
+def download_barcode_whitelists(aws_s3: aws.AwsS3):
+    """Download the barcode whitelist indices, they are memory-mapped by the worker processes."""
     
-    if not aws_s3.check_object_key_exists(s3_bucket, s3_input_tar_key):
-        raise ziexceptions.ZiHelperError(f'Key {s3_input_tar_key} does not exist in bucket {s3_bucket}.Exit.')
+    print(f'Download barcode whitelists from S3 bucket {BARCODE_WHITELIST_S3_BUCKET} and key {BARCODE_WHITELIST_S3_KEY}')
+    aws_s3.download_folder_from_bucket(BARCODE_WHITELIST_S3_BUCKET, BARCODE_WHITELIST_S3_KEY, BARCODE_WHITELIST_DIR)
     
-    tar_filesize_mb = aws_s3.get_key_size_mb(s3_bucket, s3_input_tar_key)
+    whitelists = barcodes.load_whitelists(BARCODE_WHITELIST_DIR)
+    assert whitelists, f'No whitelist indices found in {BARCODE_WHITELIST_S3_KEY}. Exit.'
+    print(f"Loaded barcode whitelists {', '.join(whitelists)}")
+
+def report_results(results: list):
     
-    if tar_filesize_mb > (MAX_INPUT_GB * 1024):
-        raise ziexceptions.ZiHelperError(f'{s3_input_tar_key} is larger than {MAX_INPUT_GB}GB. Exit.')
+    failed_units = [result.unit for result in results if not result.success]
     
-    print(f'Download input tar file {s3_input_tar_key} from bucket {s3_bucket}')
+    print(f'Registered {len(results) - len(failed_units)} of {len(results)} samples.')
     
-    # Create a temporary folder
-    temp_dir = tempfile.TemporaryDirectory()
+    if failed_units:
+        print(f"WARNING Registration failed for {', '.join(failed_units)}")
+
+# MAIN
+
+def main(s3_input_tar_key: str, s3_bucket: str):
     
-    # Move to temp dir
-    os.chdir(temp_dir.name)
+    aws_s3 = aws.AwsS3()
     
-    tar_base = os.path.basename(s3_input_tar_key)
-    local_tar_path = os.path.join(temp_dir.name, tar_base)
-        
-    aws_s3.download_key_from_bucket(s3_bucket, s3_input_tar_key, local_tar_path)
+    # Check if output bucket exists
+    aws_s3.check_bucket_exists(OUTPUT_BUCKET)
     
-    # Untar the tar file
-    print(f'Untar {local_tar_path}')
+    login = get_backend_login()
     
-    # CONTINUE HERE: Files are in tar dir and need to be extracted
-    utils.untar_file(local_tar_path)
-    untar_base = local_tar_path.replace('.tar', '')
+    # Check if single bucket key exists
+    try:
+        compression = tarstream.get_tar_compression(s3_input_tar_key)
+    except ValueError as e:
+        raise ziexceptions.ZiHelperError(f'{e}. Exit.')
     
-    # Sort the fastq files by prefix
-    sample_read_dict = defaultdict(dict)
+    if not aws_s3.check_object_key_exists(s3_bucket, s3_input_tar_key):
+        raise ziexceptions.ZiHelperError(f'Key {s3_input_tar_key} does not exist in bucket {s3_bucket}.Exit.')
     
-    # fastq files can be in cwd, level1 or level2 below the tar file, depedning on the tar file structure
-    # Prefilter fastq files from tar dir
-    fq_files = glob.glob('**', recursive=True)
-    fq_files = [os.path.abspath(f) for f in fq_files if f.endswith(tuple(VALID_FASTQ_EXTENSIONS))]
+    assert INGEST_MODE in ('index', 'stream'), f'Invalid ingest mode {INGEST_MODE}. Exit.'
+    assert QC_MODE in fastqqc.QC_MODES, f'Invalid QC mode {QC_MODE}. Exit.'
     
-    for f in fq_files:
-        
-        # Check for file which is matching substring and read
-        # Loop over read1 endings, if loop ends, check read2 endings, if loop completes continue
-        # Break if file ending is round and define sample and read
-        for read1_end in read1_endings:
-            if f.endswith(read1_end):
-                sample = os.path.basename(f).replace(read1_end, '')
-                read = 'R1'
-                break
-        else:
-            for read2_end in read2_endings:
-                if f.endswith(read2_end):
-                    sample = os.path.basename(f).replace(read2_end, '')
-                    read = 'R2'
-                    break
-            else:
-                print(f"WARNING {f} cannot be assigned to read1 or read2. Skip.")        
-                continue
-                
-        # Check if the fastq file has minimum size of 1 MB
-        if os.path.getsize(f) < 1024:
-            print(f"WARNING {f} is smaller than 1MB. Skip.")
-            continue
-        
-        # Check if files are valid fastq files, continue if not valid
-        if f.endswith('.gz'):
-            with gzip.open(f, 'rt') as fq_fh:
-                if is_fastq(fq_fh):
-                    f_path_gz = f
-                else:
-                    print(f"WARNING {f} is not a valid fastq file. Skip.")
-                    continue
-                    
-        # Case for uncompressed fastq files, continue if not valid or gzip
-        else:
-            with open(f, 'r') as fq_fh:
-                if is_fastq(fq_fh):
-                    f_path_gz = f + '.gz'
-                    utils.gzip_file(f, output_dir = os.path.dirname(f), remove_original=True)
-                    
-                else:
-                    print(f"WARNING {f} is not a valid fastq file. Skip.")
-                    continue
-        
-        # Add the sample and read to the dictionary
-        sample_read_dict[sample][read] = f_path_gz
+    if BARCODE_WHITELIST_S3_BUCKET:
+        download_barcode_whitelists(aws_s3)
     
-    # Check if the sample has both read1 and read2 and prepare for upload
-    for sample, read_dict in sample_read_dict.items():
-        
-        if 'R1' not in read_dict:
-            print(f"WARNING {sample} does not have read1. Skip.")
-            continue
-        if 'R2' not in read_dict:
-            print(f"WARNING {sample} does not have read2. Skip.")
-            continue
-        
-        uuid_short = utils.generate_short_uuid()
-        dataset_name = f'fq_{sample}_{uuid_short}'
-        date = datetime.datetime.now().strftime("%Y%m%d")
-        
-        # Upload the fastq files to S3 and 
-        for read, f in read_dict.items():
-                
-            # Check if key exists
-            s3_key = f'{OUTPUT_BUCKET_PREFIX}/{date}/{dataset_name}_S1_{read}_001.fastq.gz'
-            print(f'Upload {f} to {s3_key}')
-            aws_s3.upload_file_to_bucket(OUTPUT_BUCKET, s3_key, f)
-
-            if read == 'R1':
-                read1_key = s3_key
-            else:
-                read2_key = s3_key
-        
-        
-        fastq_dataset = FastqDatasets(
-            name = dataset_name,
-            s3_bucket = OUTPUT_BUCKET,
-            s3_source_key = s3_input_tar_key,
-            s3_source_bucket = s3_bucket,
-            s3_read1_fastq_key = read1_key,
-            s3_read2_fastq_key = read2_key
-        )
-        
-        print('POST dataset json.')
-        res = requests.post(BACKEND_URL + '/', auth=login, data=fastq_dataset.model_dump())
-        assert res.status_code == 201, f'POST request failed with status code {res.status_code}. Exit.'
-            
-    temp_dir.cleanup()
+    # Progress is recorded in a manifest next to the input tar
+    manifest_store = manifest.ManifestStore(boto3.client('s3'), s3_bucket, s3_input_tar_key,
+                                            datetime.datetime.now().strftime("%Y%m%d"), RESUME)
     
-    os.chdir(init_wd)
+    # Fastq files are streamed through the registration pipeline, nothing is staged on disk
+    # Compressed archives have no random access to members and are always streamed
+    if INGEST_MODE == 'index' and compression is None:
+        register_indexed(login, manifest_store, s3_input_tar_key, s3_bucket)
+    else:
+        register_stream(login, manifest_store, s3_input_tar_key, s3_bucket, compression)
     
 if __name__ == '__main__':
     
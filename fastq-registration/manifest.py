@@ -0,0 +1,198 @@
+# case-scrnaseq/fastq-registration/manifest.py
+
+"""
+Module for the registration manifest, a checkpoint of a registration run.
+
+The manifest is stored as JSON next to the input tar and records the state of
+each sample: the generated dataset name, the pending multipart uploads of
+validated reads and how far the sample got (validated, uploaded, posted). A
+rerun of the same tar resumes each sample from its last completed step and
+reuses its dataset name, so only work lost in the crash is repeated.
+
+The manifest is a prefix next to the input tar with one object for the run
+and one checkpoint object per sample. An update only rewrites the checkpoint
+of its sample, the bytes written do not grow with the number of samples.
+
+Sample states:
+
+- pending: dataset name assigned, results of finished reads are recorded.
+- validated: reads are validated and paired, QC profile is uploaded.
+- uploaded: multipart uploads of both reads are completed.
+- posted: fastq dataset is registered in the backend.
+- duplicate: content is already registered under another dataset.
+- failed: sample failed, its uploads are aborted. Retried by the next run.
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel
+
+import pipeline
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+MANIFEST_SUFFIX = '.registration/'
+MANIFEST_NAME = 'manifest.json'
+SAMPLES_PREFIX = 'samples/'
+
+# Concurrent requests for the checkpoints of a resumed manifest
+LOAD_WORKERS = 16
+
+# Maximum number of keys of a delete request
+DELETE_BATCH_SIZE = 1000
+
+SAMPLE_STATES = ('pending', 'validated', 'uploaded', 'posted', 'duplicate', 'failed')
+
+# Samples in these states are not registered again
+FINAL_STATES = ('posted', 'duplicate')
+
+# DATA CLASSES
+
+class SampleCheckpoint(BaseModel):
+    sample: str
+    dataset_name: str
+    state: str = 'pending'
+    job_results: dict[str, pipeline.FastqPipelineResult] = {} # By read
+    qc_profile_key: str | None = None
+    duplicate_of: str | None = None
+    error: str | None = None
+
+class RegistrationManifest(BaseModel):
+    s3_input_tar_key: str
+    s3_bucket: str
+    etag: str # Input tar the manifest belongs to
+    date: str # Date of the output keys
+    samples: dict[str, SampleCheckpoint] = {} # Stored as one object per sample
+
+# METHODS
+
+def get_manifest_prefix(s3_input_tar_key: str) -> str:
+    return s3_input_tar_key + MANIFEST_SUFFIX
+
+
+def get_checkpoint_key(manifest_prefix: str, sample: str) -> str:
+    return f'{manifest_prefix}{SAMPLES_PREFIX}{sample}.json'
+
+
+def list_checkpoint_keys(s3_client, s3_bucket: str, manifest_prefix: str) -> list[str]:
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    return [obj['Key'] for page in paginator.paginate(Bucket=s3_bucket, Prefix=manifest_prefix + SAMPLES_PREFIX)
+            for obj in page.get('Contents', [])]
+
+
+def load_manifest(s3_client, s3_bucket: str, s3_input_tar_key: str) -> RegistrationManifest | None:
+    """Load the manifest of an input tar with the checkpoints of all samples. Returns None if there is no manifest."""
+
+    manifest_prefix = get_manifest_prefix(s3_input_tar_key)
+
+    try:
+        res = s3_client.get_object(Bucket=s3_bucket, Key=manifest_prefix + MANIFEST_NAME)
+
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+    manifest = RegistrationManifest(**json.loads(res['Body'].read()))
+
+    def load_checkpoint(key: str) -> SampleCheckpoint:
+        return SampleCheckpoint(**json.loads(s3_client.get_object(Bucket=s3_bucket, Key=key)['Body'].read()))
+
+    keys = list_checkpoint_keys(s3_client, s3_bucket, manifest_prefix)
+
+    with ThreadPoolExecutor(LOAD_WORKERS) as executor:
+        checkpoints = list(executor.map(load_checkpoint, keys))
+
+    manifest.samples = {checkpoint.sample: checkpoint for checkpoint in checkpoints}
+
+    return manifest
+
+
+class ManifestStore:
+    """Load, update and save the registration manifest of an input tar.
+
+    Every update is written to S3 immediately, only the checkpoint of the
+    updated sample is written. Updates are thread-safe, samples are finalized
+    concurrently.
+
+    Args:
+        s3_client: boto3 S3 client.
+        s3_bucket: Bucket of the input tar and the manifest.
+        s3_input_tar_key: Key of the input tar.
+        date: Date of new output keys, the date of a resumed manifest is kept.
+        resume: Resume from an existing manifest, a new manifest is started if False.
+    """
+
+    def __init__(self, s3_client, s3_bucket: str, s3_input_tar_key: str, date: str, resume: bool = True):
+        self.s3_client = s3_client
+        self.s3_prefix = get_manifest_prefix(s3_input_tar_key)
+        self._lock = threading.Lock()
+
+        etag = s3_client.head_object(Bucket=s3_bucket, Key=s3_input_tar_key)['ETag']
+        manifest = load_manifest(s3_client, s3_bucket, s3_input_tar_key) if resume else None
+
+        if manifest is not None and manifest.etag != etag:
+            print(f'WARNING {s3_input_tar_key} changed since manifest {self.s3_prefix} was written. Start a new registration.')
+            manifest = None
+
+        self.resumed = manifest is not None
+        self.manifest = manifest or RegistrationManifest(s3_input_tar_key=s3_input_tar_key, s3_bucket=s3_bucket,
+                                                         etag=etag, date=date)
+
+        if self.resumed:
+            states = [checkpoint.state for checkpoint in self.manifest.samples.values()]
+            print(f'Resume registration from manifest {self.s3_prefix}: '
+                  + ', '.join(f'{states.count(state)} {state}' for state in SAMPLE_STATES if state in states))
+        else:
+            self._start()
+
+    @property
+    def date(self) -> str:
+        return self.manifest.date
+
+    def get(self, sample: str) -> SampleCheckpoint | None:
+        return self.manifest.samples.get(sample)
+
+    def add_samples(self, dataset_names: dict):
+        """Add checkpoints of new samples with their dataset names, existing samples keep their names."""
+
+        with self._lock:
+            for sample, dataset_name in dataset_names.items():
+                if sample not in self.manifest.samples:
+                    self.manifest.samples[sample] = SampleCheckpoint(sample=sample, dataset_name=dataset_name)
+                    self._save(sample)
+
+    def update(self, sample: str, **fields):
+        with self._lock:
+            checkpoint = self.manifest.samples[sample]
+
+            for field, value in fields.items():
+                setattr(checkpoint, field, value)
+            self._save(sample)
+
+    def add_job_result(self, sample: str, read: str, job_result: pipeline.FastqPipelineResult):
+        """Record the pending upload of a finished read, the read is not run again on resume."""
+
+        with self._lock:
+            self.manifest.samples[sample].job_results[read] = job_result
+            self._save(sample)
+
+    def _start(self):
+        """Write the manifest of a new registration, checkpoints of a previous manifest are deleted."""
+
+        s3_bucket = self.manifest.s3_bucket
+        keys = list_checkpoint_keys(self.s3_client, s3_bucket, self.s3_prefix)
+
+        for start in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[start:start + DELETE_BATCH_SIZE]
+            self.s3_client.delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+
+        self.s3_client.put_object(Bucket=s3_bucket, Key=self.s3_prefix + MANIFEST_NAME,
+                                  Body=self.manifest.model_dump_json(exclude={'samples'}).encode(), ContentType='application/json')
+
+    def _save(self, sample: str):
+        self.s3_client.put_object(Bucket=self.manifest.s3_bucket, Key=get_checkpoint_key(self.s3_prefix, sample),
+                                  Body=self.manifest.samples[sample].model_dump_json().encode(), ContentType='application/json')
@@ -0,0 +1,151 @@
+# case-scrnaseq/fastq-registration/pairsync.py
+
+"""
+Module for read1/read2 pair synchronization checks.
+
+Both mates of a sample are checked while they stream through the registration
+pipeline. Read names (up to the first whitespace, without /1 and /2 suffixes)
+are hashed per record with NumPy and combined into digests of fixed blocks of
+records. Block digests are exchanged through a channel shared by the mates,
+the first mismatching block stops both mates. A digest over all records is
+compared when the sample is finalized.
+"""
+
+import hashlib
+
+import numpy as np
+from pydantic import BaseModel
+
+import fastqcheck
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# Number of records per compared block
+BLOCK_SIZE = 65536
+
+# Read name bytes beyond this length are ignored
+MAX_NAME_LENGTH = 256
+
+# Multiplier of the polynomial record hash
+HASH_BASE = np.uint64(0x100000001B3)
+
+MATES = {'R1': 'R2', 'R2': 'R1'}
+
+# DATA CLASSES
+
+class PairSyncReport(BaseModel):
+    read: str
+    num_records: int
+    num_blocks: int
+    names_sha256: str
+
+
+class PairSyncError(ValueError):
+    pass
+
+# METHODS
+
+def read_name_hashes(batch: fastqcheck.RecordBatch) -> np.ndarray:
+    """Return a uint64 hash of the read name of each record in the batch."""
+
+    starts = batch.starts[:, 0] + 1 # Skip @
+    lengths = batch.ends[:, 0] - starts
+    width = max(1, min(int(lengths.max()), MAX_NAME_LENGTH))
+    positions = np.arange(width)
+
+    in_header = positions[None, :] < lengths[:, None]
+    names = batch.buf[np.minimum(starts[:, None] + positions[None, :], len(batch.buf) - 1)]
+
+    # The read name ends at the first whitespace, the comment differs between mates
+    separator = (names == ord(' ')) | (names == ord('\t')) | ~in_header
+    name_lengths = np.where(separator.any(axis=1), separator.argmax(axis=1), width)
+
+    # Strip /1 and /2 mate suffixes
+    rows = np.arange(len(names))
+    has_suffix = name_lengths >= 2
+    has_suffix[has_suffix] = (names[rows[has_suffix], name_lengths[has_suffix] - 2] == ord('/')) & \
+                             np.isin(names[rows[has_suffix], name_lengths[has_suffix] - 1], (ord('1'), ord('2')))
+    name_lengths = name_lengths - 2 * has_suffix
+
+    names = np.where(positions[None, :] < name_lengths[:, None], names, 0).astype(np.uint64)
+    powers = HASH_BASE ** np.arange(width, dtype=np.uint64)
+
+    # Integer overflow wraps around, which is intended for the hash
+    return (names * powers[None, :]).sum(axis=1, dtype=np.uint64) ^ name_lengths.astype(np.uint64)
+
+
+class PairSyncChecker:
+    """Compare read names of a mate with the other mate in blocks of records.
+
+    Args:
+        read: 'R1' or 'R2'.
+        unit: Key of the sample in the channel.
+        channel: Dict-like object shared by both mates, e.g. a multiprocessing manager dict.
+    """
+
+    def __init__(self, read: str, unit: str, channel):
+        self.read = read
+        self.unit = unit
+        self.channel = channel
+        self.num_records = 0
+        self.num_blocks = 0
+        self._block_hash = hashlib.sha256()
+        self._block_records = 0
+        self._names_hash = hashlib.sha256()
+
+    def update(self, batch: fastqcheck.RecordBatch):
+        hashes = read_name_hashes(batch)
+        self._names_hash.update(hashes.tobytes())
+        self.num_records += len(hashes)
+
+        while len(hashes):
+            take = BLOCK_SIZE - self._block_records
+            self._block_hash.update(hashes[:take].tobytes())
+            self._block_records += len(hashes[:take])
+            hashes = hashes[take:]
+
+            if self._block_records == BLOCK_SIZE:
+                self._publish_block()
+
+    def finish(self) -> PairSyncReport:
+        return PairSyncReport(
+            read=self.read,
+            num_records=self.num_records,
+            num_blocks=self.num_blocks,
+            names_sha256=self._names_hash.hexdigest()
+        )
+
+    def _publish_block(self):
+        digest = self._block_hash.hexdigest()
+        block = self.num_blocks
+
+        self.channel[(self.unit, self.read, block)] = digest
+        mate_digest = self.channel.get((self.unit, MATES[self.read], block))
+
+        self.num_blocks += 1
+        self._block_hash = hashlib.sha256()
+        self._block_records = 0
+
+        if mate_digest is not None and mate_digest != digest:
+            self.channel[(self.unit, 'mismatch')] = block
+            raise PairSyncError(f'Read names of {self.unit} read1 and read2 differ in records {block * BLOCK_SIZE}-{(block + 1) * BLOCK_SIZE - 1}')
+
+        # The mate found a mismatch first
+        mismatch = self.channel.get((self.unit, 'mismatch'))
+        if mismatch is not None:
+            raise PairSyncError(f'Read names of {self.unit} read1 and read2 differ in records {mismatch * BLOCK_SIZE}-{(mismatch + 1) * BLOCK_SIZE - 1}')
+
+
+def check_pair_reports(r1: PairSyncReport, r2: PairSyncReport) -> str | None:
+    """Compare the final reports of both mates. Returns an error message or None if the mates are in sync."""
+
+    if r1.num_records != r2.num_records:
+        return f'read1 has {r1.num_records} records, read2 has {r2.num_records} records'
+
+    if r1.names_sha256 != r2.names_sha256:
+        return 'read names of read1 and read2 differ'
+
+    return None
+
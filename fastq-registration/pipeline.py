@@ -0,0 +1,247 @@
+# case-scrnaseq/fastq-registration/pipeline.py
+
+"""
+Module for the single-pass fastq registration pipeline.
+
+Each fastq file is read once through a buffered reader. The same chunks are
+passed to the fastq validator and QC profile, the content hash, the compressor
+(for uncompressed input) and a streaming S3 multipart upload. No intermediate
+file is written to disk, the multipart upload is completed in a separate
+step once the sample is validated.
+
+A pipeline can be fed from several sources, e.g. the lanes of a sample, which
+are merged into one output by gzip member concatenation. Compressed sources
+are uploaded as is, nothing is recompressed. A seek point index of the gzip
+members is built in the same pass and stored next to the output. Cell
+barcodes of sampled read1 records are looked up in the 10x whitelists.
+"""
+
+import hashlib
+
+import boto3
+from pydantic import BaseModel
+
+import barcodes
+import bgzf
+import fastqcheck
+import fastqqc
+import gzindex
+import pairsync
+import multipart
+import tarstream
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+# DATA CLASSES
+
+class FastqSource(BaseModel):
+    name: str
+    gzipped: bool
+    # Source is either a local file or a byte range of an S3 object
+    local_path: str | None = None
+    s3_bucket: str | None = None
+    s3_key: str | None = None
+    offset: int = 0
+    size: int = 0
+
+class FastqJob(BaseModel):
+    name: str
+    output_bucket: str
+    output_key: str
+    sources: list[FastqSource] = []
+    # Tuning
+    gzip_threads: int = 2
+    download_part_size: int = 16 * 1024 * 1024
+    download_workers: int = 4
+    upload_part_size: int = 64 * 1024 * 1024
+    upload_workers: int = 4
+    upload_min_workers: int | None = None
+    upload_max_buffer: int | None = None
+    qc_mode: str = 'sample'
+    qc_sample_rate: float = 0.05
+    index_spacing: int = gzindex.DEFAULT_SPACING # 0 disables the gzip index
+    barcode_whitelist_dir: str | None = None # Whitelist indices for the read1 barcode prescan
+    barcode_sample_rate: float = 0.01
+    # Pair synchronization check, read is R1 or R2 of unit
+    unit: str | None = None
+    read: str | None = None
+
+class FastqPipelineResult(BaseModel):
+    name: str
+    s3_bucket: str
+    s3_key: str
+    upload_id: str
+    parts: list[dict]
+    sources: list[str]
+    bytes_read: int
+    bytes_uncompressed: int
+    bytes_uploaded: int
+    upload_stats: multipart.UploadStats | None = None
+    content_sha256: str
+    s3_index_key: str | None = None
+    validation: fastqcheck.FastqValidationReport
+    qc_profile: fastqqc.FastqQcProfile | None = None
+    pair_sync: pairsync.PairSyncReport | None = None
+    barcode_report: barcodes.BarcodeReport | None = None
+
+# METHODS
+
+class FastqPipeline:
+    """Validate, hash, compress and upload one output fastq in a single pass.
+
+    Sources are fed one after the other with feed(), finish() returns the
+    pending multipart upload. The upload is aborted if a source fails or the
+    merged stream is not a valid fastq file. If a pair_channel is given, read
+    names are checked against the mate of the job.
+    """
+
+    def __init__(self, job: FastqJob, s3_client=None, pair_channel=None):
+        if s3_client is None:
+            s3_client = boto3.client('s3')
+
+        self.job = job
+        self.sources = []
+        self.bytes_read = 0
+        self.bytes_uncompressed = 0
+        self.uploader = multipart.MultipartUploadWriter(s3_client, job.output_bucket, job.output_key, job.upload_part_size,
+                                                        job.upload_workers, job.upload_max_buffer, job.upload_min_workers)
+        self.qc_collector = fastqqc.FastqQcCollector(job.name, job.qc_mode, job.qc_sample_rate) if job.qc_mode != 'off' else None
+        self.pair_checker = pairsync.PairSyncChecker(job.read, job.unit, pair_channel) if pair_channel is not None and job.read else None
+        self.index_builder = gzindex.GzipIndexBuilder(job.index_spacing) if job.index_spacing else None
+        self.barcode_collector = barcodes.BarcodeCollector(barcodes.load_whitelists(job.barcode_whitelist_dir), job.barcode_sample_rate) \
+            if job.barcode_whitelist_dir and job.read == 'R1' else None
+        self.validator = fastqcheck.FastqValidator([consumer for consumer in (self.qc_collector, self.pair_checker, self.index_builder,
+                                                                              self.barcode_collector) if consumer])
+        self.s3_client = s3_client
+        self.content_hash = hashlib.sha256()
+        self._bgzf_written = False
+
+    def feed(self, fh, source: FastqSource):
+        try:
+            self._feed(fh, source)
+
+        except Exception:
+            self.abort()
+            raise
+
+    def finish(self) -> FastqPipelineResult:
+        try:
+            # BGZF output of uncompressed sources is terminated by the EOF block
+            if self._bgzf_written:
+                self.uploader.write(bgzf.BGZF_EOF)
+
+            report = self.validator.finish()
+
+            if not report.valid:
+                raise ValueError(f'{self.job.name} is not a valid fastq file: {report.error} (record {report.error_record})')
+
+            parts = self.uploader.close()
+            s3_index_key = self._upload_index(report) if self.index_builder else None
+
+        except Exception:
+            self.abort()
+            raise
+
+        return FastqPipelineResult(
+            name=self.job.name,
+            s3_bucket=self.job.output_bucket,
+            s3_key=self.job.output_key,
+            upload_id=self.uploader.upload_id,
+            parts=parts,
+            sources=self.sources,
+            bytes_read=self.bytes_read,
+            bytes_uncompressed=self.bytes_uncompressed,
+            bytes_uploaded=self.uploader.bytes_written,
+            upload_stats=self.uploader.stats(),
+            content_sha256=self.content_hash.hexdigest(),
+            s3_index_key=s3_index_key,
+            validation=report,
+            qc_profile=self.qc_collector.finish() if self.qc_collector else None,
+            pair_sync=self.pair_checker.finish() if self.pair_checker else None,
+            barcode_report=self.barcode_collector.finish() if self.barcode_collector else None
+        )
+
+    def abort(self):
+        self.uploader.abort()
+
+    def _feed(self, fh, source: FastqSource):
+        self.sources.append(source.name)
+
+        # Seek points are offsets in the output, member and block offsets are relative to the source
+        compressed_offset, uncompressed_offset = self.uploader.bytes_written, self.bytes_uncompressed
+        point_fn = (lambda c, u: self.index_builder.add_point(compressed_offset + c, uncompressed_offset + u)) if self.index_builder else None
+
+        # Compressed input is uploaded as is and decompressed for validation and hashing
+        if source.gzipped:
+            decompressor = gzindex.GzipStreamDecompressor(point_fn)
+
+            while chunk := fh.read(READ_CHUNK_SIZE):
+                self.bytes_read += len(chunk)
+                self.uploader.write(chunk)
+                self._update(decompressor.decompress(chunk))
+
+            decompressor.finish()
+
+        # Uncompressed input is compressed to BGZF on the fly
+        else:
+            compressor = bgzf.BgzfWriter(self.uploader, threads=self.job.gzip_threads, eof=False, block_fn=point_fn)
+
+            while chunk := fh.read(READ_CHUNK_SIZE):
+                self.bytes_read += len(chunk)
+                self._update(chunk)
+                compressor.write(chunk)
+
+            compressor.close()
+            self._bgzf_written = True
+
+        # Bound the buffered data while further sources are pending
+        self.uploader.flush()
+
+    def _upload_index(self, report: fastqcheck.FastqValidationReport) -> str:
+        index = self.index_builder.finish(report.num_records, self.bytes_uncompressed, self.uploader.bytes_written)
+        print(f'Upload gzip index with {len(index)} seek points for {self.job.output_key}')
+
+        return gzindex.upload_index(self.s3_client, self.job.output_bucket, self.job.output_key, index)
+
+    def _update(self, data: bytes):
+        self.bytes_uncompressed += len(data)
+        self.validator.update(data)
+        self.content_hash.update(data)
+
+
+def open_source(source: FastqSource, job: FastqJob):
+    if source.local_path:
+        return open(source.local_path, 'rb')
+
+    return tarstream.S3RangeReader(source.s3_bucket, source.s3_key, source.offset, source.size,
+                                   job.download_part_size, job.download_workers)
+
+
+def run_fastq_pipeline(fh, job: FastqJob, s3_client=None, pair_channel=None) -> FastqPipelineResult:
+    """Run the pipeline for a single source stream."""
+
+    fastq_pipeline = FastqPipeline(job, s3_client, pair_channel)
+    fastq_pipeline.feed(fh, job.sources[0])
+
+    return fastq_pipeline.finish()
+
+
+def run_fastq_job(job: FastqJob, pair_channel=None) -> FastqPipelineResult:
+    """Run the pipeline for all sources of a job, entry point for worker processes."""
+
+    fastq_pipeline = FastqPipeline(job, pair_channel=pair_channel)
+
+    try:
+        for source in job.sources:
+            with open_source(source, job) as fh:
+                fastq_pipeline.feed(fh, source)
+
+    except Exception:
+        fastq_pipeline.abort()
+        raise
+
+    return fastq_pipeline.finish()
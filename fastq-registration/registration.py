@@ -0,0 +1,124 @@
+# case-scrnaseq/fastq-registration/registration.py
+
+"""
+Module for parallel registration of fastq files.
+
+A registration unit is a set of fastq jobs (e.g. read1 and read2 of a sample)
+which is registered together. Jobs (validation, compression and upload of a
+single file) run in a process pool, finalization of units (completing uploads,
+backend requests) runs in a thread pool. Failures are isolated per unit.
+"""
+
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# DATA CLASSES
+
+class UnitResult(BaseModel):
+    unit: str
+    success: bool
+    value: Any = None
+    error: str | None = None
+
+# METHODS
+
+class RegistrationEngine:
+    """Run registration units with a process pool for fastq jobs and a thread pool for finalization.
+
+    Args:
+        job_fn: Picklable function which runs a single fastq job in a worker process.
+        num_workers: Number of worker processes and concurrently processed units.
+    """
+
+    def __init__(self, job_fn: Callable, num_workers: int):
+        self.job_fn = job_fn
+        self.num_workers = num_workers
+        # Worker processes are spawned, forking a process with running I/O threads is unsafe
+        self.process_pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+        self.thread_pool = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(num_workers)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, unit: str, jobs: dict, finalize_fn: Callable[[dict], Any], cleanup_fn: Callable[[dict], Any] | None = None,
+               job_done_fn: Callable[[str, Any], Any] | None = None):
+        """Submit a registration unit.
+
+        jobs is a dict of fastq jobs by read. finalize_fn receives the dict of
+        job results once all jobs succeeded. If a job fails, cleanup_fn receives
+        the results of the successful jobs. job_done_fn receives the read and
+        result of each job as soon as the job succeeded. Blocks while
+        num_workers units are in flight.
+        """
+
+        self._slots.acquire()
+        future = self.thread_pool.submit(self._run_isolated, unit, self._run_unit, jobs, finalize_fn, cleanup_fn, job_done_fn)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def run_inline(self, unit: str, fn: Callable, *args) -> UnitResult:
+        """Run fn in the calling thread with isolated failures, e.g. for sequential streams."""
+
+        return self._run_isolated(unit, fn, *args)
+
+    def map(self, fn: Callable, units: dict) -> list[UnitResult]:
+        """Apply fn to each value of units in the thread pool with isolated failures."""
+
+        futures = [self.thread_pool.submit(self._run_isolated, unit, fn, arg) for unit, arg in units.items()]
+
+        return [future.result() for future in futures]
+
+    def results(self) -> list[UnitResult]:
+        """Wait for all submitted units and return their results in submission order."""
+
+        results = [future.result() for future in self._futures]
+        self._futures = []
+
+        return results
+
+    def shutdown(self):
+        self.thread_pool.shutdown(wait=True)
+        self.process_pool.shutdown(wait=True)
+
+    def _run_isolated(self, unit: str, fn: Callable, *args) -> UnitResult:
+        try:
+            return UnitResult(unit=unit, success=True, value=fn(*args))
+
+        except Exception as e:
+            print(f"WARNING {unit} failed: {e}")
+            traceback.print_exc()
+            return UnitResult(unit=unit, success=False, error=str(e))
+
+    def _run_unit(self, jobs: dict, finalize_fn: Callable, cleanup_fn: Callable | None, job_done_fn: Callable | None):
+        futures = {read: self.process_pool.submit(self.job_fn, job) for read, job in jobs.items()}
+        reads = {future: read for read, future in futures.items()}
+
+        for future in as_completed(reads):
+            if job_done_fn is not None and future.exception() is None:
+                job_done_fn(reads[future], future.result())
+
+        job_results = {read: future.result() for read, future in futures.items() if future.exception() is None}
+        errors = [future.exception() for future in futures.values() if future.exception() is not None]
+
+        if errors:
+            if cleanup_fn is not None:
+                cleanup_fn(job_results)
+            raise errors[0]
+
+        return finalize_fn(job_results)
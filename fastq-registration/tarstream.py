@@ -0,0 +1,353 @@
+# case-scrnaseq/fastq-registration/tarstream.py
+
+"""
+Module for access to tar archives stored in S3 without staging the archive on disk.
+
+Two access patterns are supported:
+
+- Sequential: the archive is read as a single byte stream and members are
+  visited in archive order. gzip and zstd compressed archives are
+  decompressed on the fly.
+- Indexed: tar headers are read with ranged GET requests to build a member
+  table, member data is then streamed with parallel ranged GET requests.
+"""
+
+import queue
+import tarfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# Bytes fetched per header request, small members following a header are covered by the same request
+HEADER_READAHEAD_BYTES = 64 * 1024
+
+# Archive suffixes by compression, None is an uncompressed tar
+TAR_SUFFIXES = {
+    None: ('.tar',),
+    'gz': ('.tar.gz', '.tgz'),
+    'zst': ('.tar.zst', '.tzst')
+}
+
+# Chunks of the sequential stream are read ahead in a background thread
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+STREAM_PREFETCH_CHUNKS = 4
+
+# Seconds between checks of a closed stream while the prefetch queue is full, and to wait for the thread on close
+STREAM_QUEUE_TIMEOUT = 0.5
+STREAM_CLOSE_TIMEOUT = 5
+
+# DATA CLASSES
+
+class TarMember(BaseModel):
+    name: str
+    offset: int # Offset of the member data in the archive
+    size: int
+
+# METHODS
+
+def open_s3_stream(s3_bucket: str, s3_key: str):
+    """Open an S3 object as a readable byte stream (botocore StreamingBody)."""
+
+    s3_client = boto3.client('s3')
+    res = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+
+    return res['Body']
+
+
+def get_tar_compression(s3_key: str) -> str | None:
+    """Return the compression of a tar archive by its suffix. Raises ValueError for other files."""
+
+    for compression, suffixes in TAR_SUFFIXES.items():
+        if s3_key.endswith(suffixes):
+            return compression
+
+    raise ValueError(f'{s3_key} is not a tar archive, valid suffixes are {", ".join(sum(TAR_SUFFIXES.values(), ()))}')
+
+
+class PrefetchStream:
+    """Read a byte stream ahead in a background thread, overlapping network reads with decompression.
+
+    close() stops the thread and closes the underlying stream, also if the
+    consumer stops before the end of the stream. Use as a context manager.
+    """
+
+    def __init__(self, fileobj, chunk_size: int = STREAM_CHUNK_SIZE, num_chunks: int = STREAM_PREFETCH_CHUNKS):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=num_chunks)
+        self._buf = bytearray()
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            chunk = self._queue.get()
+
+            if isinstance(chunk, Exception):
+                raise chunk
+
+            if not chunk:
+                self._eof = True
+                break
+
+            # A whole chunk is returned without copying it into the buffer
+            if not self._buf and len(chunk) == size:
+                return chunk
+
+            self._buf += chunk
+
+        if size < 0:
+            size = len(self._buf)
+
+        # Data is copied once from the buffer, deleting from the front of a bytearray does not move the rest
+        with memoryview(self._buf) as view:
+            data = bytes(view[:size])
+
+        del self._buf[:size]
+
+        return data
+
+    def close(self):
+        self._stop.set()
+
+        # The reader may be blocked on a full queue
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+        self.fileobj.close()
+        self._thread.join(timeout=STREAM_CLOSE_TIMEOUT)
+
+    def _put(self, item) -> bool:
+        """Put an item into the queue, returns False if the stream was closed in the meantime."""
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=STREAM_QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set() and (chunk := self.fileobj.read(self.chunk_size)):
+                if not self._put(chunk):
+                    return
+
+            self._put(b'')
+
+        except Exception as e:
+            # Reads of a closed stream fail, the consumer is gone
+            if not self._stop.is_set():
+                self._put(e)
+
+
+def iter_tar_members(fileobj, compression: str | None = None):
+    """Walk the regular file members of a tar byte stream in archive order.
+
+    compression is None, 'gz' or 'zst', compressed streams are decompressed
+    while the members are read. Yields tuples of (TarInfo, file handle). The
+    file handle reads directly from the underlying stream and is only valid
+    until the next member is requested, i.e. every member must be consumed
+    before the loop continues.
+    """
+
+    mode = 'r|'
+
+    if compression == 'gz':
+        mode = 'r|gz'
+
+    elif compression == 'zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is required for .tar.zst archives')
+
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj, read_size=STREAM_CHUNK_SIZE)
+
+    elif compression is not None:
+        raise ValueError(f'Unsupported tar compression {compression}')
+
+    with tarfile.open(fileobj=fileobj, mode=mode, bufsize=1024 * 1024) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            yield member, tar.extractfile(member)
+
+
+def get_s3_range(s3_client, s3_bucket: str, s3_key: str, start: int, length: int) -> bytes:
+    """Fetch length bytes starting at start from an S3 object."""
+
+    res = s3_client.get_object(Bucket=s3_bucket, Key=s3_key, Range=f'bytes={start}-{start + length - 1}')
+
+    return res['Body'].read()
+
+
+class _S3RangeCache:
+    """Read-ahead cache for small ranged reads of an S3 object."""
+
+    def __init__(self, s3_client, s3_bucket: str, s3_key: str, object_size: int):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.object_size = object_size
+        self.num_requests = 0
+        self._start = 0
+        self._buf = b''
+
+    def read(self, pos: int, length: int) -> bytes:
+        end = pos + length
+
+        if not (self._start <= pos and end <= self._start + len(self._buf)):
+            fetch_length = min(max(length, HEADER_READAHEAD_BYTES), self.object_size - pos)
+            self._buf = get_s3_range(self.s3_client, self.s3_bucket, self.s3_key, pos, fetch_length)
+            self._start = pos
+            self.num_requests += 1
+
+        return self._buf[pos - self._start:end - self._start]
+
+
+def _parse_pax_headers(buf: bytes) -> dict:
+    """Parse pax extended header records of the form '<length> <key>=<value>\\n'."""
+
+    headers = {}
+    pos = 0
+
+    while pos < len(buf) and buf[pos:pos + 1] != tarfile.NUL:
+        length = int(buf[pos:buf.index(b' ', pos)])
+        record = buf[pos:pos + length].decode('utf-8', 'surrogateescape')
+        key, value = record.split(' ', 1)[1].rstrip('\n').split('=', 1)
+        headers[key] = value
+        pos += length
+
+    return headers
+
+
+def index_s3_tar(s3_bucket: str, s3_key: str) -> list[TarMember]:
+    """Build a table of the regular file members of an uncompressed tar archive in S3.
+
+    Only the 512 byte tar headers are read, the reader hops from header to
+    header using the member sizes. GNU long names and pax headers are supported.
+    """
+
+    s3_client = boto3.client('s3')
+    object_size = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)['ContentLength']
+    reader = _S3RangeCache(s3_client, s3_bucket, s3_key, object_size)
+
+    members = []
+    pos = 0
+    long_name = None
+    pax_headers = {}
+
+    while pos + tarfile.BLOCKSIZE <= object_size:
+        buf = reader.read(pos, tarfile.BLOCKSIZE)
+
+        # End of archive is marked by zero blocks
+        if buf == tarfile.NUL * tarfile.BLOCKSIZE:
+            break
+
+        tarinfo = tarfile.TarInfo.frombuf(buf, tarfile.ENCODING, 'surrogateescape')
+        data_offset = pos + tarfile.BLOCKSIZE
+        data_size = tarinfo.size
+
+        if tarinfo.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            data = reader.read(data_offset, data_size)
+
+            if tarinfo.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data.rstrip(tarfile.NUL).decode(tarfile.ENCODING, 'surrogateescape')
+            else:
+                pax_headers = _parse_pax_headers(data)
+
+        elif tarinfo.isfile():
+            name = pax_headers.get('path', long_name or tarinfo.name)
+            data_size = int(pax_headers.get('size', data_size))
+            members.append(TarMember(name=name, offset=data_offset, size=data_size))
+
+        # Extended headers only apply to the following member
+        if tarinfo.type not in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            long_name = None
+            pax_headers = {}
+
+        pos = data_offset + -(-data_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    print(f'Indexed {len(members)} members of {s3_key} with {reader.num_requests} ranged requests')
+
+    return members
+
+
+class S3RangeReader:
+    """Readable stream over a byte range of an S3 object.
+
+    The range is fetched as consecutive parts with parallel ranged GET
+    requests, at most max_workers parts are buffered in memory.
+    """
+
+    def __init__(self, s3_bucket: str, s3_key: str, offset: int, size: int,
+                 part_size: int = 16 * 1024 * 1024, max_workers: int = 4):
+        self.s3_client = boto3.client('s3')
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.offset = offset
+        self.size = size
+        self.part_size = part_size
+        self._max_pending = max_workers
+        self._next_part_start = 0
+        self._pending = deque()
+        self._current = memoryview(b'')
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes, returns b'' at the end of the range."""
+
+        if not self._current:
+            self._fill_window()
+
+            if not self._pending:
+                return b''
+
+            self._current = memoryview(self._pending.popleft().result())
+            self._fill_window()
+
+        if size < 0:
+            size = len(self._current)
+
+        data = self._current[:size].tobytes()
+        self._current = self._current[size:]
+
+        return data
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+
+        self._executor.shutdown(wait=True)
+
+    def _fill_window(self):
+        while len(self._pending) < self._max_pending and self._next_part_start < self.size:
+            part_length = min(self.part_size, self.size - self._next_part_start)
+            self._pending.append(self._executor.submit(get_s3_range, self.s3_client, self.s3_bucket, self.s3_key,
+                                                       self.offset + self._next_part_start, part_length))
+            self._next_part_start += part_length
@@ -67,11 +67,13 @@ class ScrnaseqDatasets(BaseModel):
     s3_qc_metrics_key : str
     s3_gene_expression_matrix_key : str
     s3_gene_expression_matrix_size_mb : float
+    s3_analysis_matrix_key : str | None = None
     number_cells : int
     mean_reads_per_cell : int
     median_number_genes_per_cell : int
     total_number_reads : int
     pipeline_version : str
+    provisional : bool = False
     valid_from : datetime.datetime
     valid_to : datetime.datetime | None
 
@@ -125,7 +127,8 @@ def main():
     print("Download dge.h5 from S3")
     
     # Get fastq S3 keys from backend
-    res = requests.get(f"{SCRNASEQ_DATASETS_BACKEND_URL}/get_valid", auth=login)
+    # Previews of quick-look runs are not integrated
+    res = requests.get(f"{SCRNASEQ_DATASETS_BACKEND_URL}/get_valid", params={'provisional': 'false'}, auth=login)
     assert res.status_code == 200, f'Failed to get fastq datasets. Exit.'
     
     scrnaseq_datasets = [
@@ -154,20 +157,31 @@ def main():
     
     print("Download DGEs")
     
-    dge_paths = []
+    # Analysis-ready h5ad of rawdata-processing, 10x HDF5 of datasets processed before
+    dge_paths = {}
     for dataset in scrnaseq_datasets:
         dataset_name = dataset.name
-        h5_path = os.path.join(h5_dir, dataset_name + '_dge.h5')
         
-        aws_s3.download_key_from_bucket(dataset.s3_bucket, dataset.s3_gene_expression_matrix_key, h5_path)
-        dge_paths.append(h5_path)
+        if dataset.s3_analysis_matrix_key:
+            h5_path = os.path.join(h5_dir, dataset_name + '_dge.h5ad')
+            aws_s3.download_key_from_bucket(dataset.s3_bucket, dataset.s3_analysis_matrix_key, h5_path)
+        else:
+            h5_path = os.path.join(h5_dir, dataset_name + '_dge.h5')
+            aws_s3.download_key_from_bucket(dataset.s3_bucket, dataset.s3_gene_expression_matrix_key, h5_path)
+        
+        dge_paths[dataset_name] = h5_path
     
     # LOAD: data into scanpy and concat
     adatas = {}
-    for dge_p in dge_paths:
-        dataset_name = os.path.basename(dge_p).replace('_dge.h5', '')
-        adata = sc.read_10x_h5(dge_p)
-        adata.var_names_make_unique()
+    for dataset_name, dge_p in dge_paths.items():
+        
+        if dge_p.endswith('.h5ad'):
+            # Unique var names and float32 CSR counts as from read_10x_h5, loaded without conversion
+            adata = ad.read_h5ad(dge_p)
+        else:
+            adata = sc.read_10x_h5(dge_p)
+            adata.var_names_make_unique()
+        
         adatas[dataset_name] = adata
         
     # Concatenate datasets
@@ -0,0 +1,75 @@
+# case-scrnaseq/rawdata-processing/analysis_matrix.py
+
+"""
+Module for the analysis-ready matrix of a scRNA-seq dataset.
+
+The filtered feature barcode matrix of cellranger (10x HDF5, v3) is converted
+once at processing time into an h5ad file as loaded by integration: cells x
+genes counts as float32 CSR, gene names made unique as var names,
+gene ids, feature types and genome as var columns and barcodes as obs names.
+Only Gene Expression features are kept, as sc.read_10x_h5 does by default.
+
+The 10x matrix stores the counts of each barcode in sequence (indptr over
+barcodes), which is the CSR layout of the transposed matrix. The arrays are
+written in gzip compressed, chunked datasets with the counts as float32, the
+dtype of sc.read_10x_h5, read_h5ad loads them directly into the CSR matrix
+used by integration without a conversion.
+"""
+
+import anndata as ad
+import h5py
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+ANALYSIS_MATRIX_NAME = 'analysis_matrix.h5ad'
+GENE_EXPRESSION = 'Gene Expression'
+
+# METHODS
+
+def read_feature_bc_matrix_h5(path: str) -> ad.AnnData:
+    """Read a 10x HDF5 feature barcode matrix (v3) as cells x genes AnnData with float32 counts."""
+
+    with h5py.File(path, 'r') as f:
+        if 'matrix' not in f:
+            raise ValueError(f'{path} is not a 10x HDF5 matrix of cellranger 3 or later. Exit.')
+
+        matrix = f['matrix']
+        num_features, num_barcodes = matrix['shape'][:]
+        data = matrix['data'][:]
+
+        # Counts are converted once here, float32 represents integer counts exactly up to 2^24
+        x = sparse.csr_matrix((data.astype(np.float32, copy=False), matrix['indices'][:], matrix['indptr'][:]),
+                              shape=(num_barcodes, num_features))
+
+        features = matrix['features']
+        var = pd.DataFrame({
+            'gene_ids': features['id'][:].astype(str),
+            'feature_types': features['feature_type'][:].astype(str),
+            'genome': features['genome'][:].astype(str)
+        }, index=features['name'][:].astype(str))
+
+        obs = pd.DataFrame(index=matrix['barcodes'][:].astype(str))
+
+    adata = ad.AnnData(X=x, obs=obs, var=var)
+
+    gex = (adata.var['feature_types'] == GENE_EXPRESSION).to_numpy()
+    if not gex.all():
+        adata = adata[:, gex].copy()
+
+    adata.var_names_make_unique()
+
+    return adata
+
+
+def write_analysis_matrix(h5_path: str, h5ad_path: str) -> str:
+    """Convert a 10x HDF5 feature barcode matrix to the analysis-ready h5ad. Returns the h5ad path."""
+
+    adata = read_feature_bc_matrix_h5(h5_path)
+    adata.write_h5ad(h5ad_path, compression='gzip')
+
+    return h5ad_path
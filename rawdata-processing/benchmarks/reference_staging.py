@@ -0,0 +1,244 @@
+# case-scrnaseq/rawdata-processing/benchmarks/reference_staging.py
+
+"""
+Benchmark of the transcriptome reference staging.
+
+Writes a synthetic reference with the layout of a cellranger reference (a
+large FASTA, STAR index files, a gzipped GTF and many small tables), uploads
+it to a local S3 stand-in (e.g. moto_server or MinIO) as a folder and as a
+packed archive (refpack.py) and stages it with each method:
+
+- folder: one object after another, as download_folder_from_bucket
+- folder_parallel: parallel per-object download of a reference cache miss
+- refpack: parallel ranged requests of the archive, unpacked as it streams
+- refpack_cache: the archive staged through a reference cache miss
+
+A local S3 stand-in has no request latency, --latency-ms adds a delay to each
+S3 request to model the first-byte latency of S3. Each staged reference is
+compared with the original. Results are written as JSON, --baseline prints
+the ratio of each throughput to a previous result.
+
+Usage:
+    moto_server -p 5000 &
+    python benchmarks/reference_staging.py --endpoint-url http://127.0.0.1:5000 --size-mb 1024 --small-files 200 \\
+        --latency-ms 30 --output results.json --baseline previous.json
+"""
+
+import argparse
+import datetime
+import filecmp
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import refcache
+import refpack
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--endpoint-url", dest='endpoint_url', type=str, default=None, help="S3 endpoint, AWS_ENDPOINT_URL by default")
+parser.add_argument("--bucket", dest='bucket', type=str, default='reference-staging-benchmark', help="Bucket of the reference, created if missing")
+parser.add_argument("--size-mb", dest='size_mb', type=int, default=256, help="Approximate size of the reference")
+parser.add_argument("--small-files", dest='small_files', type=int, default=100, help="Number of small files of the reference")
+parser.add_argument("--latency-ms", dest='latency_ms', type=float, default=0, help="Delay added to each S3 request")
+parser.add_argument("--workers", dest='workers', type=int, default=8, help="Parallel downloads (ranges) of the parallel methods")
+parser.add_argument("--output", dest='output', type=str, default=None, help="JSON file of the results")
+parser.add_argument("--baseline", dest='baseline', type=str, default=None, help="JSON results of a previous run to compare with")
+
+
+class RequestCounter:
+    """Count the S3 requests of a client and add a fixed latency to each of them."""
+
+    def __init__(self, s3_client, latency_ms: float = 0):
+        self.latency = latency_ms / 1000
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        s3_client.meta.events.register('before-send.s3', self.before_send)
+
+    def before_send(self, **kwargs):
+        with self.lock:
+            self.requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self) -> int:
+        with self.lock:
+            requests, self.requests = self.requests, 0
+
+        return requests
+
+
+def write_synthetic_reference(ref_dir: str, size_mb: int, num_small_files: int, seed: int = 42) -> dict:
+    """Write a synthetic reference. Returns the relative paths of the files with their sizes.
+
+    Half of the size is a FASTA of random bases, which compresses, the rest are random bytes (STAR index, gzipped GTF).
+    """
+
+    rng = np.random.default_rng(seed)
+    size = size_mb * 1024 * 1024
+    files = {}
+
+    def write(path: str, data: bytes):
+        full_path = os.path.join(ref_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        with open(full_path, 'wb') as fh:
+            fh.write(data)
+        files[path] = len(data)
+
+    # FASTA with 60 bases per line
+    bases = BASES[rng.integers(0, 4, (size // 2 // 61, 60))]
+    write('fasta/genome.fa', b'>chr1\n' + np.hstack([bases, np.full((len(bases), 1), ord('\n'), dtype=np.uint8)]).tobytes())
+
+    for path, fraction in (('star/SA', 0.3), ('star/Genome', 0.1), ('star/SAindex', 0.05), ('genes/genes.gtf.gz', 0.05)):
+        write(path, rng.bytes(int(size * fraction)))
+
+    write('reference.json', json.dumps({'genomes': ['synthetic'], 'version': 'benchmark'}).encode())
+
+    for i in range(num_small_files):
+        write(f'star/table_{i:04d}.tab', '\n'.join(f'chr{i}\t{j}\t{rng.integers(0, 1 << 30)}' for j in range(rng.integers(10, 2000))).encode())
+
+    return files
+
+
+def get_throughput(num_bytes: int, seconds: float, requests: int) -> dict:
+    seconds = max(seconds, 1e-6)
+
+    return {'mb': round(num_bytes / (1024 * 1024), 1), 'seconds': round(seconds, 2),
+            'mb_per_second': round(num_bytes / (1024 * 1024) / seconds, 1), 'requests': requests}
+
+
+def check_staged(ref_dir: str, files: dict, staged_dir: str):
+    for path in files:
+        assert filecmp.cmp(os.path.join(ref_dir, path), os.path.join(staged_dir, path), shallow=False), f'{path} differs from the reference'
+
+
+def stage_folder(s3_client, s3_bucket: str, s3_prefix: str, staged_dir: str) -> str:
+    """Download a folder one object after another."""
+
+    for f in refcache.list_reference_files(s3_client, s3_bucket, s3_prefix):
+        path = os.path.join(staged_dir, f.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3_client.download_file(s3_bucket, s3_prefix + '/' + f.key, path)
+
+    return staged_dir
+
+
+def stage_refpack(s3_client, s3_bucket: str, s3_key: str, staged_dir: str, workers: int) -> str:
+    refpack.unpack_s3(s3_bucket, s3_key, staged_dir, s3_client, workers)
+
+    return staged_dir
+
+
+def stage_cache(s3_client, s3_bucket: str, s3_key: str, cache_dir: str, workers: int) -> str:
+    """Stage a reference through a cache miss. Returns the entry directory."""
+
+    with refcache.ReferenceCache(cache_dir, s3_client=s3_client, download_workers=workers).open(s3_bucket, s3_key) as entry_dir:
+        return entry_dir
+
+
+def compare(results: dict, baseline: dict):
+    """Print the throughput ratio of each method to the baseline."""
+
+    print(f"Compared with baseline of {baseline['created']}")
+    for method, result in results['methods'].items():
+        value = result['mb_per_second']
+        baseline_value = baseline['methods'].get(method, {}).get('mb_per_second')
+        ratio = f'{value / baseline_value:.2f}x' if baseline_value else '-'
+        print(f'{method:<16} {value:>10} {baseline_value if baseline_value is not None else "-":>10} {ratio:>8}')
+
+
+def main(args) -> dict:
+    if args.endpoint_url:
+        os.environ['AWS_ENDPOINT_URL'] = args.endpoint_url
+
+    assert os.getenv('AWS_ENDPOINT_URL'), 'Local S3 endpoint required, set --endpoint-url or AWS_ENDPOINT_URL'
+
+    s3_client = boto3.client('s3')
+
+    if args.bucket not in [bucket['Name'] for bucket in s3_client.list_buckets()['Buckets']]:
+        s3_client.create_bucket(Bucket=args.bucket)
+
+    temp_dir = tempfile.TemporaryDirectory()
+    ref_dir = os.path.join(temp_dir.name, 'refdata-benchmark')
+    pack_path = ref_dir + refpack.PACK_SUFFIX
+    s3_prefix = 'genomes/refdata-benchmark'
+    s3_pack_key = s3_prefix + refpack.PACK_SUFFIX
+
+    print(f'Write synthetic reference of {args.size_mb} MB with {args.small_files} small files')
+    files = write_synthetic_reference(ref_dir, args.size_mb, args.small_files)
+    size = sum(files.values())
+
+    start = time.perf_counter()
+    refpack.pack(ref_dir, pack_path)
+    pack_seconds = time.perf_counter() - start
+    pack_size = os.path.getsize(pack_path)
+    print(f'Packed {len(files)} files in {pack_seconds:.1f} s, archive of {pack_size / (1024 * 1024):.1f} MB')
+
+    for path in files:
+        s3_client.upload_file(os.path.join(ref_dir, path), args.bucket, f'{s3_prefix}/{path}')
+    s3_client.upload_file(pack_path, args.bucket, s3_pack_key)
+
+    # Requests of the setup are not counted
+    counter = RequestCounter(s3_client, args.latency_ms)
+
+    stagings = {
+        'folder': lambda out_dir: stage_folder(s3_client, args.bucket, s3_prefix, out_dir),
+        'folder_parallel': lambda out_dir: stage_cache(s3_client, args.bucket, s3_prefix, out_dir, args.workers),
+        'refpack': lambda out_dir: stage_refpack(s3_client, args.bucket, s3_pack_key, out_dir, args.workers),
+        'refpack_cache': lambda out_dir: stage_cache(s3_client, args.bucket, s3_pack_key, out_dir, args.workers)
+    }
+
+    methods = {}
+
+    for method, stage in stagings.items():
+        out_dir = os.path.join(temp_dir.name, method)
+        counter.reset()
+
+        start = time.perf_counter()
+        staged_dir = stage(out_dir)
+        methods[method] = get_throughput(size, time.perf_counter() - start, counter.reset())
+
+        check_staged(ref_dir, files, staged_dir)
+        print(f"{method:<16} {methods[method]['seconds']:>8} s {methods[method]['mb_per_second']:>10} MB/s "
+              f"{methods[method]['requests']:>6} requests")
+
+    temp_dir.cleanup()
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpu_count': os.cpu_count()},
+        'config': {
+            'size_mb': round(size / (1024 * 1024), 1), 'num_files': len(files), 'pack_mb': round(pack_size / (1024 * 1024), 1),
+            'pack_seconds': round(pack_seconds, 2), 'latency_ms': args.latency_ms, 'workers': args.workers
+        },
+        'methods': methods
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+        print(f'Wrote results to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            compare(results, json.load(fh))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    main(parser.parse_args())
@@ -1,11 +1,13 @@
 # case-scrnaseq/rawdata-processing/main.py
 
 import argparse
+import contextlib
 import tempfile
 import os
-import subprocess
 import datetime
+import json
 
+import boto3
 import requests
 from requests.auth import HTTPBasicAuth
 import pandas as pd
@@ -16,6 +18,14 @@ from zihelper import aws
 from zihelper import utils
 from zihelper import exceptions as ziexceptions
 
+import analysis_matrix
+import multipart
+import quantify
+import refcache
+import refpack
+import sizing
+import staging
+import supervisor
 from __version__ import __version__
 
 __author__ = "Jonathan Alles"
@@ -38,6 +48,39 @@ RAWDATA_PROCESSING_GENOME_S3_BUCKET = utils.load_check_env_var('RAWDATA_PROCESSI
 RAWDATA_PROCESSING_NUM_CORES = int(utils.load_check_env_var('RAWDATA_PROCESSING_NUM_CORES'))
 RAWDATA_PROCESSING_MEM_GB = int(utils.load_check_env_var('RAWDATA_PROCESSING_MEM_GB'))
 
+# Optional tuning of result uploads, concurrency is tuned from min to max workers
+RAWDATA_PROCESSING_UPLOAD_PART_SIZE_MB = int(os.getenv('RAWDATA_PROCESSING_UPLOAD_PART_SIZE_MB', 64))
+RAWDATA_PROCESSING_UPLOAD_MIN_WORKERS = int(os.getenv('RAWDATA_PROCESSING_UPLOAD_MIN_WORKERS', 2))
+RAWDATA_PROCESSING_UPLOAD_MAX_WORKERS = int(os.getenv('RAWDATA_PROCESSING_UPLOAD_MAX_WORKERS', 8))
+RAWDATA_PROCESSING_UPLOAD_MAX_BUFFER_MB = int(os.getenv('RAWDATA_PROCESSING_UPLOAD_MAX_BUFFER_MB', 1024))
+
+# Optional: fail before alignment if the barcode prescan of registration found fewer valid barcodes
+RAWDATA_PROCESSING_MIN_VALID_BARCODE_FRACTION = float(os.getenv('RAWDATA_PROCESSING_MIN_VALID_BARCODE_FRACTION', 0.1))
+# Optional: pass the chemistry of the barcode prescan to cellranger instead of auto detection
+RAWDATA_PROCESSING_PIN_CHEMISTRY = os.getenv('RAWDATA_PROCESSING_PIN_CHEMISTRY', 'true').lower() == 'true'
+
+# Optional: quantification engine, cellranger or the built-in pseudoaligner (pseudoalign) for small runs, see quantify.py
+RAWDATA_PROCESSING_QUANTIFIER = os.getenv('RAWDATA_PROCESSING_QUANTIFIER', 'cellranger')
+# Optional: seconds between resource samples of the quantification
+RAWDATA_PROCESSING_SAMPLE_INTERVAL_SECONDS = float(os.getenv('RAWDATA_PROCESSING_SAMPLE_INTERVAL_SECONDS', supervisor.SAMPLE_INTERVAL_SECONDS))
+
+# Optional: persistent reference cache, e.g. on an EFS volume, the reference is downloaded for each run if not set
+# The reference key is a folder or a packed archive (.refpack, see refpack.py)
+RAWDATA_PROCESSING_REFERENCE_CACHE_DIR = os.getenv('RAWDATA_PROCESSING_REFERENCE_CACHE_DIR', '')
+RAWDATA_PROCESSING_REFERENCE_CACHE_MAX_GB = float(os.getenv('RAWDATA_PROCESSING_REFERENCE_CACHE_MAX_GB', 0)) # 0 for no limit
+RAWDATA_PROCESSING_REFERENCE_DOWNLOAD_WORKERS = int(os.getenv('RAWDATA_PROCESSING_REFERENCE_DOWNLOAD_WORKERS', 8))
+
+# Optional: sizing model in the run bucket (see sizing.py), cores and memory of the quantification are limited to its prediction
+RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY = os.getenv('RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY', '')
+
+# Optional: bandwidth budget shared by the concurrent staging of fastq files and reference, 0 for no limit
+RAWDATA_PROCESSING_STAGING_MAX_MBPS = float(os.getenv('RAWDATA_PROCESSING_STAGING_MAX_MBPS', 0))
+# Optional: parallel ranged requests per fastq file
+RAWDATA_PROCESSING_DOWNLOAD_WORKERS = int(os.getenv('RAWDATA_PROCESSING_DOWNLOAD_WORKERS', 8))
+
+# Name prefix of the provisional datasets of quick-look runs
+QUICK_LOOK_PREFIX = 'sc_preview_'
+
 # PARSER
 
 parser = argparse.ArgumentParser()
@@ -57,6 +100,14 @@ parser.add_argument(
     help="S3 bucket name"
 )
 
+parser.add_argument(
+    "--quick-look-reads",
+    dest='quick_look_reads',
+    default=0,
+    type=float,
+    help="Million read pairs of a quick-look run, registered as provisional preview. 0 for a full run"
+)
+
 # DATA CLASSES
 
 class FastqDatasets(BaseModel):
@@ -67,6 +118,9 @@ class FastqDatasets(BaseModel):
     s3_source_bucket : str
     s3_read1_fastq_key : str
     s3_read2_fastq_key : str
+    chemistry : str | None = None
+    valid_barcode_fraction : float | None = None
+    s3_qc_profile_key : str | None = None
 
 class ScrnaseqDatasets(BaseModel):
     name: str
@@ -76,21 +130,72 @@ class ScrnaseqDatasets(BaseModel):
     s3_qc_metrics_key : str
     s3_gene_expression_matrix_key : str
     s3_gene_expression_matrix_size_mb : float
+    s3_analysis_matrix_key : str | None = None
     number_cells : int
     mean_reads_per_cell : int
     median_number_genes_per_cell : int
     total_number_reads : int
     pipeline_version : str
+    run_summary : dict | None = None
+    s3_run_timeline_key : str | None = None
+    provisional : bool = False
     
 # METHODS
 
+def upload_run_timeline(run_supervisor: supervisor.Supervisor, s3_bucket: str, s3_key: str) -> dict | None:
+    """Upload the resource and stage timeline of the quantification. Returns the run summary."""
+    
+    if run_supervisor.started is None:
+        return None
+    
+    timeline = run_supervisor.get_timeline()
+    summary = timeline.summary
+    
+    print(f'Quantification took {summary.seconds:.0f} s with a mean of {summary.mean_cpu_cores} of {summary.num_cores} cores '
+          f'and a peak RSS of {summary.peak_rss_mb / 1024:.1f} of {summary.mem_gb} GB')
+    
+    print(f'Upload run timeline to {s3_key}')
+    boto3.client('s3').put_object(Bucket=s3_bucket, Key=s3_key, Body=timeline.model_dump_json().encode(), ContentType='application/json')
+    
+    return summary.model_dump()
+
+def apply_sizing(quantifier: quantify.Quantifier, s3_bucket: str, fastq_dataset: FastqDatasets, fastq_size_mb: float, transcriptome: str,
+                 num_reads: int | None = None):
+    """Limit the cores and memory of the quantification to the prediction of the sizing model."""
+    
+    s3_client = boto3.client('s3')
+    
+    try:
+        model = sizing.load_model(s3_bucket=s3_bucket, s3_key=RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY)
+    except s3_client.exceptions.NoSuchKey:
+        print(f'WARNING: Sizing model {RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY} not found, use the configured resources')
+        return
+    
+    # Read count of the QC profile of registration, estimated from the fastq size otherwise
+    if num_reads is None and fastq_dataset.s3_qc_profile_key:
+        qc_profile = json.loads(s3_client.get_object(Bucket=fastq_dataset.s3_bucket, Key=fastq_dataset.s3_qc_profile_key)['Body'].read())
+        num_reads = qc_profile['R2']['num_reads']
+    
+    resources = sizing.predict(model, fastq_size_mb / 1024, num_reads, transcriptome)
+    
+    print(f'Sizing model predicts {resources.num_cores} cores and {resources.mem_gb} GB '
+          f'(peak RSS {resources.predicted_rss_gb} GB, {resources.predicted_cpu_cores} cores)')
+    
+    if resources.num_cores > RAWDATA_PROCESSING_NUM_CORES or resources.mem_gb > RAWDATA_PROCESSING_MEM_GB:
+        print(f'WARNING: Task with {RAWDATA_PROCESSING_NUM_CORES} cores and {RAWDATA_PROCESSING_MEM_GB} GB is smaller than predicted')
+    
+    quantifier.resize(min(resources.num_cores, RAWDATA_PROCESSING_NUM_CORES), min(resources.mem_gb, RAWDATA_PROCESSING_MEM_GB))
+
 # MAIN
 
-def main(s3_input_key: str, s3_bucket: str):
+def main(s3_input_key: str, s3_bucket: str, quick_look_reads: float = 0):
     
-    aws_s3 = aws.AwsS3()
     init_wd = os.getcwd()
     
+    # CHECK: quantification engine is valid before any download
+    quantifier = quantify.get_quantifier(RAWDATA_PROCESSING_QUANTIFIER, RAWDATA_PROCESSING_NUM_CORES, RAWDATA_PROCESSING_MEM_GB,
+                                         RAWDATA_PROCESSING_SAMPLE_INTERVAL_SECONDS)
+    
     # CHECK: backend credentials can be defined
     if SERVICE_USER_SECRET_KEY_NAME:
         aws_secrets_manager = aws.AwsSecretsManager()
@@ -125,11 +230,18 @@ def main(s3_input_key: str, s3_bucket: str):
     # Read in data class
     fastq_dataset = FastqDatasets(**res.json())
     
+    # CHECK: Barcodes of read1 match a 10x whitelist, datasets registered without prescan are not checked
+    if fastq_dataset.valid_barcode_fraction is not None and fastq_dataset.valid_barcode_fraction < RAWDATA_PROCESSING_MIN_VALID_BARCODE_FRACTION:
+        raise ziexceptions.ZiHelperError(f'{fastq_dataset.name} has a valid barcode fraction of {fastq_dataset.valid_barcode_fraction}, '
+                                         f'below {RAWDATA_PROCESSING_MIN_VALID_BARCODE_FRACTION}. Wrong chemistry or read order. Exit.')
+    
     # Define new dataset name from fastq dataset name
     # fq_dataset_name example: fq_Chromium_3p_GEX_Human_PBMC_S1_L001_xKFRG5TxQSeorSwPriTbAQ
     # Strip fq_ prefix and uuid suffix and add new uuid suffix
     uuid_short = utils.generate_short_uuid()
-    sc_dataset_name = 'sc_' + '_'.join(fastq_dataset.name.lstrip('fq_').split('_')[:-1])
+    # Quick-look runs on the first reads are previews of the full run
+    sc_dataset_prefix = QUICK_LOOK_PREFIX if quick_look_reads else 'sc_'
+    sc_dataset_name = sc_dataset_prefix + '_'.join(fastq_dataset.name.lstrip('fq_').split('_')[:-1])
     sc_dataset_name += uuid_short
     
     # Ensure that the dataset name is max 63 characters long
@@ -149,42 +261,80 @@ def main(s3_input_key: str, s3_bucket: str):
     read1_path = os.path.join(fq_dir, os.path.basename(fastq_dataset.s3_read1_fastq_key))
     read2_path = os.path.join(fq_dir, os.path.basename(fastq_dataset.s3_read2_fastq_key))
     
-    aws_s3.download_key_from_bucket(s3_bucket, fastq_dataset.s3_read1_fastq_key, read1_path)
-    aws_s3.download_key_from_bucket(s3_bucket, fastq_dataset.s3_read2_fastq_key, read2_path)
-    
     # LOAD: Genome reference
-    print(f"""Download transcriptome reference from S3 bucket {RAWDATA_PROCESSING_GENOME_S3_BUCKET} and key {RAWDATA_PROCESSING_GENOME_S3_KEY}""")
+    tx_name = os.path.basename(RAWDATA_PROCESSING_GENOME_S3_KEY.rstrip('/')).removesuffix(refpack.PACK_SUFFIX)
     
-    tx_name = os.path.basename(RAWDATA_PROCESSING_GENOME_S3_KEY)
-    aws_s3.download_folder_from_bucket(RAWDATA_PROCESSING_GENOME_S3_BUCKET, RAWDATA_PROCESSING_GENOME_S3_KEY, tx_name)
+    # Fastq files and reference are staged concurrently with a shared bandwidth budget
+    stager = staging.Stager(max_mbps=RAWDATA_PROCESSING_STAGING_MAX_MBPS, workers=RAWDATA_PROCESSING_DOWNLOAD_WORKERS)
     
-    print(f'Start alignment for scRNA-seq dataset {sc_dataset_name}')
-    
-    cellranger_cmd = [
-        'cellranger',
-        'count',
-        f'--id={sc_dataset_name}',
-        f'--transcriptome={tx_name}',
-        '--fastqs=' + fq_dir,
-        '--sample=' + fastq_dataset.name,
-        '--create-bam=false',
-        f'--localcores={RAWDATA_PROCESSING_NUM_CORES}',
-        f'--localmem={RAWDATA_PROCESSING_MEM_GB}',
-        '--nosecondary'
-    ]
+    with contextlib.ExitStack() as stack:
+        
+        # A cached reference is held until cellranger finished, it is not evicted by concurrent runs
+        if RAWDATA_PROCESSING_REFERENCE_CACHE_DIR:
+            reference_cache = refcache.ReferenceCache(RAWDATA_PROCESSING_REFERENCE_CACHE_DIR, RAWDATA_PROCESSING_REFERENCE_CACHE_MAX_GB,
+                                                      s3_client=stager.s3_client,
+                                                      download_workers=RAWDATA_PROCESSING_REFERENCE_DOWNLOAD_WORKERS,
+                                                      throttle=stager.throttle)
+            stage_reference = lambda: stack.enter_context(reference_cache.open(RAWDATA_PROCESSING_GENOME_S3_BUCKET,
+                                                                               RAWDATA_PROCESSING_GENOME_S3_KEY))
+        
+        else:
+            print(f"""Download transcriptome reference from S3 bucket {RAWDATA_PROCESSING_GENOME_S3_BUCKET} and key {RAWDATA_PROCESSING_GENOME_S3_KEY}""")
+            
+            stage_reference = lambda: refcache.download_reference(stager.s3_client, RAWDATA_PROCESSING_GENOME_S3_BUCKET,
+                                                                  RAWDATA_PROCESSING_GENOME_S3_KEY, tx_name,
+                                                                  RAWDATA_PROCESSING_REFERENCE_DOWNLOAD_WORKERS, stager.throttle)
+        
+        # Size and ETag of the fastq files are validated during download, a quick-look run streams the first reads only
+        if quick_look_reads:
+            num_reads = int(quick_look_reads * 1e6)
+            print(f'Quick-look run on the first {num_reads} read pairs')
+            
+            stage_read1 = lambda: stager.download_head(s3_bucket, fastq_dataset.s3_read1_fastq_key, read1_path, num_reads)
+            stage_read2 = lambda: stager.download_head(s3_bucket, fastq_dataset.s3_read2_fastq_key, read2_path, num_reads)
+        
+        else:
+            stage_read1 = lambda: stager.download(s3_bucket, fastq_dataset.s3_read1_fastq_key, read1_path)
+            stage_read2 = lambda: stager.download(s3_bucket, fastq_dataset.s3_read2_fastq_key, read2_path)
+        
+        staged = stager.stage({
+            'read1': stage_read1,
+            'read2': stage_read2,
+            'reference': stage_reference
+        })
+        tx_path = staged['reference']
+        
+        fastq_size_mb = sum(staged_input.size for staged_input in stager.staged if staged_input.name in ('read1', 'read2')) / (1024 * 1024)
+        
+        if RAWDATA_PROCESSING_SIZING_MODEL_S3_KEY:
+            apply_sizing(quantifier, s3_bucket, fastq_dataset, fastq_size_mb, tx_name, int(quick_look_reads * 1e6) or None)
+        
+        print(f'Start {quantifier.name} quantification for scRNA-seq dataset {sc_dataset_name}')
+        
+        chemistry = fastq_dataset.chemistry if RAWDATA_PROCESSING_PIN_CHEMISTRY else None
+        s3_run_timeline_key = os.path.join('scrnaseq_dataset', sc_dataset_name, 'run_timeline.json')
+        
+        # The timeline of a failed run is uploaded for the error analysis
+        try:
+            sc_dataset_outdir = quantifier.run(sc_dataset_name, tx_path, fq_dir, fastq_dataset.name, read1_path, read2_path, chemistry)
+        finally:
+            run_summary = upload_run_timeline(quantifier.supervisor, s3_bucket, s3_run_timeline_key)
     
-    # EXEC: Cellranger Pipeline
-    subprocess.call(cellranger_cmd)
+    # Input size of the run history of the sizing model
+    if run_summary is not None:
+        run_summary['fastq_size_mb'] = round(fastq_size_mb, 1)
     
     # Collect and parse output files
-    sc_dataset_outdir = os.path.join(temp_dir.name, sc_dataset_name, 'outs')
-    
-    metrics_summary = os.path.join(sc_dataset_outdir, 'metrics_summary.csv')
-    filtered_feat_bc_matrix = os.path.join(sc_dataset_outdir, 'filtered_feature_bc_matrix.h5')
+    metrics_summary = os.path.join(sc_dataset_outdir, quantify.METRICS_SUMMARY_NAME)
+    filtered_feat_bc_matrix = os.path.join(sc_dataset_outdir, quantify.FILTERED_MATRIX_NAME)
     
     assert os.path.exists(metrics_summary), f'Cellranger failed to generate metrics_summary.csv. Exit.'
     assert os.path.exists(filtered_feat_bc_matrix), f'Cellranger failed to generate filtered_feature_bc_matrix.h5. Exit.'
     
+    # Analysis-ready matrix, loaded by integration without conversion
+    analysis_matrix_path = analysis_matrix.write_analysis_matrix(filtered_feat_bc_matrix,
+                                                                 os.path.join(temp_dir.name, analysis_matrix.ANALYSIS_MATRIX_NAME))
+    
     # Returns size in bytes
     feat_bc_matrix_size_mb = round(os.path.getsize(filtered_feat_bc_matrix) / (1024*1024),2)
     
@@ -198,11 +348,21 @@ def main(s3_input_key: str, s3_bucket: str):
     # Perform data upload
     s3_qc_metrics_key = os.path.join('scrnaseq_dataset', sc_dataset_name, 'qc_metrics.csv')
     s3_gene_expression_matrix_key = os.path.join('scrnaseq_dataset', sc_dataset_name, 'dge.h5')
+    s3_analysis_matrix_key = os.path.join('scrnaseq_dataset', sc_dataset_name, analysis_matrix.ANALYSIS_MATRIX_NAME)
     
     print(f'Upload files to S3 bucket {s3_bucket}')
     
-    aws_s3.upload_file_to_bucket(s3_bucket, s3_qc_metrics_key, metrics_summary)
-    aws_s3.upload_file_to_bucket(s3_bucket, s3_gene_expression_matrix_key, filtered_feat_bc_matrix)
+    for s3_key, file_path in ((s3_qc_metrics_key, metrics_summary), (s3_gene_expression_matrix_key, filtered_feat_bc_matrix),
+                              (s3_analysis_matrix_key, analysis_matrix_path)):
+        multipart.upload_file(file_path, s3_bucket, s3_key,
+                              part_size=RAWDATA_PROCESSING_UPLOAD_PART_SIZE_MB * 1024 * 1024,
+                              max_workers=RAWDATA_PROCESSING_UPLOAD_MAX_WORKERS,
+                              max_buffer_bytes=RAWDATA_PROCESSING_UPLOAD_MAX_BUFFER_MB * 1024 * 1024,
+                              min_workers=RAWDATA_PROCESSING_UPLOAD_MIN_WORKERS)
+    
+    # Counts of other engines than cellranger are marked in the version
+    pipeline_version = __version__ if quantifier.name == quantify.CellrangerQuantifier.name else f'{__version__}+{quantifier.name}'
+    
     # Make pydantic way
     scrnaseq_dataset = ScrnaseqDatasets(
         name=sc_dataset_name,
@@ -212,15 +372,20 @@ def main(s3_input_key: str, s3_bucket: str):
         s3_qc_metrics_key=s3_qc_metrics_key,
         s3_gene_expression_matrix_key=s3_gene_expression_matrix_key,
         s3_gene_expression_matrix_size_mb=feat_bc_matrix_size_mb,
+        s3_analysis_matrix_key=s3_analysis_matrix_key,
         number_cells=metrics['Estimated Number of Cells'].values[0],
         mean_reads_per_cell=metrics['Mean Reads per Cell'].values[0],
         median_number_genes_per_cell=metrics['Median Genes per Cell'].values[0],
         total_number_reads=metrics['Number of Reads'].values[0],
-        pipeline_version=__version__
+        pipeline_version=pipeline_version,
+        run_summary=run_summary,
+        s3_run_timeline_key=s3_run_timeline_key,
+        provisional=bool(quick_look_reads)
     )
         
     print('POST dataset json.')
-    res = requests.post(RAWDATA_PROCESSING_BACKEND_URL + '/', auth=login, data=scrnaseq_dataset.model_dump())
+    # JSON body for the nested run summary
+    res = requests.post(RAWDATA_PROCESSING_BACKEND_URL + '/', auth=login, json=scrnaseq_dataset.model_dump())
     assert res.status_code == 201, f'POST request failed with status code {res.status_code}. Exit.'
 
     temp_dir.cleanup()
@@ -232,7 +397,8 @@ if __name__ == '__main__':
     args = parser.parse_args()
     s3_input_key = args.s3_input_key
     s3_bucket = args.s3_bucket
+    quick_look_reads = args.quick_look_reads
 
-    main(s3_input_key, s3_bucket)
+    main(s3_input_key, s3_bucket, quick_look_reads)
     
     print('rawdata-processing completed. Exit.')
\ No newline at end of file
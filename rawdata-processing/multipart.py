@@ -0,0 +1,303 @@
+# case-scrnaseq/rawdata-processing/multipart.py
+
+"""
+Module for concurrent S3 multipart uploads.
+
+Data is written to a file-like writer, complete parts are uploaded on a
+thread pool while writing continues. Buffered parts are bounded by a memory
+ceiling, failed parts are retried with backoff and the number of concurrent
+part uploads is raised while the measured throughput keeps improving.
+Completion of the upload is a separate step, so an upload can be validated
+before the object becomes visible.
+
+The S3 client honors AWS_ENDPOINT_URL, uploads can be tested against a local
+S3 stand-in such as MinIO or moto_server.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+# Retries of a failed part upload, the backoff doubles after each attempt
+MAX_RETRIES = 4
+RETRY_BACKOFF_SECONDS = 1.0
+
+# Concurrency is raised while a window of parts is at least this much faster than the previous window
+AUTOTUNE_MIN_GAIN = 1.1
+
+# DATA CLASSES
+
+class UploadStats(BaseModel):
+    s3_key: str
+    bytes_uploaded: int
+    num_parts: int
+    seconds: float
+    mb_per_second: float
+    concurrency: int
+    retries: int
+
+# METHODS
+
+class MultipartUploadWriter:
+    """File-like writer which uploads written data as an S3 multipart upload.
+
+    Args:
+        s3_client: boto3 S3 client.
+        s3_bucket: Target bucket.
+        s3_key: Target key.
+        part_size: Size of uploaded parts in bytes, at least 5 MB.
+        max_workers: Maximum number of concurrent part uploads.
+        max_buffer_bytes: Memory ceiling for buffered and in-flight parts, 2 * max_workers parts by default.
+        min_workers: Initial number of concurrent part uploads, raised up to max_workers
+            while throughput improves. Concurrency is fixed to max_workers if None.
+    """
+
+    def __init__(self, s3_client, s3_bucket: str, s3_key: str, part_size: int = 64 * 1024 * 1024, max_workers: int = 4,
+                 max_buffer_bytes: int | None = None, min_workers: int | None = None):
+        assert part_size >= MIN_PART_SIZE, f'Part size must be at least {MIN_PART_SIZE} bytes'
+
+        if max_buffer_bytes is None:
+            max_buffer_bytes = 2 * max_workers * part_size
+
+        # The part being filled counts against the ceiling
+        max_in_flight = max_buffer_bytes // part_size - 1
+        assert max_in_flight >= 1, f'Memory ceiling must hold at least 2 parts of {part_size} bytes'
+
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.part_size = part_size
+        self.bytes_written = 0
+        self.retries = 0
+        self.max_workers = min(max_workers, max_in_flight)
+        self.concurrency = self.max_workers if min_workers is None else min(min_workers, self.max_workers)
+        self.upload_id = s3_client.create_multipart_upload(Bucket=s3_bucket, Key=s3_key)['UploadId']
+        self._autotune = self.concurrency < self.max_workers
+        self._buf = bytearray()
+        self._parts = []
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._lock = threading.Lock()
+        self._bytes_uploaded = 0
+        self._start_time = None
+        self._end_time = None
+        self._window = None
+        self._window_rate = 0.0
+        self._aborted = False
+
+    def write(self, data: bytes) -> int:
+        if self._start_time is None:
+            self._start()
+
+        self._buf += data
+        self.bytes_written += len(data)
+
+        while len(self._buf) >= self.part_size:
+            self._submit(bytes(self._buf[:self.part_size]))
+            del self._buf[:self.part_size]
+
+        return len(data)
+
+    def flush(self):
+        """Upload the buffered data as a part if it reaches the minimum part size."""
+
+        if len(self._buf) >= MIN_PART_SIZE:
+            self._submit(bytes(self._buf))
+            self._buf.clear()
+
+    def close(self) -> list:
+        """Upload the remaining data and wait for all parts. Returns the list of uploaded parts."""
+
+        if self._start_time is None:
+            self._start()
+
+        # The last part may be smaller than the minimum part size
+        if self._buf or not self._parts and not self._pending:
+            self._submit(bytes(self._buf))
+            self._buf.clear()
+
+        while self._pending:
+            self._parts.append(self._pending.popleft().result())
+
+        self._executor.shutdown(wait=True)
+        self._end_time = time.perf_counter()
+
+        stats = self.stats()
+        print(f'Uploaded {stats.bytes_uploaded / (1024 * 1024):.1f} MB to {self.s3_key} in {stats.seconds} s '
+              f'({stats.mb_per_second} MB/s, {stats.num_parts} parts, concurrency {stats.concurrency}, {stats.retries} retries)')
+
+        return self._parts
+
+    def abort(self):
+        """Abort the upload, uploaded parts are discarded."""
+
+        if self._aborted:
+            return
+
+        for future in self._pending:
+            future.cancel()
+
+        self._executor.shutdown(wait=True)
+        abort_multipart_upload(self.s3_client, self.s3_bucket, self.s3_key, self.upload_id)
+        self._aborted = True
+
+    def stats(self) -> UploadStats:
+        end_time = self._end_time or time.perf_counter()
+        seconds = max(end_time - (self._start_time or end_time), 1e-6)
+
+        return UploadStats(
+            s3_key=self.s3_key,
+            bytes_uploaded=self._bytes_uploaded,
+            num_parts=len(self._parts) + len(self._pending),
+            seconds=round(seconds, 2),
+            mb_per_second=round(self._bytes_uploaded / (1024 * 1024) / seconds, 1),
+            concurrency=self.concurrency,
+            retries=self.retries
+        )
+
+    def _start(self):
+        self._start_time = time.perf_counter()
+        self._window = (self._start_time, 0)
+
+    def _submit(self, data: bytes):
+        part_number = len(self._parts) + len(self._pending) + 1
+        assert part_number <= MAX_PARTS, f'Upload of {self.s3_key} exceeds {MAX_PARTS} parts, increase the part size'
+
+        # Bound memory usage by the number of parts in flight
+        while self._pending and self._pending[0].done():
+            self._parts.append(self._pending.popleft().result())
+
+        while len(self._pending) >= self.concurrency:
+            self._parts.append(self._pending.popleft().result())
+
+        if self._autotune:
+            self._tune()
+
+        self._pending.append(self._executor.submit(self._upload_part, part_number, data))
+
+    def _tune(self):
+        """Raise concurrency by one while each window of parts is faster than the previous window."""
+
+        window_start, window_bytes = self._window
+
+        # A window spans twice the current concurrency in completed parts
+        if self._bytes_uploaded - window_bytes < 2 * self.concurrency * self.part_size:
+            return
+
+        now = time.perf_counter()
+        rate = (self._bytes_uploaded - window_bytes) / max(now - window_start, 1e-6)
+        self._window = (now, self._bytes_uploaded)
+
+        if rate >= self._window_rate * AUTOTUNE_MIN_GAIN and self.concurrency < self.max_workers:
+            self.concurrency += 1
+            self._window_rate = rate
+        else:
+            self._autotune = False
+
+    def _upload_part(self, part_number: int, data: bytes) -> dict:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                res = self.s3_client.upload_part(Bucket=self.s3_bucket, Key=self.s3_key, UploadId=self.upload_id,
+                                                 PartNumber=part_number, Body=data)
+                break
+
+            except Exception as e:
+                if attempt == MAX_RETRIES:
+                    raise
+
+                with self._lock:
+                    self.retries += 1
+
+                print(f'WARNING Upload of part {part_number} of {self.s3_key} failed ({e}), retry {attempt + 1} of {MAX_RETRIES}')
+                time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+        with self._lock:
+            self._bytes_uploaded += len(data)
+
+        return {'PartNumber': part_number, 'ETag': res['ETag']}
+
+
+def complete_multipart_upload(s3_client, s3_bucket: str, s3_key: str, upload_id: str, parts: list):
+    """Complete a multipart upload, the object becomes visible and triggers bucket notifications."""
+
+    s3_client.complete_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id,
+                                        MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])})
+
+
+def abort_multipart_upload(s3_client, s3_bucket: str, s3_key: str, upload_id: str):
+    s3_client.abort_multipart_upload(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id)
+
+
+def multipart_upload_exists(s3_client, s3_bucket: str, s3_key: str, upload_id: str) -> bool:
+    """Check if a multipart upload is still pending, i.e. neither completed nor aborted."""
+
+    try:
+        s3_client.list_parts(Bucket=s3_bucket, Key=s3_key, UploadId=upload_id, MaxParts=1)
+
+    except s3_client.exceptions.NoSuchUpload:
+        return False
+
+    return True
+
+
+def abort_stale_multipart_uploads(s3_client, s3_bucket: str, s3_key: str, keep_upload_ids: tuple = ()) -> int:
+    """Abort pending multipart uploads of a key, e.g. left behind by a crashed process. Returns the number of aborted uploads."""
+
+    res = s3_client.list_multipart_uploads(Bucket=s3_bucket, Prefix=s3_key)
+    stale_uploads = [upload for upload in res.get('Uploads', [])
+                     if upload['Key'] == s3_key and upload['UploadId'] not in keep_upload_ids]
+
+    for upload in stale_uploads:
+        abort_multipart_upload(s3_client, s3_bucket, s3_key, upload['UploadId'])
+
+    return len(stale_uploads)
+
+
+def upload_file(file_path: str, s3_bucket: str, s3_key: str, s3_client=None, part_size: int = 64 * 1024 * 1024,
+                max_workers: int = 8, max_buffer_bytes: int | None = None, min_workers: int | None = 2) -> UploadStats:
+    """Upload a local file with a multipart upload. Files smaller than one part are uploaded with a single request."""
+
+    if s3_client is None:
+        s3_client = boto3.client('s3')
+
+    if os.path.getsize(file_path) < MIN_PART_SIZE:
+        start_time = time.perf_counter()
+
+        with open(file_path, 'rb') as fh:
+            s3_client.put_object(Bucket=s3_bucket, Key=s3_key, Body=fh.read())
+
+        seconds = max(time.perf_counter() - start_time, 1e-6)
+        size = os.path.getsize(file_path)
+        print(f'Uploaded {size / (1024 * 1024):.1f} MB to {s3_key} in {seconds:.2f} s ({size / (1024 * 1024) / seconds:.1f} MB/s)')
+
+        return UploadStats(s3_key=s3_key, bytes_uploaded=size, num_parts=1, seconds=round(seconds, 2),
+                           mb_per_second=round(size / (1024 * 1024) / seconds, 1), concurrency=1, retries=0)
+
+    writer = MultipartUploadWriter(s3_client, s3_bucket, s3_key, part_size, max_workers, max_buffer_bytes, min_workers)
+
+    try:
+        with open(file_path, 'rb') as fh:
+            while chunk := fh.read(part_size):
+                writer.write(chunk)
+
+        parts = writer.close()
+        complete_multipart_upload(s3_client, s3_bucket, s3_key, writer.upload_id, parts)
+
+    except Exception:
+        writer.abort()
+        raise
+
+    return writer.stats()
@@ -0,0 +1,632 @@
+# case-scrnaseq/rawdata-processing/quantify.py
+
+"""
+Module for the quantification engines of rawdata processing.
+
+An engine turns the read pair of a fastq dataset and a transcriptome
+reference into the outputs of cellranger count which main.py parses and
+uploads, {sc_dataset_name}/outs/metrics_summary.csv and
+filtered_feature_bc_matrix.h5 (10x HDF5 feature-barcode matrix) in the
+working directory.
+
+- cellranger: cellranger count, the default.
+- pseudoalign: built-in k-mer pseudoaligner for small runs and CI, no
+  cellranger binary required.
+
+The pseudoaligner indexes the canonical k-mers of all transcripts (exons of
+the GTF on the genome FASTA of the reference) in an open addressing hash
+table of NumPy arrays, k-mers shared by several genes are ambiguous. A read2
+is assigned to a gene if all of its unambiguous k-mers agree. Reads are
+collapsed by cell barcode and UMI, a UMI of several genes is counted for the
+gene with most reads (ties are dropped). Cells are called with the ordmag
+method of cellranger 2, barcodes with at least a tenth of the 99th percentile
+UMI count of the expected cells. There is no barcode whitelist, UMI error
+correction or intronic counting, counts approximate cellranger.
+
+The index is written to the reference directory and reused by later runs.
+Indexing needs about 30 bytes of memory per transcriptome base.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import supervisor
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+KMER_LENGTH = 31
+BARCODE_LENGTH = 16
+MAX_UMI_LENGTH = 12
+
+# Read pairs per processed chunk
+CHUNK_READS = 100000
+
+# Cell calling, number of expected cells of the ordmag method
+EXPECTED_CELLS = 3000
+
+INDEX_NAME = f'.pseudoalign_index_k{KMER_LENGTH}.npz'
+
+# Hash table, k-mers use at most 62 bits so all bits set marks an empty slot
+HASH_LOAD_FACTOR = 0.5
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+EMPTY = np.uint64(np.iinfo(np.uint64).max)
+
+# Gene values of k-mers
+AMBIGUOUS = -1
+NOT_FOUND = -2
+
+# 2-bit base codes, other characters are invalid
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    BASE_CODES[ord(base)] = i
+    BASE_CODES[ord(base.lower())] = i
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+METRICS_SUMMARY_NAME = 'metrics_summary.csv'
+FILTERED_MATRIX_NAME = 'filtered_feature_bc_matrix.h5'
+
+# METHODS
+
+def get_kmers(codes: np.ndarray, k: int = KMER_LENGTH) -> tuple[np.ndarray, np.ndarray]:
+    """Return the canonical k-mers of equally long sequences of base codes and a mask of k-mers without invalid bases."""
+
+    n_kmers = codes.shape[1] - k + 1
+    invalid = codes > 3
+    bases = np.where(invalid, 0, codes).astype(np.uint64)
+
+    forward = np.zeros((codes.shape[0], n_kmers), dtype=np.uint64)
+    reverse = np.zeros((codes.shape[0], n_kmers), dtype=np.uint64)
+
+    for j in range(k):
+        window = bases[:, j:j + n_kmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * j)
+
+    invalid_count = np.concatenate([np.zeros((codes.shape[0], 1), dtype=np.int32), np.cumsum(invalid, axis=1, dtype=np.int32)], axis=1)
+    valid = invalid_count[:, k:] == invalid_count[:, :n_kmers]
+
+    return np.minimum(forward, reverse), valid
+
+
+def pack_bases(codes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Pack sequences of base codes into uint64 keys with 2 bits per base. Returns the keys and a mask of valid sequences."""
+
+    keys = np.zeros(codes.shape[0], dtype=np.uint64)
+
+    for j in range(codes.shape[1]):
+        keys = (keys << np.uint64(2)) | (codes[:, j] & 3).astype(np.uint64)
+
+    return keys, (codes <= 3).all(axis=1)
+
+
+def unpack_bases(keys: np.ndarray, length: int) -> list[str]:
+    shifts = np.arange(2 * (length - 1), -1, -2, dtype=np.uint64)
+
+    return [seq.decode() for seq in BASES[(keys[:, None] >> shifts[None, :]) & np.uint64(3)].view(f'S{length}').ravel()]
+
+
+class KmerTable:
+    """Open addressing hash table with linear probing of uint64 k-mers to int32 values, in NumPy arrays.
+
+    Inserts and lookups are vectorized, each round probes the next slot of all pending k-mers.
+    """
+
+    def __init__(self, keys: np.ndarray, values: np.ndarray):
+        self.bits = max(int(np.ceil(np.log2(max(len(keys), 1) / HASH_LOAD_FACTOR))), 1)
+        self.mask = np.uint64((1 << self.bits) - 1)
+        self.keys = np.full(1 << self.bits, EMPTY, dtype=np.uint64)
+        self.values = np.full(1 << self.bits, NOT_FOUND, dtype=np.int32)
+
+        # Keys are unique, the first pending key claims a free slot
+        slots = self.hash(keys)
+        pending = np.arange(len(keys))
+
+        while len(pending):
+            free = self.keys[slots[pending]] == EMPTY
+            candidates = pending[free]
+            claimed, first = np.unique(slots[candidates], return_index=True)
+
+            self.keys[claimed] = keys[candidates[first]]
+            self.values[claimed] = values[candidates[first]]
+
+            placed = np.zeros(len(keys), dtype=bool)
+            placed[candidates[first]] = True
+            pending = pending[~placed[pending]]
+            slots[pending] = (slots[pending] + np.uint64(1)) & self.mask
+
+    @classmethod
+    def from_arrays(cls, keys: np.ndarray, values: np.ndarray) -> 'KmerTable':
+        table = cls.__new__(cls)
+        table.bits = int(np.log2(len(keys)))
+        table.mask = np.uint64(len(keys) - 1)
+        table.keys = keys
+        table.values = values
+
+        return table
+
+    def hash(self, keys: np.ndarray) -> np.ndarray:
+        return (keys * HASH_MULTIPLIER) >> np.uint64(64 - self.bits)
+
+    def lookup(self, queries: np.ndarray) -> np.ndarray:
+        """Return the values of queries, NOT_FOUND for missing k-mers."""
+
+        result = np.full(len(queries), NOT_FOUND, dtype=np.int32)
+        slots = self.hash(queries)
+        pending = np.arange(len(queries))
+
+        while len(pending):
+            keys = self.keys[slots[pending]]
+            hit = keys == queries[pending]
+            result[pending[hit]] = self.values[slots[pending[hit]]]
+
+            pending = pending[~hit & (keys != EMPTY)]
+            slots[pending] = (slots[pending] + np.uint64(1)) & self.mask
+
+        return result
+
+
+class TranscriptomeIndex:
+    """K-mer index of the genes of a cellranger reference."""
+
+    def __init__(self, table: KmerTable, gene_ids: list[str], gene_names: list[str], genome: str):
+        self.table = table
+        self.gene_ids = gene_ids
+        self.gene_names = gene_names
+        self.genome = genome
+
+    def save(self, path: str):
+        # Concurrent runs on a shared reference write their own temp file
+        temp_path = f'{path}.{os.getpid()}.tmp'
+
+        with open(temp_path, 'wb') as fh:
+            np.savez(fh, keys=self.table.keys, values=self.table.values, gene_ids=np.array(self.gene_ids),
+                     gene_names=np.array(self.gene_names), genome=np.array(self.genome))
+
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'TranscriptomeIndex':
+        with np.load(path) as npz:
+            return cls(KmerTable.from_arrays(npz['keys'], npz['values']), npz['gene_ids'].tolist(), npz['gene_names'].tolist(),
+                       str(npz['genome']))
+
+
+def get_reference_paths(tx_path: str) -> tuple[str, str]:
+    """Return the genome FASTA and the GTF of a cellranger reference."""
+
+    fasta_path = os.path.join(tx_path, 'fasta', 'genome.fa')
+    gtf_paths = [os.path.join(tx_path, 'genes', name) for name in ('genes.gtf', 'genes.gtf.gz')]
+    gtf_paths = [path for path in gtf_paths if os.path.isfile(path)]
+
+    assert os.path.isfile(fasta_path) and gtf_paths, f'{tx_path} is not a cellranger reference with fasta/genome.fa and genes/genes.gtf(.gz). Exit.'
+
+    return fasta_path, gtf_paths[0]
+
+
+def read_gtf_exons(gtf_path: str) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Return the exons and the genes of a GTF, genes in order of the GTF."""
+
+    gtf = pd.read_csv(gtf_path, sep='\t', comment='#', header=None, usecols=[0, 2, 3, 4, 8],
+                      names=['chrom', 'feature', 'start', 'end', 'attributes'], dtype={'chrom': str})
+
+    for attribute in ('gene_id', 'gene_name', 'transcript_id'):
+        gtf[attribute] = gtf['attributes'].str.extract(f'{attribute} "([^"]+)"', expand=False)
+
+    gtf['gene_name'] = gtf['gene_name'].fillna(gtf['gene_id'])
+    genes = gtf.dropna(subset=['gene_id']).drop_duplicates('gene_id')[['gene_id', 'gene_name']].reset_index(drop=True)
+
+    exons = gtf[gtf['feature'] == 'exon'].dropna(subset=['gene_id', 'transcript_id'])
+    exons = exons.sort_values(['chrom', 'transcript_id', 'start'])
+
+    return exons[['chrom', 'start', 'end', 'gene_id', 'transcript_id']], genes
+
+
+def iter_fasta(fasta_path: str):
+    """Yield (name, sequence) of the records of a FASTA file."""
+
+    name = None
+    seq = []
+
+    with (gzip.open if fasta_path.endswith('.gz') else open)(fasta_path, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, b''.join(seq)
+
+                name = line[1:].split()[0].decode()
+                seq = []
+            else:
+                seq.append(line.rstrip())
+
+    if name is not None:
+        yield name, b''.join(seq)
+
+
+def build_index(tx_path: str, k: int = KMER_LENGTH) -> TranscriptomeIndex:
+    """Index the canonical k-mers of all transcripts of a cellranger reference."""
+
+    fasta_path, gtf_path = get_reference_paths(tx_path)
+    exons, genes = read_gtf_exons(gtf_path)
+    gene_index = pd.Series(np.arange(len(genes), dtype=np.int32), index=genes['gene_id'])
+
+    kmers = []
+    kmer_genes = []
+
+    for chrom, seq in iter_fasta(fasta_path):
+        chrom_exons = exons[exons['chrom'] == chrom]
+
+        if chrom_exons.empty:
+            continue
+
+        # Transcripts of a chromosome are concatenated, separated by an invalid base
+        codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+        parts = []
+        part_genes = []
+
+        for (_, gene_id), transcript_exons in chrom_exons.groupby(['transcript_id', 'gene_id'], sort=False):
+            transcript = np.concatenate([codes[start - 1:end] for start, end in zip(transcript_exons['start'], transcript_exons['end'])]
+                                        + [np.array([4], dtype=np.uint8)])
+            parts.append(transcript)
+            part_genes.append(np.full(len(transcript), gene_index[gene_id], dtype=np.int32))
+
+        concatenated = np.concatenate(parts)
+
+        if len(concatenated) < k:
+            continue
+
+        chrom_kmers, valid = get_kmers(concatenated[None, :], k)
+        kmers.append(chrom_kmers[0][valid[0]])
+        kmer_genes.append(np.concatenate(part_genes)[:len(valid[0])][valid[0]])
+
+    assert kmers, f'No transcripts of the GTF found in {fasta_path}. Exit.'
+
+    kmers = np.concatenate(kmers)
+    kmer_genes = np.concatenate(kmer_genes)
+
+    # K-mers of several genes are ambiguous
+    order = np.lexsort((kmer_genes, kmers))
+    kmers = kmers[order]
+    kmer_genes = kmer_genes[order]
+
+    unique_kmers, first, counts = np.unique(kmers, return_index=True, return_counts=True)
+    values = kmer_genes[first]
+    values[kmer_genes[first + counts - 1] != values] = AMBIGUOUS
+
+    genome = os.path.basename(tx_path.rstrip('/'))
+    reference_json = os.path.join(tx_path, 'reference.json')
+
+    if os.path.isfile(reference_json):
+        with open(reference_json) as fh:
+            genome = (json.load(fh).get('genomes') or [genome])[0]
+
+    print(f'Indexed {len(unique_kmers)} k-mers of {len(genes)} genes, {np.mean(values == AMBIGUOUS):.1%} ambiguous')
+
+    return TranscriptomeIndex(KmerTable(unique_kmers, values), genes['gene_id'].tolist(), genes['gene_name'].tolist(), genome)
+
+
+def load_index(tx_path: str) -> TranscriptomeIndex:
+    """Load the index of a reference, the index is built and saved to the reference directory on first use."""
+
+    index_path = os.path.join(tx_path, INDEX_NAME)
+
+    if os.path.isfile(index_path):
+        print(f'Load pseudoalignment index {index_path}')
+        return TranscriptomeIndex.load(index_path)
+
+    start = time.perf_counter()
+    index = build_index(tx_path)
+    print(f'Built pseudoalignment index in {time.perf_counter() - start:.1f} s')
+
+    try:
+        index.save(index_path)
+    except OSError as e:
+        print(f'WARNING Pseudoalignment index not saved to {index_path}: {e}')
+
+    return index
+
+
+def iter_read_pairs(read1_path: str, read2_path: str, chunk_reads: int = CHUNK_READS):
+    """Yield chunks of the read1 and read2 sequences of a fastq pair."""
+
+    def open_fastq(path: str):
+        return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+    with open_fastq(read1_path) as r1_fh, open_fastq(read2_path) as r2_fh:
+        while True:
+            r1_seqs = [line.rstrip() for line in itertools.islice(r1_fh, 1, 4 * chunk_reads, 4)]
+            r2_seqs = [line.rstrip() for line in itertools.islice(r2_fh, 1, 4 * chunk_reads, 4)]
+
+            assert len(r1_seqs) == len(r2_seqs), f'{read1_path} and {read2_path} have a different number of reads. Exit.'
+
+            if not r1_seqs:
+                return
+
+            yield r1_seqs, r2_seqs
+
+
+def get_codes(seqs: list[bytes], length: int) -> np.ndarray:
+    return BASE_CODES[np.frombuffer(b''.join(seq[:length] for seq in seqs), dtype=np.uint8).reshape(-1, length)]
+
+
+def assign_genes(index: TranscriptomeIndex, r2_seqs: list[bytes]) -> np.ndarray:
+    """Return the gene of each read2, -1 for unassigned reads."""
+
+    genes = np.full(len(r2_seqs), -1, dtype=np.int32)
+    lengths = np.array([len(seq) for seq in r2_seqs])
+
+    # Reads are processed by length
+    for length in np.unique(lengths):
+        if length < KMER_LENGTH:
+            continue
+
+        reads = np.flatnonzero(lengths == length)
+        kmers, valid = get_kmers(get_codes([r2_seqs[i] for i in reads], length))
+
+        values = np.full(kmers.shape, NOT_FOUND, dtype=np.int32)
+        values[valid] = index.table.lookup(kmers[valid])
+
+        # All unambiguous k-mers of a read hit the same gene
+        unambiguous = values >= 0
+        gene_min = np.where(unambiguous, values, np.iinfo(np.int32).max).min(axis=1)
+        gene_max = np.where(unambiguous, values, -1).max(axis=1)
+        assigned = (gene_max >= 0) & (gene_min == gene_max)
+
+        genes[reads[assigned]] = gene_max[assigned]
+
+    return genes
+
+
+def count_chunk(index: TranscriptomeIndex, r1_seqs: list[bytes], r2_seqs: list[bytes], umi_length: int) -> tuple[pd.DataFrame, dict]:
+    """Return the reads per molecule (barcode and UMI) and gene of a chunk with the read counts of the chunk."""
+
+    r1_length = BARCODE_LENGTH + umi_length
+    usable = np.array([len(seq) >= r1_length for seq in r1_seqs])
+    r1_seqs = [seq for seq, ok in zip(r1_seqs, usable) if ok]
+    r2_seqs = [seq for seq, ok in zip(r2_seqs, usable) if ok]
+
+    molecules, valid = pack_bases(get_codes(r1_seqs, r1_length)) if r1_seqs else (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool))
+    genes = assign_genes(index, r2_seqs)
+    assigned = valid & (genes >= 0)
+
+    reads = pd.DataFrame({'molecule': molecules[assigned], 'gene': genes[assigned]}).groupby(['molecule', 'gene']).size().rename('reads')
+    stats = {'reads': len(usable), 'valid_barcode_reads': int(valid.sum()), 'assigned_reads': int(assigned.sum())}
+
+    return reads, stats
+
+
+def call_cells(umis_per_barcode: pd.Series, expected_cells: int = EXPECTED_CELLS) -> pd.Index:
+    """Return the cell barcodes with the ordmag method, at least a tenth of the 99th percentile UMI count of the expected cells."""
+
+    if umis_per_barcode.empty:
+        return umis_per_barcode.index
+
+    top = umis_per_barcode.sort_values(ascending=False).values[:expected_cells]
+    threshold = max(1.0, np.percentile(top, 99) / 10)
+
+    return umis_per_barcode.index[umis_per_barcode >= threshold]
+
+
+def write_feature_bc_matrix_h5(path: str, counts: pd.DataFrame, barcodes: list[str], index: TranscriptomeIndex, library_id: str):
+    """Write a 10x HDF5 feature-barcode matrix, counts holds the barcode and gene index and the UMI count."""
+
+    barcode_index = counts['barcode'].to_numpy()
+    counts = counts.iloc[np.lexsort((counts['gene'].to_numpy(), barcode_index))]
+    indptr = np.searchsorted(np.sort(barcode_index), np.arange(len(barcodes) + 1)).astype(np.int64)
+
+    with h5py.File(path, 'w') as f:
+        f.attrs['filetype'] = 'matrix'
+        f.attrs['version'] = 2
+        f.attrs['library_ids'] = np.array([library_id], dtype='S')
+        f.attrs['original_gem_groups'] = np.array([1])
+        f.attrs['chemistry_description'] = 'Single Cell 3\''
+        f.attrs['software_version'] = 'rawdata-processing pseudoalign'
+
+        matrix = f.create_group('matrix')
+        matrix.create_dataset('barcodes', data=np.array(barcodes, dtype='S'), compression='gzip')
+        matrix.create_dataset('data', data=counts['umis'].to_numpy(np.int32), compression='gzip')
+        matrix.create_dataset('indices', data=counts['gene'].to_numpy(np.int64), compression='gzip')
+        matrix.create_dataset('indptr', data=indptr, compression='gzip')
+        matrix.create_dataset('shape', data=np.array([len(index.gene_ids), len(barcodes)], dtype=np.int32))
+
+        features = matrix.create_group('features')
+        features.create_dataset('_all_tag_keys', data=np.array(['genome'], dtype='S'))
+        features.create_dataset('id', data=np.array(index.gene_ids, dtype='S'), compression='gzip')
+        features.create_dataset('name', data=np.array(index.gene_names, dtype='S'), compression='gzip')
+        features.create_dataset('feature_type', data=np.array(['Gene Expression'] * len(index.gene_ids), dtype='S'), compression='gzip')
+        features.create_dataset('genome', data=np.array([index.genome] * len(index.gene_ids), dtype='S'), compression='gzip')
+
+
+class Quantifier:
+    """Quantification engine, writes the outputs of cellranger count to {sc_dataset_name}/outs in the working directory.
+
+    Resources and stages of a run are recorded by the supervisor of the engine.
+
+    Args:
+        num_cores: Number of cores.
+        mem_gb: Memory limit in GB.
+        sample_interval: Seconds between resource samples.
+    """
+
+    name = None
+
+    def __init__(self, num_cores: int, mem_gb: int, sample_interval: float = supervisor.SAMPLE_INTERVAL_SECONDS):
+        self.num_cores = num_cores
+        self.mem_gb = mem_gb
+        self.supervisor = supervisor.Supervisor(self.name, num_cores, mem_gb, sample_interval)
+
+    def resize(self, num_cores: int, mem_gb: int):
+        """Change the cores and memory of the next run."""
+
+        self.num_cores = self.supervisor.num_cores = num_cores
+        self.mem_gb = self.supervisor.mem_gb = mem_gb
+
+    def run(self, sc_dataset_name: str, tx_path: str, fq_dir: str, sample: str, read1_path: str, read2_path: str,
+            chemistry: str | None = None) -> str:
+        """Quantify a fastq pair. Returns the outs directory."""
+
+        raise NotImplementedError
+
+
+class CellrangerQuantifier(Quantifier):
+
+    name = 'cellranger'
+
+    def run(self, sc_dataset_name: str, tx_path: str, fq_dir: str, sample: str, read1_path: str, read2_path: str,
+            chemistry: str | None = None) -> str:
+
+        cellranger_cmd = [
+            'cellranger',
+            'count',
+            f'--id={sc_dataset_name}',
+            f'--transcriptome={tx_path}',
+            '--fastqs=' + fq_dir,
+            '--sample=' + sample,
+            '--create-bam=false',
+            f'--localcores={self.num_cores}',
+            f'--localmem={self.mem_gb}',
+            '--nosecondary'
+        ]
+
+        if chemistry:
+            print(f'Pin chemistry {chemistry} from barcode prescan')
+            cellranger_cmd.append(f'--chemistry={chemistry}')
+
+        # EXEC: Cellranger Pipeline, stages are parsed from the pipestance
+        returncode = self.supervisor.run(cellranger_cmd, pipestance_dir=os.path.join(os.getcwd(), sc_dataset_name))
+        assert returncode == 0, f'cellranger failed with return code {returncode}:\n{self.supervisor.get_output_tail()}\nExit.'
+
+        return os.path.join(os.getcwd(), sc_dataset_name, 'outs')
+
+
+class PseudoalignQuantifier(Quantifier):
+
+    name = 'pseudoalign'
+
+    def run(self, sc_dataset_name: str, tx_path: str, fq_dir: str, sample: str, read1_path: str, read2_path: str,
+            chemistry: str | None = None) -> str:
+
+        with self.supervisor.monitor():
+            return self._quantify(sc_dataset_name, tx_path, sample, read1_path, read2_path)
+
+    def _quantify(self, sc_dataset_name: str, tx_path: str, sample: str, read1_path: str, read2_path: str) -> str:
+
+        outs_dir = os.path.join(os.getcwd(), sc_dataset_name, 'outs')
+        os.makedirs(outs_dir, exist_ok=True)
+
+        with self.supervisor.stage('index'):
+            index = load_index(tx_path)
+
+        chunks = iter_read_pairs(read1_path, read2_path)
+        first_chunk = next(chunks, None)
+        assert first_chunk is not None, f'{read1_path} has no reads. Exit.'
+
+        # UMI length of the chemistry from the read1 length, 12 bp for v3, 10 bp for v2
+        umi_length = min(max(len(seq) for seq in first_chunk[0]) - BARCODE_LENGTH, MAX_UMI_LENGTH)
+        assert umi_length > 0, f'read1 of {read1_path} is shorter than the {BARCODE_LENGTH} bp cell barcode. Exit.'
+
+        start = time.perf_counter()
+        molecule_reads = []
+        stats = {'reads': 0, 'valid_barcode_reads': 0, 'assigned_reads': 0}
+
+        def collect(future):
+            chunk_reads, chunk_stats = future.result()
+            molecule_reads.append(chunk_reads)
+
+            for key, value in chunk_stats.items():
+                stats[key] += value
+
+        # Chunks are counted in parallel in a bounded window
+        with self.supervisor.stage('pseudoalign'), ThreadPoolExecutor(max_workers=self.num_cores) as executor:
+            pending = deque()
+
+            for r1_seqs, r2_seqs in itertools.chain([first_chunk], chunks):
+                pending.append(executor.submit(count_chunk, index, r1_seqs, r2_seqs, umi_length))
+
+                if len(pending) >= 2 * self.num_cores:
+                    collect(pending.popleft())
+
+            while pending:
+                collect(pending.popleft())
+
+        print(f"Pseudoaligned {stats['reads']} reads in {time.perf_counter() - start:.1f} s, "
+              f"{stats['assigned_reads'] / max(stats['reads'], 1):.1%} assigned to a gene")
+
+        with self.supervisor.stage('collapse'):
+            # UMI collapsing, a molecule of several genes counts for the gene with most reads, ties are dropped
+            reads = pd.concat(molecule_reads).groupby(level=['molecule', 'gene']).sum().reset_index()
+            reads = reads[reads['reads'] == reads.groupby('molecule')['reads'].transform('max')]
+            reads = reads[~reads['molecule'].duplicated(keep=False)]
+
+            reads['barcode'] = reads['molecule'].to_numpy(np.uint64) >> np.uint64(2 * umi_length)
+            umis = reads.groupby(['barcode', 'gene']).size().rename('umis').reset_index()
+
+            cells = call_cells(umis.groupby('barcode')['umis'].sum())
+            stats['cell_reads'] = int(reads.loc[reads['barcode'].isin(cells), 'reads'].sum())
+            barcodes = [f'{barcode}-1' for barcode in unpack_bases(cells.to_numpy(np.uint64), BARCODE_LENGTH)]
+
+            # Barcodes in lexicographic order as cellranger
+            order = np.argsort(barcodes)
+            barcodes = [barcodes[i] for i in order]
+            cell_umis = umis[umis['barcode'].isin(cells)].copy()
+            cell_umis['barcode'] = pd.Series(np.argsort(order), index=cells).loc[cell_umis['barcode']].to_numpy()
+
+        with self.supervisor.stage('write'):
+            write_feature_bc_matrix_h5(os.path.join(outs_dir, FILTERED_MATRIX_NAME), cell_umis, barcodes, index, sample)
+
+            metrics = self.get_metrics(stats, reads, cell_umis, len(barcodes), len(index.gene_ids))
+            metrics.to_csv(os.path.join(outs_dir, METRICS_SUMMARY_NAME), index=False)
+
+        print(f"Called {len(barcodes)} cells with a median of {metrics['Median Genes per Cell'].values[0]} genes")
+
+        return outs_dir
+
+    @staticmethod
+    def get_metrics(stats: dict, reads: pd.DataFrame, cell_umis: pd.DataFrame, num_cells: int, num_genes: int) -> pd.DataFrame:
+        """Return the metrics summary with the columns and number formats of cellranger."""
+
+        genes_per_cell = np.zeros(num_cells, dtype=np.int64)
+        umis_per_cell = np.zeros(num_cells, dtype=np.int64)
+        np.add.at(genes_per_cell, cell_umis['barcode'].to_numpy(np.int64), 1)
+        np.add.at(umis_per_cell, cell_umis['barcode'].to_numpy(np.int64), cell_umis['umis'].to_numpy(np.int64))
+
+        total_reads = max(stats['reads'], 1)
+        assigned_reads = max(stats['assigned_reads'], 1)
+
+        def percent(value: float) -> str:
+            return f'{value:.1%}'
+
+        metrics = {
+            'Estimated Number of Cells': f'{num_cells:,}',
+            'Mean Reads per Cell': f'{stats["reads"] // max(num_cells, 1):,}',
+            'Median Genes per Cell': f'{int(np.median(genes_per_cell)) if num_cells else 0:,}',
+            'Number of Reads': f'{stats["reads"]:,}',
+            'Valid Barcodes': percent(stats['valid_barcode_reads'] / total_reads),
+            'Sequencing Saturation': percent(1 - len(reads) / assigned_reads),
+            'Reads Mapped Confidently to Transcriptome': percent(stats['assigned_reads'] / total_reads),
+            'Fraction Reads in Cells': percent(stats['cell_reads'] / assigned_reads),
+            'Total Genes Detected': f'{cell_umis["gene"].nunique():,}',
+            'Median UMI Counts per Cell': f'{int(np.median(umis_per_cell)) if num_cells else 0:,}'
+        }
+
+        return pd.DataFrame([metrics])
+
+
+QUANTIFIERS = {quantifier.name: quantifier for quantifier in (CellrangerQuantifier, PseudoalignQuantifier)}
+
+
+def get_quantifier(name: str, num_cores: int, mem_gb: int, sample_interval: float = supervisor.SAMPLE_INTERVAL_SECONDS) -> Quantifier:
+    assert name in QUANTIFIERS, f'Invalid quantifier {name}, use one of {", ".join(QUANTIFIERS)}. Exit.'
+
+    return QUANTIFIERS[name](num_cores, mem_gb, sample_interval)
@@ -0,0 +1,337 @@
+# case-scrnaseq/rawdata-processing/refcache.py
+
+"""
+Module for the persistent local cache of transcriptome references.
+
+A reference is an S3 folder (prefix) of files or a packed archive (.refpack,
+see refpack.py). Cache entries are keyed by the bucket, the prefix and the
+key, size and ETag of every object below the prefix (or of the archive), i.e.
+a changed reference in S3 is a new entry. An entry is downloaded into a
+temporary directory, checked against the object sizes (and MD5 for
+single-part uploads, CRC32 of the chunks of an archive) and renamed into
+place, a partially downloaded reference is never visible.
+
+Each entry holds a manifest of its S3 objects with a checksum of the listing
+and of its local files. A hit is accepted if the checksum matches the entry
+key and all local files have their expected size, a corrupted entry is downloaded again.
+
+The cache is shared by concurrent runs on one host (or a shared file system):
+an exclusive lock per entry ensures that a reference is downloaded once,
+runs which use an entry hold a shared lock on a separate in-use lock file,
+taken before the exclusive lock is released. The cache is bounded in size,
+least recently used entries which are not in use are evicted before a new
+entry is downloaded, eviction takes both locks of an entry.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from pydantic import BaseModel
+
+import refpack
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+MANIFEST_NAME = '.reference_manifest.json'
+LOCK_SUFFIX = '.lock'
+IN_USE_SUFFIX = '.inuse'
+TEMP_PREFIX = '.tmp-'
+
+# Objects up to this size are verified with their MD5 ETag
+MD5_CHECK_MAX_SIZE = 1024 * 1024 * 1024
+
+# DATA CLASSES
+
+class ReferenceFile(BaseModel):
+    key: str # Relative to the prefix
+    size: int
+    etag: str
+
+class ReferenceManifest(BaseModel):
+    s3_bucket: str
+    s3_prefix: str
+    checksum: str # sha256 of the listing, part of the entry name
+    files: list[ReferenceFile] # S3 objects
+    local_files: dict[str, int] = {} # Relative path and size of the local files
+    created: float
+
+# METHODS
+
+def get_listing_checksum(s3_bucket: str, s3_prefix: str, files: list[ReferenceFile]) -> str:
+    listing = json.dumps([s3_bucket, s3_prefix] + [[f.key, f.size, f.etag] for f in sorted(files, key=lambda f: f.key)])
+
+    return hashlib.sha256(listing.encode()).hexdigest()
+
+
+def list_reference_files(s3_client, s3_bucket: str, s3_prefix: str) -> list[ReferenceFile]:
+    """List the objects below a prefix, folder markers are skipped. A packed archive is a single object."""
+
+    if refpack.is_pack_key(s3_prefix):
+        res = s3_client.head_object(Bucket=s3_bucket, Key=s3_prefix)
+        return [ReferenceFile(key=os.path.basename(s3_prefix), size=res['ContentLength'], etag=res['ETag'].strip('"'))]
+
+    prefix = s3_prefix.rstrip('/') + '/'
+    files = []
+
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('/'):
+                files.append(ReferenceFile(key=obj['Key'][len(prefix):], size=obj['Size'], etag=obj['ETag'].strip('"')))
+
+    return files
+
+
+def download_reference_file(s3_client, s3_bucket: str, s3_prefix: str, f: ReferenceFile, dest_dir: str, throttle=None):
+    """Download a file of a reference folder, checked against its size and MD5 ETag.
+
+    throttle is called with the number of transferred bytes, e.g. for a shared bandwidth budget.
+    """
+
+    path = os.path.join(dest_dir, f.key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    s3_client.download_file(s3_bucket, s3_prefix.rstrip('/') + '/' + f.key, path, Callback=throttle)
+
+    if os.path.getsize(path) != f.size:
+        raise ValueError(f'Reference file {f.key} has {os.path.getsize(path)} bytes, expected {f.size}')
+
+    # ETags of single-part uploads are the MD5 of the object
+    if '-' not in f.etag and f.size <= MD5_CHECK_MAX_SIZE:
+        md5 = hashlib.md5()
+
+        with open(path, 'rb') as fh:
+            while chunk := fh.read(8 * 1024 * 1024):
+                md5.update(chunk)
+
+        if md5.hexdigest() != f.etag:
+            raise ValueError(f'Reference file {f.key} does not match its MD5 ETag')
+
+
+def download_reference(s3_client, s3_bucket: str, s3_prefix: str, dest_dir: str, workers: int = 8, throttle=None) -> str:
+    """Download a reference folder or archive into dest_dir without the cache. Returns dest_dir."""
+
+    s3_prefix = s3_prefix.rstrip('/')
+
+    if refpack.is_pack_key(s3_prefix):
+        refpack.unpack(refpack.PackReader(s3_bucket=s3_bucket, s3_key=s3_prefix, s3_client=s3_client), dest_dir, workers,
+                       throttle=throttle)
+        return dest_dir
+
+    files = list_reference_files(s3_client, s3_bucket, s3_prefix)
+    assert files, f'No reference files found in bucket {s3_bucket} and key {s3_prefix}'
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda f: download_reference_file(s3_client, s3_bucket, s3_prefix, f, dest_dir, throttle), files))
+
+    return dest_dir
+
+
+@contextlib.contextmanager
+def file_lock(path: str, mode: int):
+    """Hold a flock on a lock file, mode is fcntl.LOCK_SH or fcntl.LOCK_EX."""
+
+    with open(path, 'a') as fh:
+        fcntl.flock(fh, mode)
+
+        try:
+            yield fh
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+class ReferenceCache:
+    """Size-bounded LRU cache of S3 reference folders and archives in a local directory.
+
+    Args:
+        cache_dir: Cache directory, e.g. on a volume which outlives the task.
+        max_size_gb: Size limit of all entries, 0 for no limit.
+        s3_client: boto3 S3 client.
+        download_workers: Number of files (ranges of an archive) downloaded in parallel.
+        throttle: Called with the number of downloaded bytes, e.g. for a shared bandwidth budget.
+    """
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 0, s3_client=None, download_workers: int = 8, throttle=None):
+        if s3_client is None:
+            s3_client = boto3.client('s3')
+
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.s3_client = s3_client
+        self.download_workers = download_workers
+        self.throttle = throttle
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextlib.contextmanager
+    def open(self, s3_bucket: str, s3_prefix: str):
+        """Yield the local directory of a reference, the reference is downloaded on a miss.
+
+        The entry is not evicted while the context is open.
+        """
+
+        s3_prefix = s3_prefix.rstrip('/')
+        files = list_reference_files(self.s3_client, s3_bucket, s3_prefix)
+        assert files, f'No reference files found in bucket {s3_bucket} and key {s3_prefix}'
+
+        checksum = get_listing_checksum(s3_bucket, s3_prefix, files)
+        entry = f'{os.path.basename(s3_prefix).removesuffix(refpack.PACK_SUFFIX)}-{checksum[:16]}'
+        entry_dir = os.path.join(self.cache_dir, entry)
+        lock_path = os.path.join(self.cache_dir, entry + LOCK_SUFFIX)
+        in_use_path = os.path.join(self.cache_dir, entry + IN_USE_SUFFIX)
+
+        with contextlib.ExitStack() as stack:
+            # Concurrent runs wait for the run which downloads the entry
+            with file_lock(lock_path, fcntl.LOCK_EX):
+                if self._check_entry(entry_dir, checksum):
+                    print(f'Reference cache hit for {s3_prefix} in {entry_dir}')
+                else:
+                    print(f'Reference cache miss for {s3_prefix}, download {len(files)} files '
+                          f'({sum(f.size for f in files) / 1024 ** 3:.1f} GB) to {entry_dir}')
+                    self._populate(entry_dir, ReferenceManifest(s3_bucket=s3_bucket, s3_prefix=s3_prefix, checksum=checksum,
+                                                                files=files, created=time.time()))
+
+                # Last use of the LRU
+                os.utime(os.path.join(entry_dir, MANIFEST_NAME))
+
+                # The entry is in use before the exclusive lock is released, eviction needs both locks
+                stack.enter_context(file_lock(in_use_path, fcntl.LOCK_SH))
+
+            yield entry_dir
+
+    def entries(self) -> list[tuple[str, float, int]]:
+        """Return (entry, last use, size) of the cache entries, least recently used first."""
+
+        entries = []
+
+        for entry in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.cache_dir, entry, MANIFEST_NAME)
+
+            if entry.startswith(TEMP_PREFIX) or not os.path.isfile(manifest_path):
+                continue
+
+            # Entries can be evicted by a concurrent run
+            try:
+                with open(manifest_path) as fh:
+                    size = sum(ReferenceManifest(**json.load(fh)).local_files.values())
+                entries.append((entry, os.path.getmtime(manifest_path), size))
+            except (OSError, ValueError):
+                continue
+
+        return sorted(entries, key=lambda e: e[1])
+
+    def evict(self, required_size: int, keep: str | None = None) -> list[str]:
+        """Evict least recently used entries until required_size bytes fit into the cache. Returns the evicted entries.
+
+        Entries in use by other runs are skipped.
+        """
+
+        if not self.max_size:
+            return []
+
+        entries = [e for e in self.entries() if e[0] != keep]
+        total_size = sum(size for _, _, size in entries)
+        evicted = []
+
+        for entry, _, size in entries:
+            if total_size + required_size <= self.max_size:
+                break
+
+            with open(os.path.join(self.cache_dir, entry + LOCK_SUFFIX), 'a') as lock_fh, \
+                 open(os.path.join(self.cache_dir, entry + IN_USE_SUFFIX), 'a') as in_use_fh:
+
+                # Skip entries which are downloaded, opened or used by other runs
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(in_use_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f'WARNING Reference {entry} is in use and not evicted.')
+                    continue
+
+                print(f'Evict reference {entry} from cache ({size / 1024 ** 3:.1f} GB)')
+                shutil.rmtree(os.path.join(self.cache_dir, entry))
+                total_size -= size
+                evicted.append(entry)
+
+        if total_size + required_size > self.max_size:
+            print(f'WARNING Reference cache exceeds {self.max_size / 1024 ** 3:.1f} GB, entries in use cannot be evicted.')
+
+        return evicted
+
+    def _check_entry(self, entry_dir: str, checksum: str) -> bool:
+        manifest_path = os.path.join(entry_dir, MANIFEST_NAME)
+
+        if not os.path.isfile(manifest_path):
+            return False
+
+        try:
+            with open(manifest_path) as fh:
+                manifest = ReferenceManifest(**json.load(fh))
+
+        except ValueError:
+            print(f'WARNING Corrupted reference manifest in {entry_dir}.')
+            return False
+
+        if manifest.checksum != checksum or get_listing_checksum(manifest.s3_bucket, manifest.s3_prefix, manifest.files) != checksum:
+            print(f'WARNING Reference manifest checksum mismatch in {entry_dir}.')
+            return False
+
+        for key, size in manifest.local_files.items():
+            path = os.path.join(entry_dir, key)
+
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                print(f'WARNING Reference file {key} in {entry_dir} is missing or has a wrong size.')
+                return False
+
+        return True
+
+    def _populate(self, entry_dir: str, manifest: ReferenceManifest):
+        entry = os.path.basename(entry_dir)
+        temp_dir = os.path.join(self.cache_dir, TEMP_PREFIX + entry)
+
+        # Leftovers of a crashed download or a corrupted entry
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+        # The size of an archive is the unpacked size in its index
+        if refpack.is_pack_key(manifest.s3_prefix):
+            reader = refpack.PackReader(s3_bucket=manifest.s3_bucket, s3_key=manifest.s3_prefix, s3_client=self.s3_client)
+            index = reader.read_index()
+            manifest.local_files = {f.path: f.size for f in index.files}
+        else:
+            manifest.local_files = {f.key: f.size for f in manifest.files}
+
+        self.evict(sum(manifest.local_files.values()), keep=entry)
+
+        os.makedirs(temp_dir)
+
+        start = time.perf_counter()
+
+        try:
+            if refpack.is_pack_key(manifest.s3_prefix):
+                refpack.unpack(reader, temp_dir, workers=self.download_workers, index=index, throttle=self.throttle)
+            else:
+                with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+                    list(executor.map(lambda f: download_reference_file(self.s3_client, manifest.s3_bucket, manifest.s3_prefix, f,
+                                                                        temp_dir, self.throttle), manifest.files))
+
+            with open(os.path.join(temp_dir, MANIFEST_NAME), 'w') as fh:
+                fh.write(manifest.model_dump_json())
+
+            os.rename(temp_dir, entry_dir)
+
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        seconds = max(time.perf_counter() - start, 1e-6)
+        size_mb = sum(manifest.local_files.values()) / (1024 * 1024)
+        print(f'Downloaded reference to cache in {seconds:.1f} s ({size_mb / seconds:.1f} MB/s)')
@@ -0,0 +1,343 @@
+# case-scrnaseq/rawdata-processing/refpack.py
+
+"""
+Module for packed reference archives, a single-object format for fast staging.
+
+A cellranger reference is a directory of many files, from small annotation
+files to STAR index files of several GB. Downloaded object by object, the
+request latency of the small files and the throughput of a single stream per
+large file dominate the staging time. A refpack archive stores the directory
+as one object which is staged with parallel ranged requests.
+
+Layout of a .refpack archive:
+
+- Files in directory order, each split into chunks of chunk_size bytes.
+  Chunks are zlib compressed independently (stored if compression does not
+  pay off) and carry a CRC32 of their uncompressed data.
+- The index, zlib compressed JSON with the directories and files and the
+  offset, sizes, CRC32 and method of each chunk.
+- A fixed size trailer with the offset and size of the index.
+
+The stager reads the trailer and the index with two small ranged requests.
+Consecutive chunks are grouped into ranges of about range_size bytes, small
+files share a request. Ranges are fetched in parallel and each chunk is
+decompressed and written to its file offset as it streams in, only one chunk
+per worker is held in memory.
+
+Usage:
+    python refpack.py pack refdata-gex-GRCh38-2024-A refdata-gex-GRCh38-2024-A.refpack --s3-bucket bucket --s3-key genomes/refdata-gex-GRCh38-2024-A.refpack
+    python refpack.py unpack refdata-gex-GRCh38-2024-A.refpack refdata-gex-GRCh38-2024-A
+"""
+
+import argparse
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from pydantic import BaseModel
+
+import multipart
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+PACK_SUFFIX = '.refpack'
+
+# Index offset, index size, magic
+TRAILER = struct.Struct('<QQ8s')
+TRAILER_MAGIC = b'REFPACK1'
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_RANGE_SIZE = 64 * 1024 * 1024
+
+METHOD_STORED = 0
+METHOD_ZLIB = 1
+
+# Chunks are stored if compression saves less
+MIN_COMPRESSION_SAVING = 0.05
+
+# Columns of a chunk in the index
+CHUNK_OFFSET, CHUNK_COMPRESSED_SIZE, CHUNK_SIZE, CHUNK_CRC32, CHUNK_METHOD = range(5)
+
+# DATA CLASSES
+
+class PackedFile(BaseModel):
+    path: str # Relative to the reference directory
+    size: int
+    mode: int
+    chunks: list[list[int]] = [] # offset, compressed size, size, crc32, method
+
+class PackIndex(BaseModel):
+    chunk_size: int
+    dirs: list[str] = []
+    files: list[PackedFile] = []
+
+# METHODS
+
+def is_pack_key(s3_key: str) -> bool:
+    return s3_key.endswith(PACK_SUFFIX)
+
+
+def compress_chunk(data: bytes, level: int) -> tuple[bytes, int]:
+    compressed = zlib.compress(data, level)
+
+    if len(compressed) > len(data) * (1 - MIN_COMPRESSION_SAVING):
+        return data, METHOD_STORED
+
+    return compressed, METHOD_ZLIB
+
+
+def decompress_chunk(data: bytes, chunk: list) -> bytes:
+    out = zlib.decompress(data) if chunk[CHUNK_METHOD] == METHOD_ZLIB else data
+
+    if len(out) != chunk[CHUNK_SIZE] or zlib.crc32(out) != chunk[CHUNK_CRC32]:
+        raise ValueError(f'Corrupted chunk at offset {chunk[CHUNK_OFFSET]}')
+
+    return out
+
+
+def iter_reference_files(ref_dir: str):
+    """Yield the directories and files of a reference directory (relative paths) in a stable order."""
+
+    for root, dirs, files in os.walk(ref_dir):
+        dirs.sort()
+
+        yield 'dir', os.path.relpath(root, ref_dir)
+
+        for f in sorted(files):
+            yield 'file', os.path.relpath(os.path.join(root, f), ref_dir)
+
+
+def pack(ref_dir: str, output_path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, level: int = 1, threads: int | None = None) -> PackIndex:
+    """Pack a reference directory into a refpack archive. Chunks are compressed in parallel and written in order."""
+
+    threads = threads or os.cpu_count()
+    index = PackIndex(chunk_size=chunk_size)
+    offset = 0
+
+    with open(output_path, 'wb') as out_fh, ThreadPoolExecutor(max_workers=threads) as executor:
+        for kind, path in iter_reference_files(ref_dir):
+
+            if kind == 'dir':
+                if path != '.':
+                    index.dirs.append(path)
+                continue
+
+            full_path = os.path.join(ref_dir, path)
+            packed_file = PackedFile(path=path, size=os.path.getsize(full_path), mode=os.stat(full_path).st_mode & 0o777)
+            pending = deque()
+
+            def write_next():
+                nonlocal offset
+                data, future = pending.popleft()
+                compressed, method = future.result()
+                out_fh.write(compressed)
+                packed_file.chunks.append([offset, len(compressed), len(data), zlib.crc32(data), method])
+                offset += len(compressed)
+
+            # Bounded window of chunks in compression
+            with open(full_path, 'rb') as in_fh:
+                while data := in_fh.read(chunk_size):
+                    pending.append((data, executor.submit(compress_chunk, data, level)))
+
+                    if len(pending) >= 2 * threads:
+                        write_next()
+
+            while pending:
+                write_next()
+
+            index.files.append(packed_file)
+
+        index_data = zlib.compress(index.model_dump_json().encode())
+        out_fh.write(index_data)
+        out_fh.write(TRAILER.pack(offset, len(index_data), TRAILER_MAGIC))
+
+    return index
+
+
+def parse_trailer(data: bytes) -> tuple[int, int]:
+    index_offset, index_size, magic = TRAILER.unpack(data)
+    assert magic == TRAILER_MAGIC, 'Not a refpack archive'
+
+    return index_offset, index_size
+
+
+def parse_index(data: bytes) -> PackIndex:
+    return PackIndex(**json.loads(zlib.decompress(data)))
+
+
+def get_ranges(index: PackIndex, range_size: int) -> list[list[tuple[PackedFile, int, list]]]:
+    """Group the chunks of all files into ranges of consecutive chunks of about range_size bytes.
+
+    Returns lists of (file, file offset, chunk).
+    """
+
+    ranges = []
+    current = []
+    current_size = 0
+
+    for packed_file in index.files:
+        for i, chunk in enumerate(packed_file.chunks):
+            if current and current_size + chunk[CHUNK_COMPRESSED_SIZE] > range_size:
+                ranges.append(current)
+                current, current_size = [], 0
+
+            current.append((packed_file, i * index.chunk_size, chunk))
+            current_size += chunk[CHUNK_COMPRESSED_SIZE]
+
+    if current:
+        ranges.append(current)
+
+    return ranges
+
+
+class PackReader:
+    """Ranged reads of a refpack archive, either a local file or an S3 object."""
+
+    def __init__(self, local_path: str | None = None, s3_bucket: str | None = None, s3_key: str | None = None, s3_client=None):
+        assert local_path or (s3_bucket and s3_key), 'Local path or S3 bucket and key required'
+
+        if s3_bucket and s3_client is None:
+            s3_client = boto3.client('s3')
+
+        self.local_path = local_path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.s3_client = s3_client
+
+    def size(self) -> int:
+        if self.local_path:
+            return os.path.getsize(self.local_path)
+
+        return self.s3_client.head_object(Bucket=self.s3_bucket, Key=self.s3_key)['ContentLength']
+
+    def open_range(self, offset: int, length: int):
+        """Return a readable stream of length bytes at offset."""
+
+        if self.local_path:
+            fh = open(self.local_path, 'rb')
+            fh.seek(offset)
+            return fh
+
+        res = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key, Range=f'bytes={offset}-{offset + length - 1}')
+
+        return res['Body']
+
+    def read_range(self, offset: int, length: int) -> bytes:
+        fh = self.open_range(offset, length)
+
+        try:
+            return fh.read(length)
+        finally:
+            fh.close()
+
+    def read_index(self) -> PackIndex:
+        size = self.size()
+        index_offset, index_size = parse_trailer(self.read_range(size - TRAILER.size, TRAILER.size))
+
+        return parse_index(self.read_range(index_offset, index_size))
+
+
+def unpack(reader: PackReader, dest_dir: str, workers: int = 16, range_size: int = DEFAULT_RANGE_SIZE,
+           index: PackIndex | None = None, throttle=None) -> PackIndex:
+    """Unpack a refpack archive into dest_dir with parallel ranged reads. The index is read if not given.
+
+    throttle is called with the number of bytes of each read chunk, e.g. for a shared bandwidth budget.
+    """
+
+    if index is None:
+        index = reader.read_index()
+
+    for path in index.dirs:
+        os.makedirs(os.path.join(dest_dir, path), exist_ok=True)
+
+    # Files are created at their final size, chunks are written to their offsets in any order
+    for packed_file in index.files:
+        path = os.path.join(dest_dir, packed_file.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as fh:
+            fh.truncate(packed_file.size)
+        os.chmod(path, packed_file.mode)
+
+    def fetch_range(chunks: list):
+        first = chunks[0][2]
+        last = chunks[-1][2]
+        fh = reader.open_range(first[CHUNK_OFFSET], last[CHUNK_OFFSET] + last[CHUNK_COMPRESSED_SIZE] - first[CHUNK_OFFSET])
+
+        try:
+            for packed_file, file_offset, chunk in chunks:
+                data = fh.read(chunk[CHUNK_COMPRESSED_SIZE])
+
+                if throttle:
+                    throttle(len(data))
+
+                data = decompress_chunk(data, chunk)
+                fd = os.open(os.path.join(dest_dir, packed_file.path), os.O_WRONLY)
+
+                try:
+                    os.pwrite(fd, data, file_offset)
+                finally:
+                    os.close(fd)
+        finally:
+            fh.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch_range, get_ranges(index, range_size)))
+
+    return index
+
+
+def unpack_s3(s3_bucket: str, s3_key: str, dest_dir: str, s3_client=None, workers: int = 16,
+              range_size: int = DEFAULT_RANGE_SIZE) -> PackIndex:
+    """Stage a refpack archive from S3 into dest_dir. Returns the index of the archive."""
+
+    start = time.perf_counter()
+    index = unpack(PackReader(s3_bucket=s3_bucket, s3_key=s3_key, s3_client=s3_client), dest_dir, workers, range_size)
+
+    seconds = max(time.perf_counter() - start, 1e-6)
+    size_mb = sum(f.size for f in index.files) / (1024 * 1024)
+    print(f'Unpacked {len(index.files)} files ({size_mb:.1f} MB) of {s3_key} in {seconds:.1f} s ({size_mb / seconds:.1f} MB/s)')
+
+    return index
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack and unpack reference directories')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    pack_parser = subparsers.add_parser('pack', help='Pack a reference directory')
+    pack_parser.add_argument('ref_dir', help='Reference directory, e.g. a cellranger reference')
+    pack_parser.add_argument('output', help='Output archive (.refpack)')
+    pack_parser.add_argument('--chunk-size-mb', dest='chunk_size_mb', type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024), help='Chunk size')
+    pack_parser.add_argument('--level', dest='level', type=int, default=1, help='zlib compression level')
+    pack_parser.add_argument('--s3-bucket', dest='s3_bucket', default=None, help='Upload the archive to this bucket')
+    pack_parser.add_argument('--s3-key', dest='s3_key', default=None, help='Key of the uploaded archive')
+
+    unpack_parser = subparsers.add_parser('unpack', help='Unpack a local archive')
+    unpack_parser.add_argument('archive', help='Archive (.refpack)')
+    unpack_parser.add_argument('dest_dir', help='Output directory')
+
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        assert args.output.endswith(PACK_SUFFIX), f'Archive must end with {PACK_SUFFIX}'
+
+        index = pack(args.ref_dir, args.output, args.chunk_size_mb * 1024 * 1024, args.level)
+        size = sum(f.size for f in index.files)
+        print(f'Packed {len(index.files)} files of {size / (1024 * 1024):.1f} MB into {args.output} '
+              f'({os.path.getsize(args.output) / (1024 * 1024):.1f} MB)')
+
+        if args.s3_bucket:
+            multipart.upload_file(args.output, args.s3_bucket, args.s3_key or os.path.basename(args.output))
+
+    else:
+        index = unpack(PackReader(local_path=args.archive), args.dest_dir)
+        print(f'Unpacked {len(index.files)} files to {args.dest_dir}')
@@ -0,0 +1,316 @@
+# case-scrnaseq/rawdata-processing/sizing.py
+
+"""
+Module for the sizing of the quantification from the run history.
+
+The peak RSS and the peak CPU cores of past runs (run_summary of the
+scrnaseq datasets) are fitted by least squares to the fastq size, the number
+of reads and an offset per transcriptome. A prediction adds a margin from
+the residuals of the fit and is rounded up to a Fargate task size, which
+leaves the memory overhead of the container next to cellranger.
+
+The model is a JSON file with one coefficient per feature. rawdata-processing
+applies it within the resources of its task, the launch Lambda reads the same
+file to override the task size, see awscdk/lambda/lambda_put_ecs_task.py.
+The Lambda has its own copy of the prediction, check compares both over a
+range of fastq sizes.
+
+Usage:
+    python sizing.py fit --backend-url https://.../api_v1/scrnaseq_datasets --output model.json --s3-bucket bucket --s3-key key
+    python sizing.py predict model.json --fastq-size-gb 40 --transcriptome refdata-gex-GRCh38-2020-A
+    python sizing.py check model.json
+"""
+
+import argparse
+import datetime
+import importlib.util
+import math
+import os
+
+import boto3
+import numpy as np
+import requests
+from requests.auth import HTTPBasicAuth
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+FEATURES = ('intercept', 'fastq_gb', 'reads_m')
+TRANSCRIPTOME_PREFIX = 'transcriptome:'
+
+# A fit needs more records than coefficients
+MIN_RECORDS = 5
+
+# Penalty of the coefficients except the intercept, features are in GB and millions of reads
+RIDGE_PENALTY = 1.0
+
+# Quantile of the residuals added to a prediction
+MARGIN_QUANTILE = 0.95
+MEMORY_HEADROOM = 1.1
+
+# Compressed size of a read pair, used if the history has no read counts
+DEFAULT_BYTES_PER_READ_PAIR = 100
+
+# Memory of the task not available to cellranger, as in the CDK stack
+OVERHEAD_GB = 2
+
+# Fargate vCPUs with min, max and step of the memory in GB
+FARGATE_SIZES = ((1, 2, 8, 1), (2, 4, 16, 1), (4, 8, 30, 1), (8, 16, 60, 4), (16, 32, 120, 8))
+
+# Launch Lambda with a copy of the prediction
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'awscdk', 'lambda', 'lambda_put_ecs_task.py')
+
+# Fastq sizes (GB) and quick-look read pairs of the check
+CHECK_SIZES_GB = tuple(round(0.25 * 1.05 ** i, 3) for i in range(180))
+CHECK_QUICK_LOOK_READS = (None, 2_000_000, 20_000_000)
+
+# DATA CLASSES
+
+class RunRecord(BaseModel):
+    transcriptome: str
+    fastq_size_gb: float
+    num_reads: int
+    peak_rss_gb: float
+    peak_cpu_cores: float
+
+class SizingModel(BaseModel):
+    engine: str
+    created: str
+    num_records: int
+    default_transcriptome: str # Reference of the transcriptome offsets
+    bytes_per_read_pair: float
+    memory_coefficients: dict[str, float] # Peak RSS in GB
+    memory_margin_gb: float
+    cores_coefficients: dict[str, float]
+    cores_margin: float
+
+class Resources(BaseModel):
+    num_cores: int # Cores of cellranger, the vCPUs of the task
+    mem_gb: int # Memory of cellranger
+    task_cpu: str # Fargate CPU units
+    task_memory: str # Fargate memory in MiB
+    predicted_rss_gb: float
+    predicted_cpu_cores: float
+
+# METHODS
+
+def get_records(datasets: list[dict], engine: str = 'cellranger') -> list[RunRecord]:
+    """Return the run records of scrnaseq datasets (backend JSON) of an engine with a run summary."""
+
+    records = []
+
+    for dataset in datasets:
+        summary = dataset.get('run_summary')
+
+        if not summary or summary.get('engine') != engine or summary.get('fastq_size_mb') is None or summary.get('returncode') not in (0, None):
+            continue
+
+        records.append(RunRecord(
+            transcriptome=dataset['transcriptome'],
+            fastq_size_gb=summary['fastq_size_mb'] / 1024,
+            num_reads=dataset['total_number_reads'],
+            peak_rss_gb=summary['peak_rss_mb'] / 1024,
+            peak_cpu_cores=summary['peak_cpu_cores']
+        ))
+
+    return records
+
+
+def get_features(fastq_size_gb: float, num_reads: int, transcriptome: str) -> dict[str, float]:
+    return {'intercept': 1.0, 'fastq_gb': fastq_size_gb, 'reads_m': num_reads / 1e6, TRANSCRIPTOME_PREFIX + transcriptome: 1.0}
+
+
+def fit_coefficients(x: np.ndarray, y: np.ndarray, names: list[str]) -> tuple[dict[str, float], float]:
+    """Ridge regularised least squares fit. Returns the coefficients by feature and the margin from the residuals."""
+
+    # Fastq size and reads are nearly collinear, the penalty keeps their coefficients small
+    penalty = np.full(x.shape[1], RIDGE_PENALTY)
+    penalty[0] = 0
+
+    coefficients = np.linalg.solve(x.T @ x + np.diag(penalty), x.T @ y)
+    residuals = y - x @ coefficients
+    margin = max(float(np.quantile(residuals, MARGIN_QUANTILE)), 0.0)
+
+    return {name: round(float(value), 6) for name, value in zip(names, coefficients)}, round(margin, 3)
+
+
+def fit(records: list[RunRecord], engine: str = 'cellranger') -> SizingModel:
+    """Fit a sizing model to run records."""
+
+    if len(records) < MIN_RECORDS:
+        raise ValueError(f'{len(records)} run records, at least {MIN_RECORDS} are required for a fit. Exit.')
+
+    transcriptomes = [record.transcriptome for record in records]
+    default_transcriptome = max(set(transcriptomes), key=transcriptomes.count)
+
+    # Offsets of the other transcriptomes to the most frequent one
+    names = list(FEATURES) + sorted(TRANSCRIPTOME_PREFIX + t for t in set(transcriptomes) if t != default_transcriptome)
+    x = np.array([[get_features(r.fastq_size_gb, r.num_reads, r.transcriptome).get(name, 0.0) for name in names] for r in records])
+
+    memory_coefficients, memory_margin_gb = fit_coefficients(x, np.array([r.peak_rss_gb for r in records]), names)
+    cores_coefficients, cores_margin = fit_coefficients(x, np.array([r.peak_cpu_cores for r in records]), names)
+
+    sizes = [r.fastq_size_gb * 1024 ** 3 / r.num_reads for r in records if r.num_reads]
+    bytes_per_read_pair = float(np.median(sizes)) if sizes else DEFAULT_BYTES_PER_READ_PAIR
+
+    return SizingModel(
+        engine=engine,
+        created=datetime.datetime.now().isoformat(timespec='seconds'),
+        num_records=len(records),
+        default_transcriptome=default_transcriptome,
+        bytes_per_read_pair=round(bytes_per_read_pair, 1),
+        memory_coefficients=memory_coefficients,
+        memory_margin_gb=memory_margin_gb,
+        cores_coefficients=cores_coefficients,
+        cores_margin=cores_margin
+    )
+
+
+def get_task_size(num_cores: int, mem_gb: int) -> tuple[int, int]:
+    """Return the smallest Fargate size (vCPUs, memory GB) with num_cores and mem_gb of task memory, capped at the largest size."""
+
+    max_vcpus, _, max_gb, _ = FARGATE_SIZES[-1]
+
+    if num_cores > max_vcpus or mem_gb > max_gb:
+        print(f'WARNING: {num_cores} cores and {mem_gb} GB exceed the largest task size of {max_vcpus} vCPUs and {max_gb} GB')
+
+    num_cores, mem_gb = min(num_cores, max_vcpus), min(mem_gb, max_gb)
+
+    for vcpus, min_gb, max_gb, step_gb in FARGATE_SIZES:
+        if vcpus >= num_cores and max_gb >= mem_gb:
+            return vcpus, max(min_gb, math.ceil(mem_gb / step_gb) * step_gb)
+
+
+def predict(model: SizingModel, fastq_size_gb: float, num_reads: int | None = None, transcriptome: str | None = None) -> Resources:
+    """Predict the resources of a run. The number of reads is estimated from the fastq size if not known."""
+
+    if num_reads is None:
+        num_reads = int(fastq_size_gb * 1024 ** 3 / model.bytes_per_read_pair)
+
+    transcriptome = transcriptome or model.default_transcriptome
+    features = get_features(fastq_size_gb, num_reads, transcriptome)
+
+    if transcriptome != model.default_transcriptome and TRANSCRIPTOME_PREFIX + transcriptome not in model.memory_coefficients:
+        print(f'WARNING: No run history of transcriptome {transcriptome}, predict for {model.default_transcriptome}')
+
+    rss_gb = sum(value * features.get(name, 0.0) for name, value in model.memory_coefficients.items())
+    cpu_cores = sum(value * features.get(name, 0.0) for name, value in model.cores_coefficients.items())
+
+    mem_gb = (max(rss_gb, 0) + model.memory_margin_gb) * MEMORY_HEADROOM
+    vcpus, task_gb = get_task_size(max(math.ceil(cpu_cores + model.cores_margin), 1), math.ceil(mem_gb) + OVERHEAD_GB)
+
+    return Resources(
+        num_cores=vcpus,
+        mem_gb=task_gb - OVERHEAD_GB,
+        task_cpu=str(vcpus * 1024),
+        task_memory=str(task_gb * 1024),
+        predicted_rss_gb=round(rss_gb, 2),
+        predicted_cpu_cores=round(cpu_cores, 2)
+    )
+
+
+def load_lambda(path: str = LAMBDA_PATH):
+    """Import the launch Lambda as a module."""
+
+    # The Lambda creates its boto3 clients at import, they need a region but send no request
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    spec = importlib.util.spec_from_file_location('lambda_put_ecs_task', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def check_lambda(model: SizingModel, lambda_module) -> list[str]:
+    """Compare the task sizes of predict and the launch Lambda. Returns the mismatches."""
+
+    mismatches = []
+
+    for fastq_size_gb in CHECK_SIZES_GB:
+        for num_reads in CHECK_QUICK_LOOK_READS:
+            fastq_size = int(fastq_size_gb * 1024 ** 3)
+
+            # A quick-look run is sized for the fastq size of its reads
+            if num_reads:
+                fastq_size = min(fastq_size, num_reads * model.bytes_per_read_pair)
+
+            resources = predict(model, fastq_size / 1024 ** 3)
+            expected = (resources.num_cores, int(resources.task_memory) // 1024)
+            task_size = lambda_module.predict_task_size(model.model_dump(), int(fastq_size_gb * 1024 ** 3), num_reads)
+
+            if task_size != expected:
+                mismatches.append(f'{fastq_size_gb} GB, {num_reads} reads: predict {expected}, Lambda {task_size}')
+
+    return mismatches
+
+
+def load_model(path: str | None = None, s3_bucket: str | None = None, s3_key: str | None = None) -> SizingModel:
+    """Load a sizing model from a local file or S3."""
+
+    if s3_bucket:
+        body = boto3.client('s3').get_object(Bucket=s3_bucket, Key=s3_key)['Body'].read()
+    else:
+        with open(path, 'rb') as fh:
+            body = fh.read()
+
+    return SizingModel.model_validate_json(body)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fit and apply the sizing model of the quantification')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit_parser = subparsers.add_parser('fit', help='Fit a sizing model to the run history of the backend')
+    fit_parser.add_argument('--backend-url', dest='backend_url', default=os.getenv('RAWDATA_PROCESSING_BACKEND_URL'), help='URL of the scrnaseq datasets')
+    fit_parser.add_argument('--engine', dest='engine', default='cellranger', help='Quantification engine of the runs')
+    fit_parser.add_argument('--output', dest='output', required=True, help='Output model (JSON)')
+    fit_parser.add_argument('--s3-bucket', dest='s3_bucket', default=None, help='Upload the model to this bucket')
+    fit_parser.add_argument('--s3-key', dest='s3_key', default=None, help='Key of the uploaded model')
+
+    predict_parser = subparsers.add_parser('predict', help='Predict the resources of a run')
+    predict_parser.add_argument('model', help='Model (JSON)')
+    predict_parser.add_argument('--fastq-size-gb', dest='fastq_size_gb', type=float, required=True, help='Size of read1 and read2')
+    predict_parser.add_argument('--num-reads', dest='num_reads', type=int, default=None, help='Number of read pairs, estimated if not set')
+    predict_parser.add_argument('--transcriptome', dest='transcriptome', default=None, help='Transcriptome reference name')
+
+    check_parser = subparsers.add_parser('check', help='Check that the launch Lambda predicts the same task sizes')
+    check_parser.add_argument('model', help='Model (JSON)')
+    check_parser.add_argument('--lambda-path', dest='lambda_path', default=LAMBDA_PATH, help='Launch Lambda (lambda_put_ecs_task.py)')
+
+    args = parser.parse_args()
+
+    if args.command == 'fit':
+        assert args.backend_url, 'Backend URL required, set --backend-url or RAWDATA_PROCESSING_BACKEND_URL'
+
+        login = HTTPBasicAuth(os.getenv('RAWDATA_PROCESSING_SERVICE_USER'), os.getenv('RAWDATA_PROCESSING_SERVICE_USER_PWD'))
+        res = requests.get(args.backend_url.rstrip('/') + '/', auth=login)
+        assert res.status_code == 200, f'Failed to get scrnaseq datasets with status code {res.status_code}. Exit.'
+
+        records = get_records(res.json(), args.engine)
+        model = fit(records, args.engine)
+
+        with open(args.output, 'w') as fh:
+            fh.write(model.model_dump_json(indent=2))
+
+        print(f'Fitted sizing model to {model.num_records} runs: peak RSS {model.memory_coefficients} (+{model.memory_margin_gb} GB), '
+              f'cores {model.cores_coefficients} (+{model.cores_margin})')
+
+        if args.s3_bucket:
+            boto3.client('s3').upload_file(args.output, args.s3_bucket, args.s3_key or os.path.basename(args.output))
+
+    elif args.command == 'predict':
+        resources = predict(load_model(args.model), args.fastq_size_gb, args.num_reads, args.transcriptome)
+        print(resources.model_dump_json(indent=2))
+
+    else:
+        mismatches = check_lambda(load_model(args.model), load_lambda(args.lambda_path))
+
+        for mismatch in mismatches:
+            print(f'WARNING: {mismatch}')
+
+        assert not mismatches, f'Lambda and predict differ in {len(mismatches)} task sizes. Exit.'
+        print(f'Lambda and predict agree on {len(CHECK_SIZES_GB) * len(CHECK_QUICK_LOOK_READS)} task sizes')
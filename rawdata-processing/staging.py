@@ -0,0 +1,291 @@
+# case-scrnaseq/rawdata-processing/staging.py
+
+"""
+Module for the concurrent staging of the inputs of a run.
+
+The fastq files and the transcriptome reference are staged at the same time,
+all downloads draw from one bandwidth budget (token bucket). Objects are
+downloaded with parallel ranged requests along the parts of their multipart
+upload, each part is hashed as it streams in. The size is checked per part
+and the ETag (MD5, or MD5 of the part MD5s for multipart uploads) once all
+parts are in, a bad input fails the staging before cellranger starts. A
+failed input aborts the other downloads at their next read.
+
+Each staged input is reported with its size, time and throughput.
+
+A quick-look run stages only the first reads of a fastq file, the object is
+streamed and decompressed until the reads are in and the rest is not
+downloaded.
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+
+import boto3
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+# Bytes read from a response stream at a time
+READ_SIZE = 1024 * 1024
+
+# Concurrent requests for the part sizes of a multipart object
+HEAD_WORKERS = 16
+
+# DATA CLASSES
+
+class StagedInput(BaseModel):
+    name: str
+    local_path: str
+    size: int
+    seconds: float
+    mb_per_second: float
+
+# METHODS
+
+class StagingAborted(Exception):
+    """Raised in a download when another input of the staging failed."""
+
+
+class TokenBucket:
+    """Bandwidth budget shared by concurrent downloads.
+
+    Args:
+        rate: Bytes per second, 0 for no limit.
+        burst: Bytes which can be consumed at once, one second of the rate by default.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes: int):
+        """Take num_bytes from the bucket, waits while the bucket is in debt."""
+
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - num_bytes
+            self.last = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+def get_path_size(path: str) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def get_parts(s3_client, s3_bucket: str, s3_key: str, head: dict) -> list[tuple[int, int]]:
+    """Return (offset, size) of the parts of an object, a single part for objects of a single-part upload."""
+
+    size = head['ContentLength']
+    etag = head['ETag'].strip('"')
+
+    if '-' not in etag:
+        return [(0, size)]
+
+    num_parts = int(etag.split('-')[1])
+
+    # Parts can have different sizes, e.g. a short part after each lane, every part is looked up
+    with ThreadPoolExecutor(min(num_parts, HEAD_WORKERS)) as executor:
+        part_sizes = list(executor.map(
+            lambda part_number: s3_client.head_object(Bucket=s3_bucket, Key=s3_key, PartNumber=part_number)['ContentLength'],
+            range(1, num_parts + 1)
+        ))
+
+    if sum(part_sizes) != size:
+        raise ValueError(f'Parts of {s3_key} have {sum(part_sizes)} bytes, the object has {size} bytes. Exit.')
+
+    parts = []
+    offset = 0
+
+    for part_size in part_sizes:
+        parts.append((offset, part_size))
+        offset += part_size
+
+    return parts
+
+
+class Stager:
+    """Concurrent staging of the inputs of a run.
+
+    Args:
+        s3_client: boto3 S3 client.
+        max_mbps: Bandwidth budget of all downloads in MB/s, 0 for no limit.
+        workers: Number of parts of an object downloaded in parallel.
+    """
+
+    def __init__(self, s3_client=None, max_mbps: float = 0, workers: int = 8):
+        if s3_client is None:
+            s3_client = boto3.client('s3')
+
+        self.s3_client = s3_client
+        self.workers = workers
+        self.limiter = TokenBucket(max_mbps * 1024 * 1024)
+        self.aborted = threading.Event()
+        self.staged: list[StagedInput] = []
+
+    def throttle(self, num_bytes: int):
+        """Account downloaded bytes in the bandwidth budget. Raises StagingAborted if another input failed."""
+
+        if self.aborted.is_set():
+            raise StagingAborted('Staging aborted, another input failed')
+
+        self.limiter.consume(num_bytes)
+
+    def download(self, s3_bucket: str, s3_key: str, local_path: str) -> str:
+        """Download and validate an object. Returns the local path."""
+
+        head = self.s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+        etag = head['ETag'].strip('"')
+        parts = get_parts(self.s3_client, s3_bucket, s3_key, head)
+
+        with open(local_path, 'wb') as fh:
+            fh.truncate(head['ContentLength'])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = list(executor.map(lambda part: self._download_part(s3_bucket, s3_key, local_path, *part), parts))
+
+        # ETags of SSE-KMS and SSE-C encrypted objects are not MD5 based
+        if head.get('ServerSideEncryption') == 'aws:kms' or head.get('SSECustomerAlgorithm'):
+            return local_path
+
+        if '-' in etag:
+            md5 = hashlib.md5(b''.join(digests)).hexdigest() + f'-{len(parts)}'
+        else:
+            md5 = digests[0].hex()
+
+        if md5 != etag:
+            raise ValueError(f'{s3_key} does not match its ETag {etag}. Exit.')
+
+        return local_path
+
+    def download_head(self, s3_bucket: str, s3_key: str, local_path: str, num_reads: int) -> str:
+        """Download the first reads of a gzipped fastq file into a new gzipped file. Returns the local path."""
+
+        res = self.s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+        remaining_lines = 4 * num_reads
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+        with gzip.open(local_path, 'wb', compresslevel=1) as fh:
+            try:
+                for chunk in res['Body'].iter_chunks(READ_SIZE):
+                    self.throttle(len(chunk))
+
+                    # Multi-member files (e.g. BGZF) are decompressed member by member
+                    while chunk and remaining_lines:
+                        data = decompressor.decompress(chunk)
+
+                        if decompressor.eof:
+                            chunk = decompressor.unused_data
+                            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                        else:
+                            chunk = b''
+
+                        num_lines = data.count(b'\n')
+
+                        # Cut after the last line of the last read
+                        if num_lines >= remaining_lines:
+                            end = -1
+                            for _ in range(remaining_lines):
+                                end = data.index(b'\n', end + 1)
+                            data = data[:end + 1]
+                            num_lines = remaining_lines
+
+                        fh.write(data)
+                        remaining_lines -= num_lines
+
+                    if not remaining_lines:
+                        break
+            finally:
+                res['Body'].close()
+
+        if remaining_lines:
+            print(f'WARNING: {s3_key} has fewer than {num_reads} reads, use all {(4 * num_reads - remaining_lines) // 4} reads')
+
+        return local_path
+
+    def stage(self, inputs: dict) -> dict:
+        """Stage inputs concurrently, inputs maps names to functions which return the local path.
+
+        Returns the local paths by name. The first failed input aborts the others and is raised.
+        """
+
+        start = time.perf_counter()
+        paths = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=len(inputs)) as executor:
+            futures = {executor.submit(self._stage_input, name, stage_input): name for name, stage_input in inputs.items()}
+
+            for future in as_completed(futures):
+                try:
+                    paths[futures[future]] = future.result()
+
+                except Exception as e:
+                    self.aborted.set()
+
+                    if error is None or isinstance(error, StagingAborted):
+                        error = e
+
+        if error is not None:
+            raise error
+
+        print(f'Staged {len(inputs)} inputs in {time.perf_counter() - start:.1f} s')
+
+        return paths
+
+    def _stage_input(self, name: str, stage_input) -> str:
+        start = time.perf_counter()
+        local_path = stage_input()
+        seconds = max(time.perf_counter() - start, 1e-6)
+
+        size = get_path_size(local_path)
+        staged_input = StagedInput(name=name, local_path=local_path, size=size, seconds=round(seconds, 2),
+                                   mb_per_second=round(size / (1024 * 1024) / seconds, 1))
+        self.staged.append(staged_input)
+
+        print(f'Staged {name} ({size / (1024 * 1024):.1f} MB) in {seconds:.1f} s ({staged_input.mb_per_second} MB/s)')
+
+        return local_path
+
+    def _download_part(self, s3_bucket: str, s3_key: str, local_path: str, offset: int, size: int) -> bytes:
+        md5 = hashlib.md5()
+        position = offset
+
+        if size:
+            res = self.s3_client.get_object(Bucket=s3_bucket, Key=s3_key, Range=f'bytes={offset}-{offset + size - 1}')
+            fd = os.open(local_path, os.O_WRONLY)
+
+            try:
+                while data := res['Body'].read(READ_SIZE):
+                    self.throttle(len(data))
+                    md5.update(data)
+                    os.pwrite(fd, data, position)
+                    position += len(data)
+            finally:
+                os.close(fd)
+                res['Body'].close()
+
+        if position - offset != size:
+            raise ValueError(f'{s3_key} has {position - offset} bytes at offset {offset}, expected {size}. Exit.')
+
+        return md5.digest()
@@ -0,0 +1,341 @@
+# case-scrnaseq/rawdata-processing/supervisor.py
+
+"""
+Module for the resource and stage instrumentation of the quantification.
+
+The supervisor runs the quantification command (cellranger) as a subprocess,
+or monitors the own process for in-process engines. A sampler thread reads
+the process tree from /proc at a fixed interval: RSS, CPU time of the live
+processes and their reaped children, and the bytes used on the filesystem of
+the working directory. Stdout and stderr of the subprocess are passed through
+and the last lines are kept in ring buffers for error reports.
+
+Stages of cellranger are parsed from the _log of the martian pipestance
+directory, in-process engines mark their stages. The timeline holds the
+samples and per stage the wall time, peak RSS and CPU utilisation. Martian
+runs stages in parallel, a sample is attributed to all running stages. The
+summary relates peak RSS and CPU utilisation to the configured cores and
+memory.
+"""
+
+import contextlib
+import datetime
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from pydantic import BaseModel
+
+__author__ = "Jonathan Alles"
+__email__ = "Jonathan.Alles@evo-byte.com"
+__copyright__ = "Copyright 2024"
+
+SAMPLE_INTERVAL_SECONDS = 5.0
+
+# Lines of stdout and stderr kept for error reports
+RING_BUFFER_LINES = 200
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Martian runtime log of a pipestance, e.g.
+# 2024-04-10 10:01:25 [runtime] (chunks_complete) ID.sample.SC_RNA_COUNTER_CS.SC_MULTI_CORE.MULTI_CHEMISTRY_DETECTOR.DETECT_COUNT_CHEMISTRY
+MARTIAN_LOG_NAME = '_log'
+MARTIAN_LOG_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) \[runtime\] \(([\w:]+)\)\s+(\S+)')
+MARTIAN_CHUNK_PATTERN = re.compile(r'\.fork\d+.*$')
+MARTIAN_COMPLETE_STATES = ('chunks_complete', 'join_complete', 'complete')
+
+# Stages of the summary
+SUMMARY_STAGES = 5
+
+# DATA CLASSES
+
+class ResourceSample(BaseModel):
+    time: float # Seconds since the start
+    rss_mb: float
+    cpu_cores: float # CPU seconds per second since the previous sample
+    disk_used_mb: float # Since the start
+    num_processes: int
+
+class StageTiming(BaseModel):
+    name: str
+    start: float
+    end: float
+    seconds: float
+    peak_rss_mb: float
+    mean_cpu_cores: float
+
+class RunSummary(BaseModel):
+    engine: str
+    returncode: int | None = None
+    seconds: float
+    num_cores: int
+    mem_gb: int
+    peak_rss_mb: float
+    mean_cpu_cores: float
+    peak_cpu_cores: float
+    cpu_utilisation: float # Mean CPU cores of the configured cores
+    memory_utilisation: float # Peak RSS of the configured memory
+    peak_disk_used_mb: float
+    slowest_stages: dict[str, float] = {}
+
+class RunTimeline(BaseModel):
+    command: list[str] = []
+    started: str
+    interval: float
+    summary: RunSummary
+    stages: list[StageTiming] = []
+    samples: list[ResourceSample] = []
+    output_tail: list[str] = []
+
+# METHODS
+
+def read_process_stat(pid: int) -> tuple[int, int, int] | None:
+    """Return (parent pid, CPU ticks including reaped children, RSS bytes) of a process, None if it exited."""
+
+    try:
+        with open(f'/proc/{pid}/stat') as fh:
+            stat = fh.read()
+    except OSError:
+        return None
+
+    # The command name in parentheses can contain spaces
+    fields = stat.rsplit(')', 1)[1].split()
+
+    return int(fields[1]), sum(int(value) for value in fields[11:15]), int(fields[21]) * PAGE_SIZE
+
+
+def get_process_tree(root_pid: int) -> dict[int, tuple[int, int, int]]:
+    """Return the stats of a process and all of its descendants."""
+
+    stats = {}
+
+    for entry in os.listdir('/proc'):
+        if entry.isdigit() and (stat := read_process_stat(int(entry))) is not None:
+            stats[int(entry)] = stat
+
+    children = {}
+    for pid, stat in stats.items():
+        children.setdefault(stat[0], []).append(pid)
+
+    tree = {}
+    pending = [root_pid] if root_pid in stats else []
+
+    while pending:
+        pid = pending.pop()
+        tree[pid] = stats[pid]
+        pending.extend(children.get(pid, []))
+
+    return tree
+
+
+def parse_martian_log(lines: list[str], stages: dict):
+    """Update stages (name to [start, end]) with the events of martian runtime log lines."""
+
+    for line in lines:
+        match = MARTIAN_LOG_PATTERN.match(line)
+
+        if not match:
+            continue
+
+        timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S').timestamp()
+        name = MARTIAN_CHUNK_PATTERN.sub('', match.group(3)).split('.')[-1]
+        stage = stages.setdefault(name, [timestamp, None])
+        stage[0] = min(stage[0], timestamp)
+
+        if match.group(2) in MARTIAN_COMPLETE_STATES:
+            stage[1] = max(stage[1] or timestamp, timestamp)
+
+
+class Supervisor:
+    """Resource sampler and stage tracker of a quantification run.
+
+    Args:
+        engine: Name of the quantification engine.
+        num_cores: Configured number of cores.
+        mem_gb: Configured memory in GB.
+        interval: Seconds between samples.
+    """
+
+    def __init__(self, engine: str, num_cores: int, mem_gb: int, interval: float = SAMPLE_INTERVAL_SECONDS):
+        self.engine = engine
+        self.num_cores = num_cores
+        self.mem_gb = mem_gb
+        self.interval = interval
+
+        self.command = []
+        self.returncode = None
+        self.started = None
+        self.ended = None
+        self.samples: list[ResourceSample] = []
+        self.stages = {} # name to [start, end] in epoch seconds
+        self.output = deque(maxlen=RING_BUFFER_LINES)
+
+        self._lock = threading.Lock()
+
+    def run(self, cmd: list[str], pipestance_dir: str | None = None) -> int:
+        """Run a command under supervision. Returns the return code."""
+
+        self.command = cmd
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace', bufsize=1)
+
+        readers = [threading.Thread(target=self._pass_through, args=(process.stdout, sys.stdout), daemon=True),
+                   threading.Thread(target=self._pass_through, args=(process.stderr, sys.stderr), daemon=True)]
+
+        with self.monitor(process.pid, pipestance_dir):
+            for reader in readers:
+                reader.start()
+
+            self.returncode = process.wait()
+
+            for reader in readers:
+                reader.join()
+
+        return self.returncode
+
+    @contextlib.contextmanager
+    def monitor(self, pid: int | None = None, pipestance_dir: str | None = None):
+        """Sample the process tree of pid (default the own process) while the context is open."""
+
+        pid = pid or os.getpid()
+        work_dir = os.getcwd()
+        stop = threading.Event()
+
+        self.started = time.time()
+        disk_used = shutil.disk_usage(work_dir).used
+
+        def sample():
+            log_path = os.path.join(pipestance_dir, MARTIAN_LOG_NAME) if pipestance_dir else None
+            log_offset = 0
+            last_time, last_cpu = time.time(), None
+            final = False
+
+            # A final pass after the stop reads the last log lines
+            while True:
+                tree = get_process_tree(pid)
+                now = time.time()
+                cpu = sum(stat[1] for stat in tree.values()) / CLOCK_TICKS
+
+                if log_path and os.path.isfile(log_path):
+                    with open(log_path, 'rb') as fh:
+                        fh.seek(log_offset)
+                        lines = fh.readlines()
+
+                    # Incomplete lines are read with the next sample
+                    if lines and not lines[-1].endswith(b'\n'):
+                        lines.pop()
+
+                    log_offset += sum(len(line) for line in lines)
+
+                    with self._lock:
+                        parse_martian_log([line.decode(errors='replace') for line in lines], self.stages)
+
+                if tree:
+                    self.samples.append(ResourceSample(
+                        time=round(now - self.started, 2),
+                        rss_mb=round(sum(stat[2] for stat in tree.values()) / (1024 * 1024), 1),
+                        cpu_cores=round(max(cpu - last_cpu, 0) / max(now - last_time, 1e-6), 2) if last_cpu is not None else 0.0,
+                        disk_used_mb=round((shutil.disk_usage(work_dir).used - disk_used) / (1024 * 1024), 1),
+                        num_processes=len(tree)
+                    ))
+                    last_time, last_cpu = now, cpu
+
+                if final:
+                    return
+
+                final = stop.wait(self.interval)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        try:
+            yield self
+        finally:
+            stop.set()
+            sampler.join()
+            self.ended = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Mark a stage of an in-process engine."""
+
+        with self._lock:
+            self.stages[name] = [time.time(), None]
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages[name][1] = time.time()
+
+    def get_output_tail(self, num_lines: int = 50) -> str:
+        return '\n'.join(list(self.output)[-num_lines:])
+
+    def get_timeline(self) -> RunTimeline:
+        assert self.started is not None, 'Nothing was monitored'
+
+        ended = self.ended or time.time()
+        stages = []
+
+        with self._lock:
+            spans = {name: (start, end or ended) for name, (start, end) in self.stages.items()}
+
+        for name, (start, end) in sorted(spans.items(), key=lambda item: item[1][0]):
+            # Martian log timestamps have a resolution of seconds
+            start, end = max(start - self.started, 0), max(end - self.started, 0)
+            samples = [s for s in self.samples if start <= s.time <= end]
+
+            # Stages shorter than the interval get the next sample
+            if not samples:
+                samples = [s for s in self.samples if s.time >= start][:1]
+
+            stages.append(StageTiming(
+                name=name,
+                start=round(start, 2),
+                end=round(end, 2),
+                seconds=round(end - start, 2),
+                peak_rss_mb=max((s.rss_mb for s in samples), default=0.0),
+                mean_cpu_cores=round(sum(s.cpu_cores for s in samples) / len(samples), 2) if samples else 0.0
+            ))
+
+        cpu_samples = [s.cpu_cores for s in self.samples[1:]]
+        mean_cpu_cores = round(sum(cpu_samples) / len(cpu_samples), 2) if cpu_samples else 0.0
+        peak_rss_mb = max((s.rss_mb for s in self.samples), default=0.0)
+
+        summary = RunSummary(
+            engine=self.engine,
+            returncode=self.returncode,
+            seconds=round(ended - self.started, 2),
+            num_cores=self.num_cores,
+            mem_gb=self.mem_gb,
+            peak_rss_mb=peak_rss_mb,
+            mean_cpu_cores=mean_cpu_cores,
+            peak_cpu_cores=max(cpu_samples, default=0.0),
+            cpu_utilisation=round(mean_cpu_cores / self.num_cores, 3),
+            memory_utilisation=round(peak_rss_mb / (self.mem_gb * 1024), 3),
+            peak_disk_used_mb=max((s.disk_used_mb for s in self.samples), default=0.0),
+            slowest_stages={stage.name: stage.seconds for stage in sorted(stages, key=lambda s: -s.seconds)[:SUMMARY_STAGES]}
+        )
+
+        return RunTimeline(
+            command=self.command,
+            started=datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            interval=self.interval,
+            summary=summary,
+            stages=stages,
+            samples=self.samples,
+            output_tail=list(self.output)
+        )
+
+    def _pass_through(self, pipe, out):
+        for line in pipe:
+            out.write(line)
+            out.flush()
+            self.output.append(line.rstrip('\n'))
+
+        pipe.close()
@@ -12,11 +12,13 @@ class ScrnaseqDatasets(BaseModel):
     s3_qc_metrics_key : str
     s3_gene_expression_matrix_key : str
     s3_gene_expression_matrix_size_mb : float
+    s3_analysis_matrix_key : str | None = None
     number_cells : int
     mean_reads_per_cell : int
     median_number_genes_per_cell : int
     total_number_reads : int
     pipeline_version : str
+    provisional : bool = False
     valid_from : datetime.datetime
     valid_to : datetime.datetime | None
     